@@ -1,6 +1,11 @@
 """Конфигурация приложения и настройки."""
 
+import atexit
+import logging
 import os
+from logging import FileHandler, StreamHandler
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
 from dotenv import load_dotenv
 
 # Загрузка переменных из .env файла
@@ -12,9 +17,90 @@ COINGECKO_API_KEY = os.getenv("COINGECKO_API_KEY", "")
 BITQUERY_API_KEY = os.getenv("BITQUERY_API_KEY", "")
 
 # Настройки LLM
-LLM_MODEL = "gpt-4"
+LLM_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+# Модели по ролям: диалоговый агент (выбор инструментов) и итоговый отчет deep research
+AGENT_LLM_MODEL = os.getenv("AGENT_LLM_MODEL", LLM_MODEL)
+RESEARCH_LLM_MODEL = os.getenv("RESEARCH_LLM_MODEL", LLM_MODEL)
+# Легкая модель для маршрутизации (например, нужны ли уточняющие вопросы)
+ROUTER_LLM_MODEL = os.getenv("ROUTER_LLM_MODEL", "gpt-4o-mini")
+# Модель форматирования итоговых отчетов из готовых результатов задач (данные уже собраны,
+# поэтому достаточно легкой модели)
+FORMATTER_LLM_MODEL = os.getenv("FORMATTER_LLM_MODEL", "gpt-4o-mini")
 LLM_TEMPERATURE = 0
 
+# Сжатие истории диалога: при превышении порога старшая половина заменяется кратким содержанием
+HISTORY_TOKEN_THRESHOLD = int(os.getenv("HISTORY_TOKEN_THRESHOLD", "6000"))
+SUMMARY_LLM_MODEL = os.getenv("SUMMARY_LLM_MODEL", "gpt-4o-mini")
+# Жесткий предел токенов истории, отправляемой модели за ход (после сжатия)
+HISTORY_WINDOW_TOKENS = int(os.getenv("HISTORY_WINDOW_TOKENS", "8000"))
+
+# Хранилище сессий (чекпойнтер LangGraph) и число последних сообщений сессии, отправляемых модели
+SESSIONS_DB = os.getenv("SESSIONS_DB", "sessions.db")
+SESSION_CONTEXT_MESSAGES = int(os.getenv("SESSION_CONTEXT_MESSAGES", "20"))
+
+# Максимальное число одновременных вызовов LLM в мультиагентной системе
+MAX_CONCURRENT_LLM = int(os.getenv("MAX_CONCURRENT_LLM", "16"))
+# Общий лимит запросов к OpenAI в секунду для всех клиентов модели (0 - без ограничения)
+LLM_REQUESTS_PER_SECOND = float(os.getenv("LLM_REQUESTS_PER_SECOND", "5"))
+
+# Максимальное число одновременно выполняемых инструментов за один ход модели
+TOOL_MAX_CONCURRENCY = int(os.getenv("TOOL_MAX_CONCURRENCY", "8"))
+
+# Ограничения на число одновременных запросов к внешним API
+COINGECKO_MAX_CONCURRENCY = int(os.getenv("COINGECKO_MAX_CONCURRENCY", "4"))
+LLAMAFEED_MAX_CONCURRENCY = int(os.getenv("LLAMAFEED_MAX_CONCURRENCY", "8"))
+BITQUERY_MAX_CONCURRENCY = int(os.getenv("BITQUERY_MAX_CONCURRENCY", "4"))
+DEFILLAMA_MAX_CONCURRENCY = int(os.getenv("DEFILLAMA_MAX_CONCURRENCY", "8"))
+# Лимит запросов к CoinGecko в секунду для всех инструментов (0 - без ограничения)
+COINGECKO_REQUESTS_PER_SECOND = float(os.getenv("COINGECKO_REQUESTS_PER_SECOND", "5"))
+
+# Время жизни кэша ответов модели на повторяющиеся промпты (секунды)
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
+
+# Число последних вызовов модели, по которым считается телеметрия (задержка, токены)
+LLM_TELEMETRY_SIZE = int(os.getenv("LLM_TELEMETRY_SIZE", "1024"))
+
+# Время жизни кэша цен токенов (секунды)
+TOKEN_PRICE_CACHE_TTL = int(os.getenv("TOKEN_PRICE_CACHE_TTL", "15"))
+
+# Время жизни кэша цен и рыночных данных HyperLiquid (секунды)
+HYPERLIQUID_PRICE_CACHE_TTL = int(os.getenv("HYPERLIQUID_PRICE_CACHE_TTL", "2"))
+HYPERLIQUID_CACHE_TTL = int(os.getenv("HYPERLIQUID_CACHE_TTL", "60"))
+
+# Время жизни кэша трендов и результатов поиска CoinGecko (секунды)
+COINGECKO_CACHE_TTL = int(os.getenv("COINGECKO_CACHE_TTL", "60"))
+
+# Время жизни кэша лент LlamaFeed (секунды)
+LLAMAFEED_CACHE_TTL = int(os.getenv("LLAMAFEED_CACHE_TTL", "300"))
+
+# Время жизни кэша ответов внешних API с редко меняющимися данными (секунды)
+DEFILLAMA_CACHE_TTL = int(os.getenv("DEFILLAMA_CACHE_TTL", "600"))
+GECKOTERMINAL_CACHE_TTL = int(os.getenv("GECKOTERMINAL_CACHE_TTL", "120"))
+GECKOTERMINAL_META_CACHE_TTL = int(os.getenv("GECKOTERMINAL_META_CACHE_TTL", "86400"))
+COINGECKO_HISTORY_CACHE_TTL = int(os.getenv("COINGECKO_HISTORY_CACHE_TTL", "1800"))
+BITQUERY_CACHE_TTL = int(os.getenv("BITQUERY_CACHE_TTL", "3600"))
+
+# Повторы запросов инструментов к внешним API при 429/5xx и обрывах соединения
+HTTP_RETRY_ATTEMPTS = int(os.getenv("HTTP_RETRY_ATTEMPTS", "3"))
+# Число ошибок подряд, после которого запросы к хосту отклоняются сразу, и длительность паузы (секунды)
+HTTP_BREAKER_THRESHOLD = int(os.getenv("HTTP_BREAKER_THRESHOLD", "5"))
+HTTP_BREAKER_RESET_S = float(os.getenv("HTTP_BREAKER_RESET_S", "30"))
+
+# Сколько хранить тело ответа вместе с ETag для условных запросов после истечения кэша (секунды)
+HTTP_ETAG_CACHE_TTL = int(os.getenv("HTTP_ETAG_CACHE_TTL", "86400"))
+
+# Максимальная длина результата одной задачи в промптах форматирования отчета (символы)
+REPORT_RESULT_MAX_CHARS = int(os.getenv("REPORT_RESULT_MAX_CHARS", "8000"))
+
+# Бюджет токенов на промпт анализа deep research (шаблон + собранные данные)
+RESEARCH_PROMPT_TOKEN_BUDGET = int(os.getenv("RESEARCH_PROMPT_TOKEN_BUDGET", "16000"))
+
+# Спиннер rich во время этапов deep research (только для интерактивного CLI)
+RESEARCH_PROGRESS_UI = os.getenv("RESEARCH_PROGRESS_UI") == "1"
+
+# Число разобранных Markdown-ответов, которые хранятся для повторного вывода (0 - без кэша)
+MARKDOWN_CACHE_SIZE = int(os.getenv("MARKDOWN_CACHE_SIZE", "64"))
+
 # Настройки приложения
 APP_NAME = "🚀 CRYPTO AI ASSISTANT 🚀"
 APP_COLOR = "cyan"
@@ -29,42 +115,40 @@ def setup_environment():
     # Проверка наличия ключей
     if not os.environ.get("OPENAI_API_KEY"):
         print("⚠️  ВНИМАНИЕ: OPENAI_API_KEY не установлен!")
+
+    configure_logging()
         
         
-import logging
-from logging.handlers import QueueHandler, QueueListener
-from logging import StreamHandler, FileHandler
-from queue import Queue
+# Уровень логирования и необязательный файл журнала
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+LOG_FILE = os.getenv("LOG_FILE", "")
 
-# Настройка асинхронного логирования
-# log_queue = Queue()
-# queue_listener = QueueListener(
-#     log_queue,
-#     StreamHandler(),
-#     FileHandler('agent_system.log', encoding='utf-8')
-# )
-# queue_listener.start()
-
-# def configure_logging():
-#     root_logger = logging.getLogger()
-#     root_logger.setLevel(logging.INFO)
-#     root_logger.addHandler(QueueHandler(log_queue))
-    
-#     # Форматтер с цветами для консоли
-#     console_formatter = logging.Formatter(
-#         '[%(asctime)s] %(levelname)-8s %(agent_id)s %(task_id)s %(message)s',
-#         datefmt='%Y-%m-%d %H:%M:%S'
-#     )
-    
-#     # Форматтер для файла
-#     file_formatter = logging.Formatter(
-#         '[%(asctime)s] %(levelname)-8s %(agent_id)s %(task_id)s %(message)s'
-#     )
-    
-#     for handler in queue_listener.handlers:
-#         if isinstance(handler, StreamHandler):
-#             handler.setFormatter(console_formatter)
-#         elif isinstance(handler, FileHandler):
-#             handler.setFormatter(file_formatter)
+# Настройка асинхронного логирования: обработчики пишут в потоке QueueListener,
+# а корутины только кладут запись в очередь и не блокируются на вводе-выводе
+_queue_listener = None
+
+
+def configure_logging():
+    """Подключает очередь логирования к корневому логгеру (повторные вызовы ничего не делают)."""
+    global _queue_listener
+    if _queue_listener is not None:
+        return
+
+    formatter = logging.Formatter(
+        '[%(asctime)s] %(levelname)-8s %(name)s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    handlers = [StreamHandler()]
+    if LOG_FILE:
+        handlers.append(FileHandler(LOG_FILE, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = Queue(-1)
+    _queue_listener = QueueListener(log_queue, *handlers)
+    _queue_listener.start()
+    atexit.register(_queue_listener.stop)
 
-# configure_logging()
+    root_logger = logging.getLogger()
+    root_logger.setLevel(LOG_LEVEL)
+    root_logger.addHandler(QueueHandler(log_queue))
@@ -1,24 +1,40 @@
 """Логика работы с LLM и инструментами."""
 
+import functools
+import logging
 import time
-from typing import Literal, Dict, Any, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import TYPE_CHECKING, AsyncIterator, Literal, Dict, Any, List, Optional, Tuple
 import asyncio
 
-from langchain_openai import ChatOpenAI
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
 from langgraph.graph import StateGraph, MessagesState, START, END
-from langgraph.prebuilt import ToolNode
 
-from .deep_research import DeepResearchManager
 
-from config.settings import LLM_MODEL, LLM_TEMPERATURE
+from .llm import make_llm
+from .memory import compact_history
+
+from config.settings import (
+    AGENT_LLM_MODEL,
+    RESEARCH_LLM_MODEL,
+    LLM_TEMPERATURE,
+    HISTORY_TOKEN_THRESHOLD,
+    HISTORY_WINDOW_TOKENS,
+    TOOL_MAX_CONCURRENCY
+)
 from tools import (
     get_token_price,
+    get_token_prices,
     get_trending_coins,
     search_cryptocurrencies,
     analyze_protocol,
+    analyze_protocols_bulk,
     analyze_pools_geckoterminal,
     get_token_historical_data,
+    analyze_tokens_bulk,
     analyze_token_holders,
+    analyze_holders_bulk,
     # fetch_crypto_news,
     # Добавляем новые инструменты HyperLiquid
     get_crypto_price,
@@ -37,122 +53,238 @@ from tools import (
     get_polymarket_data,
     get_market_summary
 )
-from models.state import AgentState, ToolCall, ToolResult
+from models.state import AgentState, ToolCall, ToolResult, TurnEvent
 from models.tool_schemas import ToolType
 
+if TYPE_CHECKING:
+    # Модуль deep research загружается только при первом исследовании
+    from .deep_research import ProgressCallback
+
+
+logger = logging.getLogger(__name__)
+
+
+# Список всех инструментов агента
+TOOLS = [
+    get_token_price,
+    get_token_prices,
+    get_trending_coins,
+    search_cryptocurrencies,
+    analyze_protocol,
+    analyze_protocols_bulk,
+    analyze_pools_geckoterminal,
+    get_token_historical_data,
+    analyze_tokens_bulk,
+    analyze_token_holders,
+    analyze_holders_bulk,
+    # fetch_crypto_news,
+
+    # Инструменты HyperLiquid
+    get_crypto_price,
+    get_klines_history,
+    execute_trade,
+    confirm_trade,
+    get_market_info,
+    get_account_info,
+
+    # Инструменты LlamaFeed
+    get_crypto_news,
+    get_crypto_tweets,
+    get_crypto_hacks,
+    get_token_unlocks,
+    get_project_raises,
+    get_polymarket_data,
+    get_market_summary
+]
+
+# Таблица диспетчеризации инструментов строится один раз и не изменяется
+_TOOLS_BY_NAME = MappingProxyType({t.name: t for t in TOOLS})
+
+# Пул потоков для синхронных инструментов, чтобы они не блокировали event loop
+_TOOL_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="agent-tool")
+
+
+@functools.lru_cache(maxsize=1)
+def _get_llm_with_tools(model: str, temperature: float):
+    """Возвращает модель с привязанными инструментами (один экземпляр на процесс)."""
+    return make_llm(temperature, model).bind_tools(TOOLS)
+
+
+def _should_continue(state: MessagesState) -> Literal["tools", "end"]:
+    """Определяет, нужно ли вызывать инструменты или завершить обработку."""
+    messages = state["messages"]
+    last_message = messages[-1]
+    if hasattr(last_message, "tool_calls") and last_message.tool_calls:
+        return "tools"
+    return "end"
+
+
+async def _dispatch_tool_call(tool_call: Dict[str, Any]) -> ToolMessage:
+    """Выполняет один вызов инструмента и оборачивает результат в ToolMessage."""
+    tool = _TOOLS_BY_NAME.get(tool_call["name"])
+    if tool is None:
+        return ToolMessage(
+            content=f"Ошибка: инструмент {tool_call['name']} не найден",
+            name=tool_call["name"],
+            tool_call_id=tool_call["id"],
+            status="error"
+        )
+
+    try:
+        if getattr(tool, "coroutine", None) is not None:
+            result = await tool.ainvoke(tool_call["args"])
+        else:
+            # Синхронный инструмент выполняем в пуле потоков
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                _TOOL_EXECUTOR, functools.partial(tool.invoke, tool_call["args"])
+            )
+    except Exception as e:
+        # Ошибка возвращается модели, как это делает ToolNode, а не прерывает граф
+        return ToolMessage(
+            content=f"Ошибка: {e!r}\nИсправь аргументы и попробуй снова.",
+            name=tool.name,
+            tool_call_id=tool_call["id"],
+            status="error"
+        )
+
+    return ToolMessage(
+        content=result if isinstance(result, str) else str(result),
+        name=tool.name,
+        tool_call_id=tool_call["id"]
+    )
+
+
+async def _parallel_tools(state: MessagesState):
+    """Выполняет все вызовы инструментов из последнего ответа модели параллельно."""
+    tool_calls = state["messages"][-1].tool_calls
+    # Ограничиваем число одновременных вызовов внешних API за один ход модели
+    semaphore = asyncio.Semaphore(TOOL_MAX_CONCURRENCY)
+
+    async def run(call: Dict[str, Any]) -> ToolMessage:
+        async with semaphore:
+            return await _dispatch_tool_call(call)
+
+    messages = await asyncio.gather(*(run(call) for call in tool_calls))
+    return {"messages": list(messages)}
+
+
+def _context_window(messages: List[Any], size: int) -> List[Any]:
+    """Возвращает последние size сообщений, не начиная окно с результатов инструментов без их вызова."""
+    window = messages[-size:]
+    start = 0
+    while start < len(window) and isinstance(window[start], ToolMessage):
+        start += 1
+    return window[start:]
+
+
+def _build_workflow(model: str, temperature: float, context_window: Optional[int] = None) -> StateGraph:
+    """Создает граф агента с инструментами (без компиляции)."""
+    llm_with_tools = _get_llm_with_tools(model, temperature)
+
+    async def call_model(state: MessagesState):
+        """Вызывает модель с текущими сообщениями."""
+        messages = state["messages"]
+        if context_window:
+            # Состояние сессии хранится в чекпойнтере целиком, модели отправляется только хвост
+            messages = _context_window(messages, context_window)
+
+        # Задержка LLM замеряется только при включенном DEBUG-логировании
+        if not logger.isEnabledFor(logging.DEBUG):
+            return {"messages": [await llm_with_tools.ainvoke(messages)]}
+
+        started = time.perf_counter_ns()
+        response = await llm_with_tools.ainvoke(messages)
+        logger.debug("llm_latency_ns=%d", time.perf_counter_ns() - started)
+        return {"messages": [response]}
+
+    # Создание графа состояния
+    workflow = StateGraph(MessagesState)
+
+    # Добавление узлов и ребер
+    workflow.add_node("agent", call_model)
+    workflow.add_node("tools", _parallel_tools)
+
+    workflow.set_entry_point("agent")
+    workflow.add_conditional_edges(
+        "agent",
+        _should_continue,
+        {"tools": "tools", "end": END}
+    )
+    workflow.add_edge("tools", "agent")
+    return workflow
+
+
+@functools.lru_cache(maxsize=1)
+def _get_compiled_graph(model: str, temperature: float):
+    """Создает и компилирует граф агента с инструментами (один раз на процесс)."""
+    return _build_workflow(model, temperature).compile()
+
 
 class CryptoAgent:
     """Класс агента для анализа криптовалют с использованием LLM и инструментов."""
     
     def __init__(self):
         """Инициализация агента и его компонентов."""
+        # Собственное у агента только состояние диалога,
+        # модель с инструментами и граф общие для всего процесса
         self.state = AgentState()
-        self.llm = ChatOpenAI(model=LLM_MODEL, temperature=LLM_TEMPERATURE)
-        
-        # Список всех инструментов
-        self.tools = [
-            get_token_price,
-            get_trending_coins,
-            search_cryptocurrencies,
-            analyze_protocol,
-            analyze_pools_geckoterminal,
-            get_token_historical_data,
-            analyze_token_holders,
-            # fetch_crypto_news,
-            
-            # Инструменты HyperLiquid
-            get_crypto_price,
-            get_klines_history,
-            execute_trade,
-            confirm_trade,
-            get_market_info,
-            get_account_info,
-            
-            # Инструменты LlamaFeed
-            get_crypto_news,
-            get_crypto_tweets,
-            get_crypto_hacks,
-            get_token_unlocks,
-            get_project_raises,
-            get_polymarket_data,
-            get_market_summary
-        ]
-        
-        # Привязка инструментов к модели
-        self.llm_with_tools = self.llm.bind_tools(self.tools)
-        
-        # Создание графа агента
-        self.agent = self._create_agent_graph()
+        # Изменения состояния после хода применяются атомарно, чтобы один агент
+        # можно было безопасно использовать из нескольких одновременных запросов
+        self._state_lock = asyncio.Lock()
+        self.tools = TOOLS
+        self.llm_with_tools = _get_llm_with_tools(AGENT_LLM_MODEL, LLM_TEMPERATURE)
+        self.agent = _get_compiled_graph(AGENT_LLM_MODEL, LLM_TEMPERATURE)
     
-    def _create_agent_graph(self):
-        """Создает и возвращает граф агента с инструментами."""
-        # Создание ToolNode с инструментами
-        tool_node = ToolNode(self.tools)
-        
-        # Создание графа состояния
-        workflow = StateGraph(MessagesState)
-        
-        # Добавление узлов и ребер
-        workflow.add_node("agent", self._call_model)
-        workflow.add_node("tools", tool_node)
-        
-        workflow.set_entry_point("agent")
-        workflow.add_conditional_edges(
-            "agent", 
-            self._should_continue, 
-            {"tools": "tools", "end": END}
-        )
-        workflow.add_edge("tools", "agent")
-        
-        # Компиляция графа
-        return workflow.compile()
-    
-    async def _call_model(self, state: MessagesState):
-        """Вызывает модель с текущими сообщениями."""
-        messages = state["messages"]
-        
-        # Засекаем время выполнения
-        start_time = time.time()
-        
-        # Вызываем модель
-        response = await self.llm_with_tools.ainvoke(messages)
-        
-        # Записываем время выполнения
-        execution_time = time.time() - start_time
-        
-        # Обновляем состояние агента
-        if hasattr(response, "content") and response.content:
-            self.state.add_assistant_message(response.content)
-        
-        # Обрабатываем вызовы инструментов, если они есть
-        if hasattr(response, "tool_calls") and response.tool_calls:
-            for tool_call in response.tool_calls:
-                tool_name = tool_call.get("name", "unknown_tool")
-                tool_args = tool_call.get("args", {})
-                
-                # Регистрируем вызов инструмента
-                self.state.add_tool_call(tool_name, tool_args)
-        
-        return {"messages": [response]}
-    
-    def _should_continue(self, state: MessagesState) -> Literal["tools", "end"]:
-        """Определяет, нужно ли вызывать инструменты или завершить обработку."""
-        messages = state["messages"]
-        last_message = messages[-1]
-        if hasattr(last_message, "tool_calls") and last_message.tool_calls:
-            return "tools"
-        return "end"
+    @staticmethod
+    def _turn_events(new_messages) -> List[TurnEvent]:
+        """Собирает события хода (ответы модели и вызовы инструментов) из новых сообщений графа."""
+        events = []
+        for message in new_messages:
+            if not isinstance(message, AIMessage):
+                continue
+
+            if message.content:
+                events.append(TurnEvent(kind="assistant_message", content=message.content))
+
+            # Регистрируем вызовы инструментов, если они есть
+            for tool_call in message.tool_calls or []:
+                events.append(TurnEvent(
+                    kind="tool_call",
+                    tool_name=tool_call.get("name", "unknown_tool"),
+                    arguments=tool_call.get("args", {})
+                ))
+        return events
+
+    async def _record_turn(self, new_messages) -> None:
+        """Записывает ответы модели и вызовы инструментов в состояние агента."""
+        events = self._turn_events(new_messages)
+        async with self._state_lock:
+            for event in events:
+                self.state.apply(event)
     
+    async def _begin_turn(self, user_input: str) -> List[Dict[str, Any]]:
+        """Добавляет запрос пользователя в историю и возвращает снимок истории для хода."""
+        async with self._state_lock:
+            # Добавляем сообщение пользователя в состояние
+            self.state.add_user_message(user_input)
+
+            # Не даем истории, отправляемой модели на каждом ходе, расти без ограничений
+            await compact_history(self.state, HISTORY_TOKEN_THRESHOLD)
+
+            # Снимок истории в формате для LangChain: во время хода состояние не изменяется,
+            # а объем отправляемой модели истории ограничен окном токенов
+            return self.state.get_windowed_history(HISTORY_WINDOW_TOKENS)
+
     async def process_user_input(self, user_input: str) -> str:
         """Обрабатывает ввод пользователя и возвращает ответ."""
-        # Добавляем сообщение пользователя в состояние
-        self.state.add_user_message(user_input)
-        
-        # Преобразуем историю в формат для LangChain
-        langchain_messages = self.state.get_conversation_history()
+        langchain_messages = await self._begin_turn(user_input)
         
         # Вызываем агента
         result = await self.agent.ainvoke({"messages": langchain_messages})
+
+        # Обновляем состояние агента новыми сообщениями графа
+        await self._record_turn(result["messages"][len(langchain_messages):])
         
         # Получаем последний ответ
         last_message = result["messages"][-1]
@@ -160,6 +292,25 @@ class CryptoAgent:
         
         return response_content
     
+    async def process_user_input_stream(self, user_input: str) -> AsyncIterator[str]:
+        """Обрабатывает ввод пользователя, отдавая текст ответа по мере генерации."""
+        langchain_messages = await self._begin_turn(user_input)
+
+        final_messages = langchain_messages
+        async for mode, payload in self.agent.astream(
+            {"messages": langchain_messages}, stream_mode=["messages", "values"]
+        ):
+            if mode == "values":
+                final_messages = payload["messages"]
+                continue
+
+            chunk, _ = payload
+            if isinstance(chunk, AIMessageChunk) and chunk.content:
+                yield chunk.content
+
+        # Обновляем состояние агента новыми сообщениями графа
+        await self._record_turn(final_messages[len(langchain_messages):])
+    
     def get_state(self) -> AgentState:
         """Возвращает текущее состояние агента."""
         return self.state
@@ -168,24 +319,51 @@ class CryptoAgent:
         """Сбрасывает состояние агента."""
         self.state = AgentState()
         
-    async def perform_deep_research(self, token_symbol: str) -> str:
+    async def perform_deep_research(self, token_symbol: str,
+                                    on_progress: Optional["ProgressCallback"] = None) -> str:
         """
         Выполняет глубокое исследование токена.
         
         Args:
             token_symbol: Символ токена для исследования
+            on_progress: Необязательный колбэк прогресса по этапам
             
         Returns:
             Строка с отчетом о результатах исследования
         """
-        research_manager = DeepResearchManager(llm_model=LLM_MODEL)
-        result = await research_manager.conduct_research(self.state, token_symbol)
+        from .deep_research import DeepResearchManager
+
+        research_manager = DeepResearchManager(llm_model=RESEARCH_LLM_MODEL)
+        result = await research_manager.conduct_research(self.state, token_symbol, on_progress)
         
         # Добавляем результат исследования в историю сообщений
         self.state.add_assistant_message(result)
         
         return result
 
+    async def perform_deep_research_stream(self, token_symbol: str,
+                                           on_progress: Optional["ProgressCallback"] = None) -> AsyncIterator[str]:
+        """
+        Выполняет глубокое исследование токена, отдавая отчет по частям.
+        
+        Args:
+            token_symbol: Символ токена для исследования
+            on_progress: Необязательный колбэк прогресса по этапам
+            
+        Yields:
+            Фрагменты отчета о результатах исследования
+        """
+        from .deep_research import DeepResearchManager
+
+        research_manager = DeepResearchManager(llm_model=RESEARCH_LLM_MODEL)
+        chunks = []
+        async for chunk in research_manager.conduct_research_stream(self.state, token_symbol, on_progress):
+            chunks.append(chunk)
+            yield chunk
+        
+        # Добавляем полный отчет в историю сообщений после завершения генерации
+        self.state.add_assistant_message("".join(chunks))
+
 
 # Функция для создания экземпляра агента
 def create_agent() -> CryptoAgent:
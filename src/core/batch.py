@@ -0,0 +1,99 @@
+"""Отложенное выполнение запросов к модели через OpenAI Batch API (вдвое дешевле, ответ - до 24 часов)."""
+
+import asyncio
+import functools
+from typing import Any, Dict, List, Optional
+
+import orjson
+from openai import AsyncOpenAI
+
+from config.settings import LLM_MODEL
+from core.llm import SHARED_HTTPX
+
+
+# Статусы пакета, после которых результаты уже не изменятся
+_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+@functools.lru_cache(maxsize=1)
+def _client() -> AsyncOpenAI:
+    """Клиент OpenAI на общем пуле соединений."""
+    return AsyncOpenAI(http_client=SHARED_HTTPX)
+
+
+async def submit_batch(requests: List[Dict[str, Any]], model: str = LLM_MODEL) -> str:
+    """
+    Отправляет запросы к модели одним пакетом.
+
+    Args:
+        requests: Запросы вида {"custom_id": ..., "messages": [...]}
+        model: Модель для всех запросов пакета
+
+    Returns:
+        ID созданного пакета
+    """
+    lines = [
+        orjson.dumps({
+            "custom_id": request["custom_id"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": model, "messages": request["messages"]}
+        })
+        for request in requests
+    ]
+
+    client = _client()
+    input_file = await client.files.create(file=("batch.jsonl", b"\n".join(lines)), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    return batch.id
+
+
+async def get_batch_results(batch_id: str) -> Dict[str, Any]:
+    """
+    Проверяет состояние пакета и забирает результаты, если он выполнен.
+
+    Returns:
+        Словарь со статусом пакета и ответами по custom_id (только для выполненного пакета)
+    """
+    client = _client()
+    batch = await client.batches.retrieve(batch_id)
+    info: Dict[str, Any] = {"batch_id": batch_id, "status": batch.status, "results": {}}
+    if batch.status != "completed" or not batch.output_file_id:
+        return info
+
+    content = await client.files.content(batch.output_file_id)
+    for line in content.text.splitlines():
+        if not line:
+            continue
+        record = orjson.loads(line)
+        response = record.get("response") or {}
+        if response.get("status_code") == 200:
+            info["results"][record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        else:
+            info["results"][record["custom_id"]] = f"Ошибка: {record.get('error') or response}"
+    return info
+
+
+async def wait_for_batch(batch_id: str, poll_interval_s: float = 30, timeout_s: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Ждет завершения пакета, периодически опрашивая его статус.
+
+    Args:
+        batch_id: ID пакета
+        poll_interval_s: Интервал опроса в секундах
+        timeout_s: Максимальное время ожидания (None - без ограничения)
+
+    Returns:
+        Результат get_batch_results для завершенного (или еще выполняющегося по таймауту) пакета
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout_s is None else loop.time() + timeout_s
+    while True:
+        info = await get_batch_results(batch_id)
+        if info["status"] in _FINAL_STATUSES or (deadline is not None and loop.time() >= deadline):
+            return info
+        await asyncio.sleep(poll_interval_s)
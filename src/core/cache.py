@@ -0,0 +1,172 @@
+"""Простой асинхронный кэш с ограниченным временем жизни записей."""
+
+import asyncio
+import functools
+import inspect
+import time
+import weakref
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+import orjson
+
+# Маркер отсутствующего значения (None - допустимое значение для кэширования)
+_MISSING = object()
+
+
+class TTLCache:
+    """In-process кэш результатов корутин с TTL и защитой от одновременных промахов."""
+
+    # Все созданные кэши, чтобы фоновая очистка могла пройти по ним
+    _instances: "weakref.WeakSet[TTLCache]" = weakref.WeakSet()
+
+    def __init__(self, ttl_s: int = 300, maxsize: Optional[int] = None):
+        """
+        Инициализация кэша.
+
+        Args:
+            ttl_s: Время жизни записи в секундах
+            maxsize: Максимальное число записей (при переполнении вытесняется самая старая)
+        """
+        self.ttl_s = ttl_s
+        self.maxsize = maxsize
+        self._data: Dict[Hashable, Tuple[float, Any]] = {}
+        self._inflight = RequestCoalescer()
+        # Счетчики попаданий и промахов для статистики
+        self.hits = 0
+        self.misses = 0
+        TTLCache._instances.add(self)
+
+    def _get(self, key: Hashable) -> Any:
+        """Возвращает значение по ключу или _MISSING, если записи нет или она устарела."""
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return _MISSING
+        return value
+
+    async def get_or_set(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Возвращает значение из кэша или вычисляет его через factory и сохраняет.
+
+        Args:
+            key: Ключ записи
+            factory: Функция без аргументов, возвращающая корутину со значением
+
+        Returns:
+            Закэшированное или только что полученное значение
+        """
+        value = self._get(key)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+
+        # Одновременные промахи по одному ключу ждут первый запрос, а не дублируют его
+        # (объединитель учитывает event loop: сессии Streamlit работают в разных loop)
+        computed = False
+
+        async def load() -> Any:
+            nonlocal computed
+            computed = True
+            loaded = await factory()
+            self.set(key, loaded)
+            return loaded
+
+        value = await self._inflight.call(key, load)
+        if computed:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Возвращает значение из кэша или default, учитывая попадание или промах."""
+        value = self._get(key)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Сохраняет значение в кэш."""
+        if self.maxsize is not None and key not in self._data and len(self._data) >= self.maxsize:
+            # dict хранит порядок вставки: первая запись - самая старая
+            del self._data[next(iter(self._data))]
+        self._data[key] = (time.monotonic() + self.ttl_s, value)
+
+    def sweep(self) -> int:
+        """Удаляет устаревшие записи и возвращает их число."""
+        now = time.monotonic()
+        expired = [key for key, (expires_at, _) in self._data.items() if expires_at < now]
+        for key in expired:
+            del self._data[key]
+        return len(expired)
+
+    def clear(self) -> None:
+        """Очищает кэш."""
+        self._data.clear()
+
+
+async def sweep_caches_periodically(interval_s: float = 60) -> None:
+    """Фоновая задача: периодически удаляет устаревшие записи из всех TTL-кэшей процесса."""
+    while True:
+        await asyncio.sleep(interval_s)
+        for cache in list(TTLCache._instances):
+            cache.sweep()
+
+
+class RequestCoalescer:
+    """Объединяет одновременные одинаковые запросы: все вызовы с одним ключом ждут один результат."""
+
+    def __init__(self):
+        """Инициализация реестра выполняющихся запросов."""
+        # Ключ - пара (event loop, ключ запроса): future нельзя ожидать из другого loop
+        self._inflight: Dict[Tuple[asyncio.AbstractEventLoop, Hashable], asyncio.Future] = {}
+
+    async def call(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполняет запрос через factory или присоединяется к уже выполняющемуся с тем же ключом.
+
+        Args:
+            key: Ключ запроса
+            factory: Функция без аргументов, возвращающая корутину с результатом
+
+        Returns:
+            Результат запроса
+        """
+        inflight_key = (asyncio.get_running_loop(), key)
+        future = self._inflight.get(inflight_key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._inflight[inflight_key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(inflight_key, None))
+
+        # Отмена одного из ожидающих не должна отменять общий запрос
+        return await asyncio.shield(future)
+
+
+def single_flight(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """
+    Декоратор корутины: одновременные вызовы с одинаковыми аргументами выполняются один раз.
+
+    Например, если два агента параллельно запрашивают одни и те же данные, внешний API
+    вызывается один раз, а оба получают общий результат.
+    """
+    coalescer = RequestCoalescer()
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        # Ключ не зависит от того, переданы ли аргументы позиционно или по умолчанию;
+        # аргументы инструментов - JSON-совместимые значения (в том числе списки)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = orjson.dumps(bound.arguments, option=orjson.OPT_SORT_KEYS, default=str)
+        return await coalescer.call(key, lambda: func(*args, **kwargs))
+
+    return wrapper
@@ -1,15 +1,28 @@
 """Модуль для проведения глубокого исследования криптовалютных проектов."""
 
 import asyncio
+import functools
+import inspect
+import logging
+import re
 import time
-from typing import Dict, List, Any, Optional, Tuple
+from contextlib import contextmanager
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Any, Literal, Optional, Tuple
 from datetime import datetime, timedelta, timezone
-from pydantic import BaseModel
+import orjson
+from pydantic import BaseModel, ConfigDict, Field
 
-from langchain_openai import ChatOpenAI
-from rich.console import Console
+from langchain_core.utils.json import parse_partial_json
 from rich import print as rprint
 
+from config.settings import (
+    COINGECKO_MAX_CONCURRENCY,
+    LLAMAFEED_MAX_CONCURRENCY,
+    BITQUERY_MAX_CONCURRENCY,
+    ROUTER_LLM_MODEL,
+    RESEARCH_PROGRESS_UI,
+    RESEARCH_PROMPT_TOKEN_BUDGET
+)
 from models.state import AgentState, Message, MessageRole
 from tools import (
     # Базовые инструменты
@@ -34,6 +47,211 @@ from tools import (
     get_project_raises,
     get_market_summary
 )
+from tools._http import get_session
+from core.llm import make_llm
+from core.retry import with_retry
+from core.tokens import CHARS_PER_TOKEN, count_tokens, get_encoding
+
+logger = logging.getLogger(__name__)
+
+# Колбэк прогресса исследования: (этап, событие "start" | "done")
+ProgressCallback = Callable[[str, str], None]
+
+# Инструменты, доступные менеджеру исследований
+_ALL_TOOLS = [
+    get_token_price,
+    get_trending_coins,
+    search_cryptocurrencies,
+    analyze_protocol,
+    analyze_pools_geckoterminal,
+    get_token_historical_data,
+    analyze_token_holders,
+    get_crypto_price,
+    get_klines_history,
+    get_market_info,
+    get_crypto_news,
+    get_crypto_tweets,
+    get_crypto_hacks,
+    get_token_unlocks,
+    get_project_raises,
+    get_market_summary,
+]
+
+
+def _signature_param_names(tool_func) -> List[str]:
+    """Возвращает имена параметров функции, обернутой инструментом LangChain."""
+    # У асинхронных инструментов функция хранится в coroutine, а func равен None
+    func = getattr(tool_func, "func", None) or getattr(tool_func, "coroutine", None)
+    return list(inspect.signature(func).parameters.keys())
+
+
+# Имена параметров (по имени инструмента) вычисляются один раз, а не через inspect.signature при каждом вызове
+_TOOL_PARAM_NAMES: Dict[str, List[str]] = {t.name: _signature_param_names(t) for t in _ALL_TOOLS}
+
+
+def _classify_tool(tool_func) -> Tuple[str, str]:
+    """Определяет способ вызова инструмента ("ainvoke" | "coro" | "sync") и его имя для логов."""
+    if hasattr(tool_func, "ainvoke"):
+        kind = "ainvoke"
+    elif asyncio.iscoroutinefunction(tool_func):
+        kind = "coro"
+    else:
+        kind = "sync"
+    return kind, getattr(tool_func, "name", str(tool_func))
+
+
+# Способ вызова и имя известных инструментов определяются один раз. Ключ - id объекта,
+# так как инструменты LangChain нехешируемы, а сами объекты живут все время работы процесса
+_TOOL_INFO: Dict[int, Tuple[str, str]] = {id(t): _classify_tool(t) for t in _ALL_TOOLS}
+
+# Регулярные выражения для разбора ответов LLM компилируются один раз
+_TOKEN_SYM_RE = re.compile(r'\b[A-Z]{2,10}\b')
+# Признаки того, что пользователь сам указал горизонт исследования и профиль риска
+_HORIZON_RE = re.compile(r'\d+\s*(дн|день|недел|месяц|год|day|week|month|year)', re.IGNORECASE)
+_RISK_RE = re.compile(r'риск|risk|консерватив|агрессив|умерен|conservative|aggressive|moderate', re.IGNORECASE)
+
+# Минимальный прирост (в символах) аргументов отчета между разборами частичного JSON при стриминге
+_STREAM_PARSE_STEP = 256
+
+# Шаблоны промптов: фиксированный текст задается один раз, подставляются только переменные части
+_ANALYSIS_TEMPLATE = """
+        Ты - опытный криптоаналитик. Проанализируй следующие данные о токене {token_symbol} и создай комплексный отчет.
+
+        ПАРАМЕТРЫ ИССЛЕДОВАНИЯ:
+        - Токен: {token_name} ({token_symbol})
+        - Временной горизонт: {days} дней
+        - Профиль риска: {risk}
+
+        СОБРАННЫЕ ДАННЫЕ:
+        {data_summary}
+
+        Создай структурированный отчет, включающий:
+
+        1. РЕЗЮМЕ: Краткое резюме о токене и его текущем положении (3-4 предложения)
+
+        2. ЦЕНОВОЙ АНАЛИЗ:
+           - Текущая цена и изменение за анализируемый период
+           - Ключевые уровни поддержки и сопротивления
+           - Волатильность и сравнение с рынком в целом
+
+        3. ТЕХНИЧЕСКИЙ АНАЛИЗ:
+           - Тренды (краткосрочные, среднесрочные)
+           - Объемы торгов и их динамика
+           - Корреляция с другими активами (если данные доступны)
+
+        4. РЫНОЧНЫЙ АНАЛИЗ:
+           - Рыночная капитализация и позиция среди конкурентов
+           - Ликвидность и глубина рынка
+           - Присутствие на основных биржах и объемы
+
+        5. АНАЛИЗ СОЦИАЛЬНЫХ СИГНАЛОВ:
+           - Активность в социальных сетях
+           - Настроения сообщества
+           - Последние важные новости и их влияние
+
+        6. ОЦЕНКА РИСКОВ:
+           - Технические риски (безопасность, централизация)
+           - Рыночные риски (конкуренция, ликвидность)
+           - Регуляторные риски
+
+        7. РЕКОМЕНДАЦИЯ:
+           - Четкая рекомендация: ПОКУПАТЬ / ДЕРЖАТЬ / ПРОДАВАТЬ
+           - Обоснование рекомендации с учетом профиля риска: {risk}
+           - Возможные сценарии развития (оптимистичный, нейтральный, пессимистичный)
+
+        Формат: Заполни поля структурированного ответа:
+        - full_report_markdown: полный отчет в виде хорошо структурированного Markdown с заголовками
+          и подзаголовками. Включи эмодзи для улучшения читаемости.
+        - summary: краткое резюме из пункта 1
+        - recommendation: итоговая рекомендация - ровно одно из ПОКУПАТЬ / ДЕРЖАТЬ / ПРОДАВАТЬ
+        """
+
+_PREPARATION_TEMPLATE = """
+        Пользователь хочет провести глубокое исследование криптовалюты {token_symbol}.
+
+        1. clarification_questions: 3-5 уточняющих вопросов, которые помогут лучше понять его цели
+           и интересы относительно этого токена:
+           - Цель исследования (инвестиции, трейдинг, общее понимание)
+           - Временной горизонт интереса
+           - Аспекты, которые наиболее важны (технология, экономика токена, команда и т.д.)
+           - Профиль риска
+           Не задавай вопросы, ответы на которые уже есть в диалоге.
+
+        2. parsed_params: параметры исследования, извлеченные из диалога:
+           - token_symbol: символ токена (например, BTC, ETH)
+           - token_name: полное название токена (если указано)
+           - token_id: идентификатор токена в CoinGecko (если указано)
+           - token_address: адрес смарт-контракта токена (если указано)
+           - chain: блокчейн, на котором запущен токен (по умолчанию "ethereum")
+           - days_lookback: на сколько дней назад смотреть исторические данные (по умолчанию 30)
+           - risk_profile: профиль риска пользователя ("low", "moderate", "high") (по умолчанию "moderate")
+
+        Диалог:
+        {conversation}
+        """
+
+_PRECHECK_TEMPLATE = """
+        Пользователь хочет провести исследование криптовалюты {token_symbol}.
+        Определи, указал ли он в своих сообщениях временной горизонт и профиль риска.
+        Если указал - заполни params (token_symbol, token_name, token_id, token_address, chain,
+        days_lookback, risk_profile: "low" | "moderate" | "high") и верни needs_clarification=false.
+        Иначе верни needs_clarification=true.
+
+        Сообщения пользователя:
+        {user_messages}
+        """
+
+
+@functools.lru_cache(maxsize=1)
+def _analysis_template_tokens() -> int:
+    """Число токенов в фиксированной части шаблона анализа (считается один раз)."""
+    return count_tokens(_ANALYSIS_TEMPLATE)
+
+
+def _guess_token_symbol(conversation_history: List[Dict[str, str]]) -> str:
+    """Ищет символ токена в сообщениях пользователя (по умолчанию BTC)."""
+    for msg in conversation_history:
+        if msg['role'] == 'user':
+            tokens = _TOKEN_SYM_RE.findall(msg['content'].upper())
+            if tokens:
+                return tokens[0]
+    return "BTC"
+
+
+def _serialize_section(value: Any) -> str:
+    """Сериализует данные секции: строки как есть, остальное - в компактный JSON вместо repr."""
+    if isinstance(value, str):
+        return value
+    return orjson.dumps(
+        value,
+        option=orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC,
+        default=str
+    ).decode()
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Детерминированно обрезает текст до max_tokens токенов."""
+    # Заведомо лишний хвост отбрасываем до токенизации, чтобы не кодировать мегабайты
+    max_chars = max_tokens * CHARS_PER_TOKEN * 2
+    if len(text) > max_chars:
+        text = text[:max_chars]
+        truncated = True
+    else:
+        truncated = False
+
+    encoding = get_encoding()
+    if encoding is None:
+        if len(text) > max_tokens * CHARS_PER_TOKEN:
+            text = text[:max_tokens * CHARS_PER_TOKEN]
+            truncated = True
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) > max_tokens:
+            text = encoding.decode(tokens[:max_tokens])
+            truncated = True
+
+    return text + "\n...[данные сокращены]" if truncated else text
+
 
 class ResearchParams(BaseModel):
     """Параметры для проведения исследования."""
@@ -59,196 +277,283 @@ class ResearchResult(BaseModel):
     full_report: str = ""  
     timestamp: datetime = datetime.now()
 
-    class Config:
-        arbitrary_types_allowed = True
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+class ResearchReport(BaseModel):
+    """Структурированный отчет об исследовании токена."""
+    full_report_markdown: str = Field(description="Полный отчет в формате Markdown")
+    summary: str = Field(description="Краткое резюме о токене (3-4 предложения)")
+    recommendation: Literal["ПОКУПАТЬ", "ДЕРЖАТЬ", "ПРОДАВАТЬ"] = Field(description="Итоговая рекомендация")
+
+class ResearchPrecheck(BaseModel):
+    """Решение о том, достаточно ли в диалоге данных для начала исследования."""
+    needs_clarification: bool = Field(
+        description="True, если в диалоге не указаны временной горизонт или профиль риска"
+    )
+    params: Optional[ResearchParams] = Field(
+        default=None,
+        description="Параметры исследования, если уточнение не требуется"
+    )
+
+class ResearchPreparation(BaseModel):
+    """Уточняющие вопросы и параметры исследования, извлеченные из диалога."""
+    clarification_questions: List[str] = Field(
+        default_factory=list,
+        description="Уточняющие вопросы пользователю, каждый отдельной строкой, без нумерации"
+    )
+    parsed_params: ResearchParams = Field(description="Параметры исследования")
 
 class DeepResearchManager:
     """Менеджер для проведения глубокого исследования токенов."""
 
-    def __init__(self, llm_model: str = "gpt-4"):
+    def __init__(self, llm_model: str = "gpt-4o"):
         """Инициализация менеджера исследований."""
-        self.llm = ChatOpenAI(model=llm_model, temperature=0)
-        self.console = Console()
-
-    async def get_clarification_questions(self, token_symbol: str) -> List[str]:
-        """Генерирует уточняющие вопросы для проведения исследования."""
-        prompt = f"""
-        Я хочу провести глубокое исследование криптовалюты {token_symbol}.
-        Какие 3-5 уточняющих вопроса ты бы задал, чтобы лучше понять мои цели
-        и интересы относительно этого токена?
-
-        Вопросы должны помочь определить:
-        1. Цель исследования (инвестиции, трейдинг, общее понимание)
-        2. Временной горизонт интереса
-        3. Аспекты, которые наиболее важны для меня (технология, экономика токена, команда и т.д.)
-        4. Мой профиль риска
-
-        Верни только список вопросов, каждый с новой строки, без нумерации.
-        """
+        self.llm = make_llm(0, llm_model)
+        # Отчет запрашивается как вызов функции ResearchReport - поля приходят уже разобранными
+        self._structured_llm = self.llm.with_structured_output(ResearchReport, method="function_calling")
+        self._report_llm = self.llm.bind_tools([ResearchReport], tool_choice="ResearchReport")
+        self._preparation_llm = self.llm.with_structured_output(ResearchPreparation, method="function_calling")
+        # Решение о необходимости уточнений - маршрутизация, для нее достаточно легкой модели
+        self._precheck_llm = make_llm(0, ROUTER_LLM_MODEL).with_structured_output(
+            ResearchPrecheck, method="function_calling"
+        )
+        self._console = None
+
+        # Ограничиваем параллельные запросы к каждому API, чтобы не упираться в rate limit
+        self._semaphores = {
+            "coingecko": asyncio.Semaphore(COINGECKO_MAX_CONCURRENCY),
+            "llamafeed": asyncio.Semaphore(LLAMAFEED_MAX_CONCURRENCY),
+            "bitquery": asyncio.Semaphore(BITQUERY_MAX_CONCURRENCY),
+        }
+
+    @property
+    def console(self):
+        """Консоль rich для спиннера прогресса (создается только при первом использовании)."""
+        if self._console is None:
+            from rich.console import Console
+            self._console = Console()
+        return self._console
+
+    @contextmanager
+    def _phase(self, phase: str, message: str, token_symbol: str,
+               on_progress: Optional[ProgressCallback] = None) -> Iterator[None]:
+        """Сообщает о начале и завершении этапа исследования (лог, колбэк и, по флагу, спиннер)."""
+        logger.info("%s_start token=%s", phase, token_symbol)
+        if on_progress:
+            on_progress(phase, "start")
+        started = time.perf_counter()
+
+        # Спиннер rich перерисовывает терминал из фонового потока - нужен только в интерактивном CLI
+        if RESEARCH_PROGRESS_UI:
+            with self.console.status(f"[bold green]{message}", spinner="dots"):
+                yield
+        else:
+            yield
 
-        response = await self.llm.ainvoke([{"role": "user", "content": prompt}])
-        questions = [q.strip() for q in response.content.split('\n') if q.strip()]
-        return questions
+        logger.info("%s_done token=%s elapsed=%.2fs", phase, token_symbol, time.perf_counter() - started)
+        if on_progress:
+            on_progress(phase, "done")
 
-    async def parse_user_requirements(self, conversation_history: List[Dict[str, str]]) -> ResearchParams:
-        """Анализирует ответы пользователя для определения параметров исследования."""
-        prompt = f"""
-        На основе следующего диалога с пользователем, определи параметры для исследования
-        криптовалютного токена. Извлеки следующую информацию:
-
-        1. token_symbol: символ токена (например, BTC, ETH)
-        2. token_name: полное название токена (если указано)
-        3. token_id: идентификатор токена в CoinGecko (если указано)
-        4. token_address: адрес смарт-контракта токена (если указано)
-        5. chain: блокчейн, на котором запущен токен (по умолчанию "ethereum")
-        6. days_lookback: на сколько дней назад смотреть исторические данные (по умолчанию 30)
-        7. risk_profile: профиль риска пользователя ("low", "moderate", "high") (по умолчанию "moderate")
+    async def _guarded(self, host: str, coro_factory):
+        """Выполняет запрос под семафором соответствующего API, повторяя его при временных ошибках."""
+        # Повторы выполняются внутри семафора, чтобы не увеличивать число одновременных запросов
+        async with self._semaphores[host]:
+            return await with_retry(coro_factory)
 
-        Диалог:
-        {conversation_history}
-
-        Ответ предоставь в виде JSON без лишних комментариев.
+    async def precheck_requirements(self, token_symbol: str,
+                                    conversation_history: List[Dict[str, str]]) -> Optional[ResearchParams]:
         """
+        Проверяет, содержит ли диалог все параметры исследования, без уточняющих вопросов.
 
-        conversation_formatted = "\n".join([
-            f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
-            for msg in conversation_history
-        ])
-
-        response = await self.llm.ainvoke([
-            {"role": "user", "content": prompt.replace("{conversation_history}", conversation_formatted)}
-        ])
+        Returns:
+            Параметры исследования или None, если нужны уточнения (или проверка не удалась)
+        """
+        user_text = "\n".join(msg["content"] for msg in conversation_history if msg["role"] == "user")
 
-        # Извлекаем JSON из ответа
-        import json
-        import re
-
-        json_match = re.search(r'\{.*\}', response.content, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(0)
-            params_dict = json.loads(json_str)
-            return ResearchParams(**params_dict)
-
-        # Если не удалось извлечь JSON, используем базовые параметры
-        # Извлекаем символ токена из диалога
-        token_symbol = None
-        for msg in conversation_history:
-            if msg['role'] == 'user':
-                # Ищем символы токенов в сообщении пользователя
-                tokens = re.findall(r'\b[A-Z]{2,10}\b', msg['content'].upper())
-                if tokens:
-                    token_symbol = tokens[0]
-                    break
-
-        return ResearchParams(token_symbol=token_symbol or "BTC")
+        # Дешевая проверка: без упоминания горизонта и риска уточнения нужны наверняка
+        if not (_HORIZON_RE.search(user_text) and _RISK_RE.search(user_text)):
+            return None
 
-    async def gather_research_data(self, params: ResearchParams) -> Dict[str, Any]:
-        """Собирает данные из всех доступных источников параллельно."""
-        results = {}
+        prompt = _PRECHECK_TEMPLATE.format(token_symbol=token_symbol, user_messages=user_text)
 
-        # Базовая информация
         try:
-            results["basic_info"] = await search_cryptocurrencies.ainvoke(params.token_symbol)
+            precheck = await self._precheck_llm.ainvoke([{"role": "user", "content": prompt}])
         except Exception as e:
-            rprint(f"[bold red]Ошибка при поиске базовой информации: {str(e)}[/bold red]")
-            results["basic_info"] = f"Не удалось получить базовую информацию о {params.token_symbol}"
+            # При ошибке разбора возвращаемся к обычному сценарию с уточняющими вопросами
+            rprint(f"[dim]Не удалось проверить параметры исследования: {str(e)}[/dim]")
+            return None
 
-        try:
-            results["price"] = await get_token_price.ainvoke(params.token_symbol)
-        except Exception as e:
-            rprint(f"[bold red]Ошибка при получении цены: {str(e)}[/bold red]")
-            results["price"] = "Не удалось получить текущую цену"
+        if precheck is None or precheck.needs_clarification or precheck.params is None:
+            return None
+        return precheck.params
 
-        # Исторические данные
-        try:
-            results["historical_data"] = await get_token_historical_data.ainvoke({
-                "token_id": params.token_id or params.token_symbol.lower(),
-                "token_label": params.token_name or params.token_symbol,
-                "vs_currency": "usd",
-                "days": str(params.days_lookback)
-            })
-        except Exception as e:
-            rprint(f"[bold red]Ошибка при получении исторических данных: {str(e)}[/bold red]")
-            results["historical_data"] = "Не удалось получить исторические данные"
+    async def prepare_research(self, token_symbol: str,
+                               conversation_history: List[Dict[str, str]]) -> ResearchPreparation:
+        """
+        Одним вызовом LLM формирует уточняющие вопросы и извлекает параметры исследования из диалога.
 
-        # Новости и социальные данные - передаем словари с правильными ключами
-        try:
-            results["news"] = await get_crypto_news.ainvoke({"days": params.days_lookback})
-        except Exception as e:
-            rprint(f"[bold red]Ошибка при получении новостей: {str(e)}[/bold red]")
-            results["news"] = "Не удалось получить новости"
+        Args:
+            token_symbol: Символ токена для исследования (может быть пустым)
+            conversation_history: История диалога с пользователем
 
-        try:
-            results["tweets"] = await get_crypto_tweets.ainvoke({"days": params.days_lookback})
-        except Exception as e:
-            rprint(f"[bold red]Ошибка при получении твитов: {str(e)}[/bold red]")
-            results["tweets"] = "Не удалось получить твиты"
+        Returns:
+            Уточняющие вопросы и параметры исследования
+        """
+        conversation_formatted = "\n".join([
+            f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
+            for msg in conversation_history
+        ])
 
-        # Трендовые монеты
-        try:
-            results["trending"] = await get_trending_coins.ainvoke({"limit": 10, "include_platform": True})
-        except Exception as e:
-            rprint(f"[bold red]Ошибка при получении трендовых монет: {str(e)}[/bold red]")
-            results["trending"] = "Не удалось получить информацию о трендовых монетах"
+        prompt = _PREPARATION_TEMPLATE.format(
+            token_symbol=token_symbol or "(не указана)",
+            conversation=conversation_formatted
+        )
 
-        # Рыночный обзор
         try:
-            results["market_summary"] = await get_market_summary.ainvoke({"days": params.days_lookback})
+            preparation = await self._preparation_llm.ainvoke([{"role": "user", "content": prompt}])
+            if preparation is not None:
+                return preparation
         except Exception as e:
-            rprint(f"[bold red]Ошибка при получении обзора рынка: {str(e)}[/bold red]")
-            results["market_summary"] = "Не удалось получить обзор рынка"
+            rprint(f"[bold red]Ошибка при разборе параметров исследования: {str(e)}[/bold red]")
 
-        # Дополнительные данные
-        try:
-            results["hacks"] = await get_crypto_hacks.ainvoke({"days": params.days_lookback})
-        except Exception as e:
-            rprint(f"[bold red]Ошибка при получении данных о хаках: {str(e)}[/bold red]")
-            results["hacks"] = "Не удалось получить информацию о хаках"
+        # Если структурированный ответ не получен, используем базовые параметры
+        return ResearchPreparation(
+            clarification_questions=[],
+            parsed_params=ResearchParams(token_symbol=token_symbol or _guess_token_symbol(conversation_history))
+        )
 
-        try:
-            results["unlocks"] = await get_token_unlocks.ainvoke({"days": params.days_lookback})
-        except Exception as e:
-            rprint(f"[bold red]Ошибка при получении данных о разблокировках: {str(e)}[/bold red]")
-            results["unlocks"] = "Не удалось получить информацию о разблокировках токенов"
+    async def parse_user_requirements(self, conversation_history: List[Dict[str, str]]) -> ResearchParams:
+        """Анализирует ответы пользователя для определения параметров исследования."""
+        preparation = await self.prepare_research(_guess_token_symbol(conversation_history), conversation_history)
+        return preparation.parsed_params
 
-        try:
-            results["raises"] = await get_project_raises.ainvoke({"days": params.days_lookback})
-        except Exception as e:
-            rprint(f"[bold red]Ошибка при получении данных о финансировании: {str(e)}[/bold red]")
-            results["raises"] = "Не удалось получить информацию о привлечении средств"
+    async def gather_research_data(self, params: ResearchParams) -> Dict[str, Any]:
+        """Собирает данные из всех доступных источников параллельно."""
+        token_label = params.token_name or params.token_symbol
+
+        # Все запросы независимы друг от друга, поэтому запускаем их одновременно.
+        # Ключ -> (API, фабрика корутины, контекст ошибки для лога, значение при ошибке).
+        # Фабрика, а не корутина: при повторе запроса нужна новая корутина
+        requests = {
+            # Базовая информация
+            "basic_info": (
+                "coingecko",
+                lambda: search_cryptocurrencies.ainvoke(params.token_symbol),
+                "поиске базовой информации",
+                f"Не удалось получить базовую информацию о {params.token_symbol}"
+            ),
+            "price": (
+                "coingecko",
+                lambda: get_token_price.ainvoke(params.token_symbol),
+                "получении цены",
+                "Не удалось получить текущую цену"
+            ),
+            # Исторические данные
+            "historical_data": (
+                "coingecko",
+                lambda: get_token_historical_data.ainvoke({
+                    "token_id": params.token_id or params.token_symbol.lower(),
+                    "token_label": token_label,
+                    "vs_currency": "usd",
+                    "days": str(params.days_lookback)
+                }),
+                "получении исторических данных",
+                "Не удалось получить исторические данные"
+            ),
+            # Новости и социальные данные - передаем словари с правильными ключами
+            "news": (
+                "llamafeed",
+                lambda: get_crypto_news.ainvoke({"days": params.days_lookback}),
+                "получении новостей",
+                "Не удалось получить новости"
+            ),
+            "tweets": (
+                "llamafeed",
+                lambda: get_crypto_tweets.ainvoke({"days": params.days_lookback}),
+                "получении твитов",
+                "Не удалось получить твиты"
+            ),
+            # Трендовые монеты
+            "trending": (
+                "coingecko",
+                lambda: get_trending_coins.ainvoke({"limit": 10, "include_platform": True}),
+                "получении трендовых монет",
+                "Не удалось получить информацию о трендовых монетах"
+            ),
+            # Рыночный обзор
+            "market_summary": (
+                "llamafeed",
+                lambda: get_market_summary.ainvoke({"days": params.days_lookback}),
+                "получении обзора рынка",
+                "Не удалось получить обзор рынка"
+            ),
+            # Дополнительные данные
+            "hacks": (
+                "llamafeed",
+                lambda: get_crypto_hacks.ainvoke({"days": params.days_lookback}),
+                "получении данных о хаках",
+                "Не удалось получить информацию о хаках"
+            ),
+            "unlocks": (
+                "llamafeed",
+                lambda: get_token_unlocks.ainvoke({"days": params.days_lookback}),
+                "получении данных о разблокировках",
+                "Не удалось получить информацию о разблокировках токенов"
+            ),
+            "raises": (
+                "llamafeed",
+                lambda: get_project_raises.ainvoke({"days": params.days_lookback}),
+                "получении данных о финансировании",
+                "Не удалось получить информацию о привлечении средств"
+            ),
+        }
 
         # Если есть token_address, анализируем держателей
         if params.token_address:
-            try:
-                results["holders"] = await analyze_token_holders.ainvoke({
+            requests["holders"] = (
+                "bitquery",
+                lambda: analyze_token_holders.ainvoke({
                     "token_address": params.token_address,
-                    "token_label": params.token_name or params.token_symbol,
+                    "token_label": token_label,
                     "chain": params.chain
-                })
-            except Exception as e:
-                rprint(f"[bold red]Ошибка при анализе держателей: {str(e)}[/bold red]")
-                results["holders"] = "Не удалось получить информацию о держателях токена"
+                }),
+                "анализе держателей",
+                "Не удалось получить информацию о держателях токена"
+            )
+
+        # return_exceptions=True: ошибка одного источника не отменяет остальные запросы
+        responses = await asyncio.gather(
+            *(self._guarded(host, factory) for host, factory, _, _ in requests.values()),
+            return_exceptions=True
+        )
+
+        results = {}
+        for (key, (_, _, error_context, fallback)), response in zip(requests.items(), responses):
+            if isinstance(response, Exception):
+                rprint(f"[bold red]Ошибка при {error_context}: {str(response)}[/bold red]")
+                results[key] = fallback
+            else:
+                results[key] = response
 
         return results
 
     async def _execute_tool(self, tool_func, *args, result_key=None):
         """Выполняет инструмент и возвращает результат с ключом."""
-        try:
-            # Получаем имя инструмента для логирования
-            tool_name = getattr(tool_func, "name", str(tool_func))
+        # Способ вызова и имя инструмента для логирования (для незарегистрированных - определяем на месте)
+        kind, tool_name = _TOOL_INFO.get(id(tool_func)) or _classify_tool(tool_func)
 
+        try:
             # Правильный способ вызова LangChain инструментов
-            if hasattr(tool_func, "ainvoke"):
+            if kind == "ainvoke":
                 # Для LangChain инструментов мы должны передать аргументы по-другому
                 # ainvoke ожидает один аргумент (строку) или словарь параметров
                 if len(args) == 1:  # Если только один аргумент - передаем его напрямую
                     result = await tool_func.ainvoke(args[0])
                 else:
                     # Создаем словарь из имен параметров функции и переданных значений
-                    # Получаем имена параметров из сигнатуры функции
-                    import inspect
-                    sig = inspect.signature(tool_func.func)
-                    params = list(sig.parameters.keys())
+                    params = _TOOL_PARAM_NAMES.get(tool_name)
+                    if params is None:
+                        params = _TOOL_PARAM_NAMES.setdefault(tool_name, _signature_param_names(tool_func))
 
                     # Создаем словарь параметров
                     kwargs = {}
@@ -257,7 +562,7 @@ class DeepResearchManager:
                             kwargs[params[i]] = arg
 
                     result = await tool_func.ainvoke(kwargs)
-            elif asyncio.iscoroutinefunction(tool_func):
+            elif kind == "coro":
                 # Для обычных асинхронных функций
                 result = await tool_func(*args)
             else:
@@ -266,123 +571,131 @@ class DeepResearchManager:
 
             return (result_key, result) if result_key else result
         except Exception as e:
-            import traceback
             error_msg = f"Ошибка при выполнении {tool_name}: {str(e)}"
             rprint(f"[bold red]{error_msg}[/bold red]")
             # rprint(traceback.format_exc())  # Раскомментировать для отладки
             return (result_key, f"Ошибка: {str(e)}") if result_key else str(e)
 
-    async def analyze_research_data(self, params: ResearchParams, data: Dict[str, Any]) -> ResearchResult:
-        """Анализирует собранные данные и формирует результаты исследования."""
-        # Подготавливаем данные для анализа LLM
-        data_summary = ""
+    def _build_analysis_prompt(self, params: ResearchParams, data: Dict[str, Any]) -> str:
+        """Формирует промпт для анализа собранных данных."""
+        # Подготавливаем данные для анализа LLM (части собираются в список и склеиваются один раз)
+        parts: List[str] = []
+        # Бюджет токенов за вычетом фиксированной части шаблона делится поровну между секциями,
+        # чтобы промпт помещался в контекст модели
+        data_budget = max(RESEARCH_PROMPT_TOKEN_BUDGET - _analysis_template_tokens(), 0)
+        section_budget = data_budget // max(len(data), 1)
 
         for key, value in data.items():
-            data_summary += f"=== {key.upper()} ===\n"
-            # Проверяем, строка ли это
-            if isinstance(value, str):
-                data_summary += value + "\n\n"
-            else:
-                # Для других типов данных преобразуем в строку
-                data_summary += str(value) + "\n\n"
-
-        prompt = f"""
-        Ты - опытный криптоаналитик. Проанализируй следующие данные о токене {params.token_symbol} и создай комплексный отчет.
-
-        ПАРАМЕТРЫ ИССЛЕДОВАНИЯ:
-        - Токен: {params.token_name or params.token_symbol} ({params.token_symbol})
-        - Временной горизонт: {params.days_lookback} дней
-        - Профиль риска: {params.risk_profile}
-
-        СОБРАННЫЕ ДАННЫЕ:
-        {data_summary}
-
-        Создай структурированный отчет, включающий:
-
-        1. РЕЗЮМЕ: Краткое резюме о токене и его текущем положении (3-4 предложения)
-
-        2. ЦЕНОВОЙ АНАЛИЗ:
-           - Текущая цена и изменение за анализируемый период
-           - Ключевые уровни поддержки и сопротивления
-           - Волатильность и сравнение с рынком в целом
-
-        3. ТЕХНИЧЕСКИЙ АНАЛИЗ:
-           - Тренды (краткосрочные, среднесрочные)
-           - Объемы торгов и их динамика
-           - Корреляция с другими активами (если данные доступны)
+            text = _truncate_to_tokens(_serialize_section(value), section_budget)
 
-        4. РЫНОЧНЫЙ АНАЛИЗ:
-           - Рыночная капитализация и позиция среди конкурентов
-           - Ликвидность и глубина рынка
-           - Присутствие на основных биржах и объемы
-
-        5. АНАЛИЗ СОЦИАЛЬНЫХ СИГНАЛОВ:
-           - Активность в социальных сетях
-           - Настроения сообщества
-           - Последние важные новости и их влияние
-
-        6. ОЦЕНКА РИСКОВ:
-           - Технические риски (безопасность, централизация)
-           - Рыночные риски (конкуренция, ликвидность)
-           - Регуляторные риски
+            parts.append(f"=== {key.upper()} ===\n")
+            parts.append(text)
+            parts.append("\n\n")
 
-        7. РЕКОМЕНДАЦИЯ:
-           - Четкая рекомендация: ПОКУПАТЬ / ДЕРЖАТЬ / ПРОДАВАТЬ
-           - Обоснование рекомендации с учетом профиля риска: {params.risk_profile}
-           - Возможные сценарии развития (оптимистичный, нейтральный, пессимистичный)
+        data_summary = "".join(parts)
 
-        Формат: Предоставь ответ в виде хорошо структурированного Markdown с заголовками и подзаголовками.
-        Включи эмодзи для улучшения читаемости.
-        """
+        return _ANALYSIS_TEMPLATE.format(
+            token_symbol=params.token_symbol,
+            token_name=params.token_name or params.token_symbol,
+            days=params.days_lookback,
+            risk=params.risk_profile,
+            data_summary=data_summary
+        )
 
-        response = await self.llm.ainvoke([{"role": "user", "content": prompt}])
 
-        # Создаем объект результата
-        result = ResearchResult(
+    async def analyze_research_data_stream(self, params: ResearchParams, data: Dict[str, Any]) -> AsyncIterator[str]:
+        """Анализирует собранные данные, отдавая текст отчета по мере генерации."""
+        prompt = self._build_analysis_prompt(params, data)
+
+        # Отчет приходит внутри аргументов вызова ResearchReport: разбираем частичный JSON
+        # и отдаем прирост поля full_report_markdown. Разбор выполняется не на каждом чанке,
+        # чтобы не перепарсивать растущую строку целиком.
+        args_parts: List[str] = []
+        pending = 0
+        emitted = 0
+
+        async for chunk in self._report_llm.astream([{"role": "user", "content": prompt}]):
+            for tool_chunk in chunk.tool_call_chunks:
+                if tool_chunk.get("args"):
+                    args_parts.append(tool_chunk["args"])
+                    pending += len(tool_chunk["args"])
+
+            if pending >= _STREAM_PARSE_STEP:
+                pending = 0
+                report = self._partial_report("".join(args_parts))
+                if len(report) > emitted:
+                    yield report[emitted:]
+                    emitted = len(report)
+
+        report = self._partial_report("".join(args_parts))
+        if len(report) > emitted:
+            yield report[emitted:]
+
+    @staticmethod
+    def _partial_report(args_json: str) -> str:
+        """Извлекает текущий текст отчета из частично сгенерированного JSON аргументов."""
+        partial = parse_partial_json(args_json) if args_json else None
+        if not isinstance(partial, dict):
+            return ""
+        return partial.get("full_report_markdown") or ""
+
+    def _build_research_result(self, params: ResearchParams, report: ResearchReport) -> ResearchResult:
+        """Формирует результат исследования из структурированного ответа модели."""
+        return ResearchResult(
             token_symbol=params.token_symbol,
             token_name=params.token_name or params.token_symbol,
-            summary="",  # Будет заполнено из отчета
+            summary=report.summary,
             price_data={},
             technical_analysis={},
             market_data={},
             social_signals={},
             risk_assessment={},
-            recommendation="",
+            recommendation=report.recommendation,
+            full_report=report.full_report_markdown,
             timestamp=datetime.now()
         )
 
-        # Устанавливаем полный отчет
-        result.full_report = response.content
-
-        # Извлекаем рекомендацию
-        if "ПОКУПАТЬ" in response.content:
-            result.recommendation = "ПОКУПАТЬ"
-        elif "ПРОДАВАТЬ" in response.content:
-            result.recommendation = "ПРОДАВАТЬ"
-        else:
-            result.recommendation = "ДЕРЖАТЬ"
-
-        # Извлекаем резюме (первый параграф после заголовка РЕЗЮМЕ)
-        import re
-        summary_match = re.search(r'РЕЗЮМЕ[:\s]*\n+(.*?)(?=\n*#)', response.content, re.DOTALL)
-        if summary_match:
-            result.summary = summary_match.group(1).strip()
-
-        return result
+    async def analyze_research_data(self, params: ResearchParams, data: Dict[str, Any]) -> ResearchResult:
+        """Анализирует собранные данные и формирует результаты исследования."""
+        prompt = self._build_analysis_prompt(params, data)
+        report = await self._structured_llm.ainvoke([{"role": "user", "content": prompt}])
+        return self._build_research_result(params, report)
 
-    async def conduct_research(self, user_state: AgentState, token_symbol: str) -> str:
+    async def _prepare_research(self, user_state: AgentState, token_symbol: str,
+                                on_progress: Optional[ProgressCallback] = None) -> Tuple[ResearchParams, Dict[str, Any]]:
         """
-        Проводит полное исследование токена с уточняющими вопросами и анализом.
+        Выполняет подготовительные шаги исследования: уточняющие вопросы, параметры и сбор данных.
 
         Args:
             user_state: Текущее состояние диалога с пользователем
             token_symbol: Символ токена для исследования
+            on_progress: Необязательный колбэк прогресса по этапам
 
         Returns:
-            Строка с отчетом о результатах исследования
+            Кортеж (параметры исследования, собранные данные)
         """
-        # Шаг 1: Генерация уточняющих вопросов
-        questions = await self.get_clarification_questions(token_symbol)
+        with self._phase("prepare", f"Определяю параметры исследования {token_symbol}...", token_symbol, on_progress):
+            # Шаг 0: Если диалог уже содержит все параметры, уточняющие вопросы не нужны
+            params = await self.precheck_requirements(token_symbol, user_state.get_conversation_history())
+            if params is None:
+                params = await self._clarify_requirements(user_state, token_symbol)
+            params.token_symbol = token_symbol  # Уточняем символ токена
+
+        # Шаг 3: Сбор данных из всех источников
+        # Открываем общую HTTP-сессию заранее, чтобы параллельные запросы использовали один пул соединений
+        await get_session()
+        with self._phase("gather", f"Собираю данные о {token_symbol}...", token_symbol, on_progress):
+            research_data = await self.gather_research_data(params)
+
+        return params, research_data
+
+    async def _clarify_requirements(self, user_state: AgentState, token_symbol: str) -> ResearchParams:
+        """Формирует уточняющие вопросы и извлекает параметры исследования из диалога."""
+        # Шаг 1: Уточняющие вопросы и параметры исследования - одним вызовом LLM
+        preparation = await self.prepare_research(token_symbol, user_state.get_conversation_history())
+        questions = preparation.clarification_questions
+        if not questions:
+            return preparation.parsed_params
 
         # Формируем сообщение с вопросами
         clarification_message = f"""
@@ -393,26 +706,54 @@ class DeepResearchManager:
         Пожалуйста, ответьте на эти вопросы для более точного анализа.
         """
 
-        # Добавляем сообщение в историю диалога
+        # Добавляем сообщение в историю диалога, чтобы интерфейс мог показать вопросы
         user_state.add_assistant_message(clarification_message)
 
-        # На данном этапе пользователь должен ответить на вопросы в интерфейсе
-        # После получения ответа, мы извлекаем параметры для исследования
+        return preparation.parsed_params
 
-        # Получаем историю диалога
-        conversation_history = user_state.get_conversation_history()
+    async def conduct_research(self, user_state: AgentState, token_symbol: str,
+                               on_progress: Optional[ProgressCallback] = None) -> str:
+        """
+        Проводит полное исследование токена с уточняющими вопросами и анализом.
 
-        # Шаг 2: Парсинг требований пользователя
-        params = await self.parse_user_requirements(conversation_history)
-        params.token_symbol = token_symbol  # Уточняем символ токена
+        Args:
+            user_state: Текущее состояние диалога с пользователем
+            token_symbol: Символ токена для исследования
+            on_progress: Необязательный колбэк прогресса по этапам
 
-        # Шаг 3: Сбор данных из всех источников
-        with self.console.status(f"[bold green]Собираю данные о {token_symbol}...", spinner="dots"):
-            research_data = await self.gather_research_data(params)
+        Returns:
+            Строка с отчетом о результатах исследования
+        """
+        params, research_data = await self._prepare_research(user_state, token_symbol, on_progress)
 
         # Шаг 4: Анализ данных и формирование отчета
-        with self.console.status(f"[bold green]Анализирую данные и формирую отчет...", spinner="dots"):
+        with self._phase("analyze", "Анализирую данные и формирую отчет...", token_symbol, on_progress):
             research_result = await self.analyze_research_data(params, research_data)
 
         # Возвращаем отчет
         return research_result.full_report
+
+    async def conduct_research_stream(self, user_state: AgentState, token_symbol: str,
+                                      on_progress: Optional[ProgressCallback] = None) -> AsyncIterator[str]:
+        """
+        Проводит исследование токена, отдавая текст отчета по частям по мере генерации.
+
+        Args:
+            user_state: Текущее состояние диалога с пользователем
+            token_symbol: Символ токена для исследования
+            on_progress: Необязательный колбэк прогресса по этапам
+
+        Yields:
+            Фрагменты отчета о результатах исследования
+        """
+        params, research_data = await self._prepare_research(user_state, token_symbol, on_progress)
+
+        # Шаг 4: Отчет отдается вызывающему коду по мере генерации (без спиннера - текст виден сразу)
+        logger.info("analyze_start token=%s", token_symbol)
+        if on_progress:
+            on_progress("analyze", "start")
+        async for chunk in self.analyze_research_data_stream(params, research_data):
+            yield chunk
+        logger.info("analyze_done token=%s", token_symbol)
+        if on_progress:
+            on_progress("analyze", "done")
@@ -0,0 +1,51 @@
+"""Диспетчер вызовов внешнего API: ограничение параллельности и частоты запросов."""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Optional
+
+from langchain_core.rate_limiters import InMemoryRateLimiter
+
+
+class Dispatcher:
+    """Пропускает вызовы одного провайдера не более max_workers одновременно и не чаще заданной частоты."""
+
+    def __init__(self, max_workers: int, requests_per_second: float = 0):
+        """
+        Инициализация диспетчера.
+
+        Args:
+            max_workers: Максимальное число одновременных вызовов
+            requests_per_second: Лимит запросов в секунду (token bucket; 0 - без ограничения)
+        """
+        self.max_workers = max_workers
+        self._limiter = (
+            InMemoryRateLimiter(
+                requests_per_second=requests_per_second,
+                check_every_n_seconds=0.05,
+                max_bucket_size=max(1.0, requests_per_second)
+            )
+            if requests_per_second > 0 else None
+        )
+        # Семафор привязан к event loop, поэтому создается заново для каждого loop
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def submit(self, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполняет вызов с учетом ограничений.
+
+        Args:
+            factory: Функция без аргументов, возвращающая корутину вызова
+
+        Returns:
+            Результат вызова
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+            self._loop = loop
+
+        async with self._semaphore:
+            if self._limiter is not None:
+                await self._limiter.aacquire()
+            return await factory()
@@ -0,0 +1,221 @@
+"""Общие клиенты моделей OpenAI на едином пуле соединений."""
+
+import asyncio
+import functools
+import hashlib
+import importlib.util
+import statistics
+import time
+import weakref
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Tuple
+
+import httpx
+import orjson
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from langchain_openai import ChatOpenAI
+
+from config.settings import LLM_CACHE_TTL, LLM_MODEL, LLM_REQUESTS_PER_SECOND, LLM_TELEMETRY_SIZE
+from core.cache import TTLCache
+
+
+class _LoopLocalTransport(httpx.AsyncBaseTransport):
+    """
+    Транспорт httpx с отдельным пулом соединений для каждого event loop.
+
+    Соединения привязаны к loop, в котором открыты, поэтому у каждого loop (например, у каждой
+    сессии Streamlit) свой пул; после сборки loop его запись удаляется автоматически.
+    """
+
+    def __init__(self):
+        self._transports: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncHTTPTransport]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def _current(self) -> httpx.AsyncHTTPTransport:
+        """Возвращает пул соединений текущего event loop (создается при первом запросе)."""
+        loop = asyncio.get_running_loop()
+        transport = self._transports.get(loop)
+        if transport is None:
+            # С пакетом h2 (httpx[http2]) параллельные запросы мультиплексируются в одном соединении HTTP/2
+            transport = httpx.AsyncHTTPTransport(
+                http2=importlib.util.find_spec("h2") is not None,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+            )
+            self._transports[loop] = transport
+        return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._current().handle_async_request(request)
+
+    async def aclose_current(self) -> None:
+        """Закрывает пул соединений текущего event loop."""
+        transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+    async def aclose(self) -> None:
+        await self.aclose_current()
+
+
+_TRANSPORT = _LoopLocalTransport()
+
+# Общий клиент OpenAI для всех агентов: TCP + TLS устанавливаются один раз на event loop,
+# а не отдельно для каждого клиента модели. Сам клиент не хранит соединений, поэтому
+# его (и созданные на нем ChatOpenAI из make_llm) можно использовать из любого loop
+SHARED_HTTPX = httpx.AsyncClient(
+    transport=_TRANSPORT,
+    timeout=httpx.Timeout(60.0, connect=5.0)
+)
+
+
+# Общий для всех клиентов модели лимит запросов в секунду (token bucket): при всплеске
+# параллельных агентов запросы выравниваются, а не упираются в 429 от OpenAI
+RATE_LIMITER = (
+    InMemoryRateLimiter(
+        requests_per_second=LLM_REQUESTS_PER_SECOND,
+        check_every_n_seconds=0.05,
+        max_bucket_size=max(1.0, LLM_REQUESTS_PER_SECOND)
+    )
+    if LLM_REQUESTS_PER_SECOND > 0 else None
+)
+
+
+@functools.lru_cache(maxsize=8)
+def make_llm(temperature: float, model: str = LLM_MODEL) -> ChatOpenAI:
+    """Возвращает клиент модели на общем пуле соединений (один на набор параметров)."""
+    return ChatOpenAI(
+        model=model,
+        temperature=temperature,
+        http_async_client=SHARED_HTTPX,
+        rate_limiter=RATE_LIMITER,
+        # Потоковые ответы тоже возвращают число токенов (для телеметрии)
+        stream_usage=True
+    )
+
+
+async def warm_up_llm_connection() -> None:
+    """
+    Заранее открывает соединение с OpenAI в общем пуле (TCP + TLS + HTTP/2).
+
+    Используется легкий запрос списка моделей, который не расходует токены;
+    ошибки игнорируются - первый настоящий запрос просто установит соединение сам.
+    """
+    try:
+        await make_llm(0.2).root_async_client.models.list()
+    except Exception:
+        pass
+
+
+async def close_llm_client() -> None:
+    """Закрывает пул соединений с OpenAI текущего event loop (вызывается при завершении приложения)."""
+    # SHARED_HTTPX не закрывается: им продолжают пользоваться другие loop
+    await _TRANSPORT.aclose_current()
+
+
+# Телеметрия последних вызовов модели: (время, задержка в нс, входные токены, выходные токены, из кэша).
+# Буфер ограничен, поэтому статистика считается за O(LLM_TELEMETRY_SIZE), а не по всей истории
+LLM_TELEMETRY: Deque[Tuple[float, int, int, int, bool]] = deque(maxlen=LLM_TELEMETRY_SIZE)
+
+
+def record_llm_call(started_ns: int, message: Any, cache_hit: bool = False) -> None:
+    """
+    Записывает вызов модели в буфер телеметрии.
+
+    Args:
+        started_ns: Момент начала вызова (time.perf_counter_ns())
+        message: Ответ модели (AIMessage с usage_metadata)
+        cache_hit: Ответ взят из кэша без обращения к модели
+    """
+    usage = getattr(message, "usage_metadata", None) or {}
+    LLM_TELEMETRY.append((
+        time.time(),
+        time.perf_counter_ns() - started_ns,
+        usage.get("input_tokens", 0),
+        usage.get("output_tokens", 0),
+        cache_hit
+    ))
+
+
+def telemetry_summary() -> Dict[str, Any]:
+    """Сводка по буферу телеметрии: число вызовов, средняя и p95 задержка, токены, попадания в кэш."""
+    if not LLM_TELEMETRY:
+        return {}
+
+    latencies = [record[1] for record in LLM_TELEMETRY]
+    p95 = statistics.quantiles(latencies, n=20, method="inclusive")[-1] if len(latencies) > 1 else latencies[0]
+    return {
+        "calls": len(latencies),
+        "mean_latency_s": statistics.fmean(latencies) / 1e9,
+        "p95_latency_s": p95 / 1e9,
+        "tokens_in": sum(record[2] for record in LLM_TELEMETRY),
+        "tokens_out": sum(record[3] for record in LLM_TELEMETRY),
+        "cache_hits": sum(record[4] for record in LLM_TELEMETRY)
+    }
+
+
+def _request_key(llm: ChatOpenAI, messages: List[Dict[str, Any]]) -> str:
+    """Ключ кэша ответа: модель, температура и сообщения запроса."""
+    return hashlib.sha256(orjson.dumps(
+        {"model": llm.model_name, "temperature": llm.temperature, "messages": messages},
+        option=orjson.OPT_SORT_KEYS
+    )).hexdigest()
+
+
+# Ответы модели на одинаковые промпты (например, форматирование тех же результатов задач)
+LLM_RESPONSE_CACHE = TTLCache(ttl_s=LLM_CACHE_TTL, maxsize=512)
+
+
+async def cached_ainvoke(llm: ChatOpenAI, messages: List[Dict[str, Any]]) -> Any:
+    """
+    Вызывает модель, возвращая сохраненный ответ для уже встречавшегося запроса.
+
+    Args:
+        llm: Клиент модели
+        messages: Сообщения в формате {"role": ..., "content": ...}
+
+    Returns:
+        Ответ модели (из кэша или только что полученный)
+    """
+    key = _request_key(llm, messages)
+    started = time.perf_counter_ns()
+    fetched = False
+
+    async def fetch():
+        nonlocal fetched
+        fetched = True
+        return await llm.ainvoke(messages)
+
+    response = await LLM_RESPONSE_CACHE.get_or_set(key, fetch)
+    record_llm_call(started, response, cache_hit=not fetched)
+    return response
+
+
+async def cached_astream(llm: ChatOpenAI, messages: List[Dict[str, Any]]) -> AsyncIterator[str]:
+    """
+    Отдает текст ответа модели по мере генерации; для уже встречавшегося запроса - сразу из кэша.
+
+    Args:
+        llm: Клиент модели
+        messages: Сообщения в формате {"role": ..., "content": ...}
+
+    Yields:
+        Фрагменты текста ответа
+    """
+    key = _request_key(llm, messages)
+    started = time.perf_counter_ns()
+    cached = LLM_RESPONSE_CACHE.get(key)
+    if cached is not None:
+        record_llm_call(started, cached, cache_hit=True)
+        yield cached.content
+        return
+
+    # Ответ попадает в кэш только если поток дочитан до конца
+    message = None
+    async for chunk in llm.astream(messages):
+        message = chunk if message is None else message + chunk
+        if chunk.content:
+            yield chunk.content
+    if message is not None:
+        record_llm_call(started, message)
+        LLM_RESPONSE_CACHE.set(key, message)
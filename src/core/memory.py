@@ -0,0 +1,41 @@
+"""Память диалога агента: старшая часть истории заменяется кратким содержанием."""
+
+from config.settings import SUMMARY_LLM_MODEL
+from models.state import AgentState
+from .llm import make_llm
+from .tokens import count_tokens
+
+
+# Краткое содержание обязано сохранить факты, которые пользователь не станет повторять
+_SUMMARY_PROMPT = (
+    "Кратко перескажи диалог, сохранив упомянутые токены, цифры, адреса кошельков и контрактов, "
+    "предпочтения пользователя, решения и открытые вопросы."
+)
+
+
+async def compact_history(state: AgentState, threshold_tokens: int, keep: int = 0) -> bool:
+    """
+    Заменяет старшую половину истории кратким содержанием, если история превышает порог токенов.
+
+    Args:
+        state: Состояние агента
+        threshold_tokens: Порог токенов истории, после которого она сжимается
+        keep: Число первых сообщений, которые сохраняются как есть (например, системный промпт)
+
+    Returns:
+        True, если история была сжата
+    """
+    history = state.get_conversation_history()[keep:]
+    if len(history) < 2:
+        return False
+    if sum(count_tokens(msg["content"]) for msg in history) <= threshold_tokens:
+        return False
+
+    oldest = history[:len(history) // 2]
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in oldest)
+    response = await make_llm(0, SUMMARY_LLM_MODEL).ainvoke([
+        {"role": "system", "content": _SUMMARY_PROMPT},
+        {"role": "user", "content": transcript}
+    ])
+    state.summarize_oldest(len(oldest), f"Краткое содержание предыдущего диалога: {response.content}", keep=keep)
+    return True
@@ -1,18 +1,30 @@
 """Мультиагентная система для анализа криптовалют."""
 
-import json
+import functools
+import hashlib
+from itertools import islice
+import logging
+import re
+import sys
 import time
 import uuid
-from typing import Literal, Dict, Any, List, Optional, Tuple, Union
+from typing import AsyncIterator, Literal, Dict, Any, List, Optional, Tuple, Union
 import asyncio
+from dataclasses import dataclass, field
 from enum import Enum
+import orjson
 from pydantic import BaseModel, Field
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.tools import StructuredTool
 from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, MessagesState, START, END
 from langgraph.prebuilt import ToolNode
 
-from config.settings import LLM_MODEL, LLM_TEMPERATURE
-from models.state import AgentState, MessageRole, Message, ToolCall, ToolResult
+from config.settings import FORMATTER_LLM_MODEL, HISTORY_TOKEN_THRESHOLD, HISTORY_WINDOW_TOKENS, LLM_MODEL, LLM_TEMPERATURE, MAX_CONCURRENT_LLM, REPORT_RESULT_MAX_CHARS
+from core.cache import RequestCoalescer
+from core.llm import LLM_TELEMETRY, close_llm_client, make_llm, record_llm_call
+from core.memory import compact_history
+from models.state import AgentState, MessageRole, Message, ToolCall, ToolResult, TurnEvent
 from models.tool_schemas import ToolType
 from datetime import datetime
 from typing import Any, Dict, List, Optional
@@ -21,12 +33,16 @@ from uuid import uuid4
 # Импорт инструментов
 from tools import (
     get_token_price,
+    get_token_prices,
     get_trending_coins,
     search_cryptocurrencies,
     analyze_protocol,
+    analyze_protocols_bulk,
     analyze_pools_geckoterminal,
     get_token_historical_data,
+    analyze_tokens_bulk,
     analyze_token_holders,
+    analyze_holders_bulk,
     get_crypto_price,
     get_klines_history,
     execute_trade,
@@ -39,10 +55,227 @@ from tools import (
     get_token_unlocks,
     get_project_raises,
     get_polymarket_data,
+    get_llamafeed_bundle,
     get_market_summary
 )
 
 
+logger = logging.getLogger(__name__)
+
+
+class _ToolSet:
+    """Набор инструментов агента, хэшируемый по идентичности инструментов (StructuredTool не хэшируется)."""
+
+    def __init__(self, tools: List[Any]):
+        self.tools = tuple(tools)
+        self._key = tuple(id(tool) for tool in self.tools)
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _ToolSet) and self._key == other._key
+
+    @property
+    def module_level(self) -> bool:
+        """Все инструменты определены на уровне модуля (не замыкания на объект системы)."""
+        return all(
+            "<locals>" not in getattr(
+                getattr(tool, "coroutine", None) or getattr(tool, "func", None) or tool, "__qualname__", "<locals>"
+            )
+            for tool in self.tools
+        )
+
+
+def _should_continue(state: MessagesState) -> Literal["tools", "end"]:
+    """Определяет, нужно ли вызывать инструменты или завершить обработку."""
+    messages = state["messages"]
+    last_message = messages[-1]
+    if hasattr(last_message, "tool_calls") and last_message.tool_calls:
+        return "tools"
+    return "end"
+
+
+# Одинаковые запросы к модели от параллельно работающих агентов выполняются один раз
+_LLM_COALESCER = RequestCoalescer()
+
+
+def _llm_request_key(model: str, temperature: float, tool_set: _ToolSet, messages) -> bytes:
+    """Ключ запроса к модели: параметры модели, набор инструментов и содержимое сообщений."""
+    payload = orjson.dumps(
+        [
+            (msg.type, msg.content, getattr(msg, "tool_calls", None), getattr(msg, "tool_call_id", None))
+            for msg in messages
+        ],
+        default=str
+    )
+    return hashlib.blake2b(
+        f"{model}|{temperature}|{hash(tool_set)}|".encode() + payload, digest_size=16
+    ).digest()
+
+
+def _compile_graph(model: str, temperature: float, tool_set: _ToolSet):
+    """
+    Привязывает инструменты к модели и компилирует граф агента.
+
+    Returns:
+        Кортеж (модель с инструментами, скомпилированный граф)
+    """
+    llm_with_tools = make_llm(temperature, model).bind_tools(list(tool_set.tools))
+
+    async def call_model(state: MessagesState):
+        """Вызывает модель с текущими сообщениями."""
+        messages = state["messages"]
+        key = _llm_request_key(model, temperature, tool_set, messages)
+
+        async def invoke():
+            # Телеметрию пишет только выполняющий запрос вызов: присоединившиеся
+            # к нему ожидающие не дублируют его токены и задержку
+            started = time.perf_counter_ns()
+            response = await llm_with_tools.ainvoke(messages)
+            record_llm_call(started, response)
+            return response
+
+        response = await _LLM_COALESCER.call(key, invoke)
+        return {"messages": [response]}
+
+    # Создание графа состояния
+    workflow = StateGraph(MessagesState)
+
+    # Добавление узлов и ребер
+    workflow.add_node("agent", call_model)
+    workflow.add_node("tools", ToolNode(list(tool_set.tools)))
+
+    workflow.set_entry_point("agent")
+    workflow.add_conditional_edges(
+        "agent",
+        _should_continue,
+        {"tools": "tools", "end": END}
+    )
+    workflow.add_edge("tools", "agent")
+
+    # Компиляция графа
+    return llm_with_tools, workflow.compile()
+
+
+# Агенты с одинаковыми моделью и набором инструментов получают один и тот же граф;
+# ключ кэша хранит ссылки на инструменты, поэтому их id не переиспользуются
+_compile_shared_graph = functools.lru_cache(maxsize=64)(_compile_graph)
+
+
+def _build_compiled_graph(model: str, temperature: float, tool_set: _ToolSet):
+    """
+    Возвращает граф агента: общий для наборов из инструментов уровня модуля.
+
+    Инструменты-замыкания (например, plan_tasks супервизора) ссылаются на свою
+    MultiAgentSystem: в кэше уровня модуля они удерживали бы систему со всеми
+    задачами и историями, поэтому такие графы не кэшируются.
+    """
+    if tool_set.module_level:
+        return _compile_shared_graph(model, temperature, tool_set)
+    return _compile_graph(model, temperature, tool_set)
+
+
+# Шаблон промпта итогового отчета: статичные инструкции в начале, данные задач в конце
+_REPORT_TEMPLATE = """
+            # Инструкция по форматированию комплексного криптоаналитического отчета
+
+            Твоя задача - создать хорошо структурированный, комплексный аналитический отчет на основе результатов нескольких исследовательских задач.
+
+            ## Основная структура отчета:
+
+            Твой отчет должен ВСЕГДА содержать следующие разделы:
+
+            1. **📋 СВОДНОЕ РЕЗЮМЕ (EXECUTIVE SUMMARY)** - 3-5 предложений с ключевыми выводами
+            2. **📊 РЫНОЧНЫЙ АНАЛИЗ** - цены, объемы, капитализация, тренды
+            3. **📈 ТЕХНИЧЕСКИЙ АНАЛИЗ** - паттерны, индикаторы, уровни поддержки/сопротивления
+            4. **📰 НОВОСТИ И НАСТРОЕНИЯ** - ключевые новости, социальные сигналы
+            5. **🔍 ФУНДАМЕНТАЛЬНЫЙ АНАЛИЗ** - технология, команда, развитие проекта
+            6. **⚠️ РИСКИ И ВОЗМОЖНОСТИ** - обзор потенциальных рисков и возможностей
+            7. **🔮 ПРОГНОЗ И РЕКОМЕНДАЦИИ** - обоснованное мнение о перспективах
+            8. **📚 ИСТОЧНИКИ ДАННЫХ** - перечисление использованных источников
+
+            ## Принципы форматирования:
+
+            - Используй **жирный шрифт** для выделения важных моментов
+            - Структурируй информацию с использованием заголовков ## и подзаголовков ###
+            - Применяй эмодзи в начале разделов для лучшей визуальной навигации
+            - Используй маркированные списки для перечисления пунктов
+            - Выделяй предупреждения и важные замечания в отдельные блоки
+            - Включай таблицы для сравнительного анализа, где уместно
+            - Каждый вывод должен быть подкреплен данными
+
+            ## Правила обработки данных:
+
+            1. Объедини похожую информацию из разных источников
+            2. При противоречивых данных указывай на расхождения и приводи все версии
+            3. Все числовые данные должны сопровождаться единицами измерения и временными метками
+            4. Все сложные термины должны быть кратко объяснены
+            5. Для всех прогнозов указывай степень уверенности и временной горизонт
+
+            Сформируй ПОЛНЫЙ, комплексный отчет, максимально интегрируя и структурируя всю предоставленную информацию в соответствии с указанными принципами. Каждый раздел отчета должен содержать конкретную и релевантную информацию, даже если для этого нужно сделать обоснованные выводы на основе имеющихся данных.
+
+            ## Заголовок отчета:
+
+            {title}
+
+            ## Результаты исследовательских задач:
+
+            {payload}
+
+            ## Задачи, которые не удалось выполнить (учти это в отчете):
+
+            Невыполненные задачи: {incomplete}
+            Отсутствующие задачи: {missing}
+            """
+
+
+# Промпт форматирования результатов задач для ответа пользователю (CLI и Streamlit).
+# Инструкции - неизменный префикс (одинаковые байты в каждом запросе, провайдер может
+# кэшировать его), запрос и данные дописываются в конец простой конкатенацией
+_FORMAT_PROMPT_PREFIX = """
+# Задача: Форматирование аналитического отчета
+
+Создай хорошо структурированный, профессиональный отчет на основе следующих данных анализа.
+
+## Инструкции по форматированию:
+- Используй заголовки и подзаголовки (##, ###)
+- Выделяй важные цифры и результаты **жирным шрифтом**
+- Используй эмодзи в начале разделов для улучшения восприятия
+- Организуй данные в логические разделы
+- Добавь краткое резюме в начале
+
+Форматируй отчет так, чтобы он был максимально информативным и легко читаемым.
+
+## Исходный запрос:
+"""
+_FORMAT_PROMPT_DATA = "\n\n## Данные анализа:\n"
+
+
+def _results_payload(task_results: Dict[str, Any]) -> str:
+    """Компактный JSON результатов задач; слишком длинные текстовые результаты обрезаются."""
+    bounded = {
+        title: result[:REPORT_RESULT_MAX_CHARS] + "…"
+        if isinstance(result, str) and len(result) > REPORT_RESULT_MAX_CHARS else result
+        for title, result in task_results.items()
+    }
+    return orjson.dumps(bounded, option=orjson.OPT_NON_STR_KEYS, default=str).decode()
+
+
+def build_format_prompt(request: str, task_results: Dict[str, Any]) -> str:
+    """
+    Собирает промпт форматирования результатов задач.
+
+    Args:
+        request: Исходный запрос пользователя
+        task_results: Результаты задач по заголовкам
+
+    Returns:
+        Готовый промпт для модели форматирования
+    """
+    return _FORMAT_PROMPT_PREFIX + request + _FORMAT_PROMPT_DATA + _results_payload(task_results)
+
+
 class AgentRole(str, Enum):
     """Роли агентов в системе."""
     SUPERVISOR = "supervisor"
@@ -54,20 +287,133 @@ class AgentRole(str, Enum):
     CUSTOM = "custom"
 
 
-class Task(BaseModel):
-    """Модель задачи для агентов."""
-    task_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+# Системные промпты стандартных агентов
+_SUPERVISOR_PROMPT = sys.intern("""
+        Ты - супервизорный агент, координирующий работу команды специализированных агентов.
+        ОБЯЗАТЕЛЬНО делегируй задачи следующим агентам в зависимости от запроса:
+
+        1. MARKET_ANALYST - текущие цены и тренды
+        2. TECHNICAL_ANALYST - исторические данные, графики, изменения цен и капитализации за период
+        3. NEWS_RESEARCHER - новости и социальные сигналы
+        4. PROTOCOL_ANALYST - анализ протоколов и холдеров
+
+        КРИТИЧЕСКИ ВАЖНО: Когда запрос касается "исторических данных", "изменений за период"
+        или "анализа капитализации" - ВСЕГДА назначай задачу агенту TECHNICAL_ANALYST с чёткими
+        параметрами: название токена (Bitcoin/Ethereum/др.), период в днях, и что именно
+        анализировать (цену/капитализацию/объем).
+
+        Составляй ВЕСЬ план одним вызовом plan_tasks: перечисли все нужные задачи сразу.
+        Указывай depends_on только если задаче действительно нужен результат другой задачи -
+        независимые задачи выполняются параллельно.
+        """)
+
+_MARKET_ANALYST_PROMPT = sys.intern("""
+        Ты - агент-аналитик рынка. Твоя задача - анализировать текущие цены,
+        тренды и рыночные показатели криптовалют. Используй доступные инструменты
+        для получения и анализа данных о ценах и трендах.
+        Если нужны цены нескольких токенов, запрашивай их одним вызовом get_token_prices.
+        """)
+
+_TECHNICAL_ANALYST_PROMPT = sys.intern("""
+        ы - агент технического анализа. Твоя задача - анализировать исторические данные,
+        графики и технические индикаторы для криптовалют.
+
+        ВАЖНО: Для получения исторических данных о токенах используй инструмент get_token_historical_data
+        с правильными параметрами:
+        - Для Ethereum: token_id="ethereum", token_label="Ethereum"
+        - Для Bitcoin: token_id="bitcoin", token_label="Bitcoin"
+        - Для других токенов: соответствующие идентификаторы
+
+        Когда запрос касается изменения капитализации или цен за определенный период,
+        всегда указывай точный период в днях в параметре days.
+        Если нужны данные нескольких токенов, запрашивай их одним вызовом analyze_tokens_bulk.
+
+        Анализируй полученные данные, выделяя тренды, уровни поддержки и сопротивления,
+        и предоставляй обоснованные прогнозы на основе технических индикаторов.
+        """)
+
+_NEWS_RESEARCHER_PROMPT = sys.intern("""
+        Ты - агент-исследователь новостей. Твоя задача - собирать и анализировать
+        новости, твиты и события, связанные с криптовалютами. Выделяй ключевые события,
+        которые могут влиять на рынок, и оценивай их потенциальное воздействие.
+        Если нужны несколько разделов (новости, твиты, хаки, разблокировки, привлечения средств),
+        запрашивай их одним вызовом get_llamafeed_bundle.
+        """)
+
+_TRADER_PROMPT = sys.intern("""
+        Ты - агент-трейдер. Твоя задача - выполнять торговые операции на основе
+        аналитических данных, предоставленных другими агентами. Учитывай риски,
+        оценивай потенциальную прибыль и контролируй исполнение сделок.
+        """)
+
+_PROTOCOL_ANALYST_PROMPT = sys.intern("""
+        Ты - агент-аналитик протоколов. Твоя задача - анализировать блокчейн-протоколы,
+        пулы ликвидности и данные о холдерах. Выявляй риски, оценивай ликвидность
+        и анализируй показатели здоровья протоколов.
+        Если нужно сравнить несколько протоколов или токенов, используй analyze_protocols_bulk
+        и analyze_holders_bulk вместо нескольких отдельных вызовов.
+        """)
+
+_AGENT_PROMPTS = {
+    AgentRole.SUPERVISOR: _SUPERVISOR_PROMPT,
+    AgentRole.MARKET_ANALYST: _MARKET_ANALYST_PROMPT,
+    AgentRole.TECHNICAL_ANALYST: _TECHNICAL_ANALYST_PROMPT,
+    AgentRole.NEWS_RESEARCHER: _NEWS_RESEARCHER_PROMPT,
+    AgentRole.TRADER: _TRADER_PROMPT,
+    AgentRole.PROTOCOL_ANALYST: _PROTOCOL_ANALYST_PROMPT,
+}
+
+# Готовые системные сообщения стандартных ролей: создаются один раз и разделяются всеми агентами
+_SYSTEM_MESSAGES = {
+    role: Message(role=MessageRole.SYSTEM, content=prompt) for role, prompt in _AGENT_PROMPTS.items()
+}
+
+
+# Быстрая маршрутизация: запросы, однозначно относящиеся к одному специалисту,
+# идут к нему напрямую без хода супервизора
+_FAST_ROUTES = [
+    (re.compile(r'\b(price|цен[аеуыой]\w*|стоимост\w*|курс\w*|тренд\w*|trending)\b', re.IGNORECASE), "market_analyst"),
+    (re.compile(r'\b(истори\w*|klines?|свеч\w*|график\w*|капитализаци\w*)\b|\d+\s*(дн|день|недел|месяц)', re.IGNORECASE), "technical_analyst"),
+    (re.compile(r'\b(news|новост\w*|твит\w*|tweets?|взлом\w*|hacks?|анлок\w*|unlocks?|polymarket)\b', re.IGNORECASE), "news_researcher"),
+    (re.compile(r'\b(протокол\w*|protocols?|пул\w*|pools?|холдер\w*|holders?|tvl)\b', re.IGNORECASE), "protocol_analyst"),
+]
+
+# Торговые запросы всегда идут через супервизора: "купи 0.1 ETH по текущей цене"
+# не должен уйти к аналитику рынка по слову "цене"
+_TRADE_PATTERN = re.compile(
+    r'\b(buy\w*|sell\w*|trade\w*|trading|order\w*|куп\w*|прода\w*|сделк\w*|ордер\w*|торг\w*|трейд\w*)\b', re.IGNORECASE
+)
+
+
+# Одно связанное имя для временных меток задач
+_now = datetime.now
+
+
+@dataclass(slots=True)
+class Task:
+    """Модель задачи для агентов (внутренняя структура, без валидации)."""
     title: str
     description: str
+    task_id: str = field(default_factory=lambda: uuid4().hex)
     assigned_agent_id: Optional[str] = None
     status: str = "pending"  # pending, in_progress, completed, failed
     priority: int = 1
-    created_at: datetime = Field(default_factory=datetime.now)
-    updated_at: datetime = Field(default_factory=datetime.now)
+    created_at: datetime = field(default_factory=_now)
+    updated_at: datetime = field(default_factory=_now)
     result: Optional[Any] = None
     parent_task_id: Optional[str] = None
-    sub_tasks: List[str] = Field(default_factory=list)
-    metadata: Dict[str, Any] = Field(default_factory=dict)
+    sub_tasks: List[str] = field(default_factory=list)
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+
+class PlannedTask(BaseModel):
+    """Шаг плана супервизора: задача для агента и ее зависимости."""
+    step_id: str = Field(description="Уникальный идентификатор шага внутри плана, например 's1'")
+    agent_id: str = Field(description="ID агента-исполнителя")
+    title: str = Field(description="Заголовок задачи")
+    description: str = Field(description="Подробное описание задачи")
+    priority: int = Field(default=1, description="Приоритет задачи (1-5, где 5 - наивысший)")
+    depends_on: List[str] = Field(default_factory=list, description="step_id шагов, результаты которых нужны этой задаче")
 
 
 class MultiAgentSystem:
@@ -79,39 +425,98 @@ class MultiAgentSystem:
         self.tasks = {}
         self.global_state = {}
 
+        # Индекс ожидающих задач в порядке создания (dict как упорядоченное множество):
+        # планировщику не нужно просматривать все накопленные задачи
+        self._pending: Dict[str, None] = {}
+
+        # Версия набора задач: увеличивается при создании задачи и каждой смене статуса,
+        # чтобы интерфейс мог не перерисовывать статистику без изменений
+        self.tasks_version = 0
+
+        # Телеметрия вызовов модели (общий для процесса кольцевой буфер последних вызовов)
+        self.telemetry = LLM_TELEMETRY
+
+        # Глобальный лимит одновременных вызовов LLM и блокировки агентов:
+        # задачи одного агента выполняются по очереди (общая история диалога),
+        # задачи разных агентов - параллельно
+        self._global_sem: Optional[asyncio.Semaphore] = None
+        self._agent_locks: Dict[str, asyncio.Lock] = {}
+        self._guards_loop: Optional[asyncio.AbstractEventLoop] = None
+
         # Создаем супервизорного агента
         self.create_supervisor_agent()
 
         # Создаем набор специализированных агентов
         self.initialize_specialized_agents()
 
+    def _ensure_guards(self) -> None:
+        """Создает семафор и блокировки агентов для текущего event loop."""
+        # Примитивы asyncio привязываются к loop, а Streamlit запускает каждый запрос в новом loop
+        loop = asyncio.get_running_loop()
+        if self._guards_loop is not loop:
+            self._global_sem = asyncio.Semaphore(MAX_CONCURRENT_LLM)
+            self._agent_locks = {}
+            self._guards_loop = loop
+
+    def _add_task(self, task: Task) -> None:
+        """Регистрирует новую задачу и добавляет ее в индекс ожидающих."""
+        self.tasks[task.task_id] = task
+        self._pending[task.task_id] = None
+        self.tasks_version += 1
+
+    def create_task(self, agent_id: str, title: str, description: str, priority: int = 1) -> str:
+        """
+        Создает задачу для агента напрямую, без планирования супервизором.
+
+        Args:
+            agent_id: ID агента-исполнителя
+            title: Заголовок задачи
+            description: Описание задачи (запрос агенту)
+            priority: Приоритет задачи
+
+        Returns:
+            ID созданной задачи
+        """
+        task = Task(title=title, description=description, assigned_agent_id=agent_id, priority=priority)
+        self._add_task(task)
+        return task.task_id
+
+    def create_tasks(self, specs: List[Tuple[str, str, str]]) -> List[str]:
+        """
+        Создает набор задач одним вызовом: сначала проверяются все агенты,
+        затем создаются задачи (либо все, либо ни одной).
+
+        Args:
+            specs: Список (ID агента, заголовок, описание)
+
+        Returns:
+            ID созданных задач в порядке specs
+        """
+        unknown = [agent_id for agent_id, _, _ in specs if agent_id not in self.agents]
+        if unknown:
+            raise ValueError(f"Агенты с ID {', '.join(unknown)} не найдены")
+        return [self.create_task(agent_id, title, description) for agent_id, title, description in specs]
+
+    def _fail_task(self, task: Task, error: str) -> Dict[str, Any]:
+        """Помечает задачу проваленной и убирает ее из индекса ожидающих."""
+        self._pending.pop(task.task_id, None)
+        task.status = "failed"
+        task.result = {"error": error}
+        task.updated_at = _now()
+        self.tasks_version += 1
+        return task.result
+
     def create_supervisor_agent(self):
         """Создает супервизорного агента, координирующего работу других агентов."""
         supervisor_tools = [
-            self._create_delegate_task_tool(),
+            self._create_plan_tasks_tool(),
             self._create_check_task_status_tool(),
             self._create_merge_results_tool()
         ]
 
-        supervisor_system_prompt = """
-        Ты - супервизорный агент, координирующий работу команды специализированных агентов.
-        ОБЯЗАТЕЛЬНО делегируй задачи следующим агентам в зависимости от запроса:
-
-        1. MARKET_ANALYST - текущие цены и тренды
-        2. TECHNICAL_ANALYST - исторические данные, графики, изменения цен и капитализации за период
-        3. NEWS_RESEARCHER - новости и социальные сигналы
-        4. PROTOCOL_ANALYST - анализ протоколов и холдеров
-
-        КРИТИЧЕСКИ ВАЖНО: Когда запрос касается "исторических данных", "изменений за период"
-        или "анализа капитализации" - ВСЕГДА назначай задачу агенту TECHNICAL_ANALYST с чёткими
-        параметрами: название токена (Bitcoin/Ethereum/др.), период в днях, и что именно
-        анализировать (цену/капитализацию/объем).
-        """
-
         supervisor = CryptoAgent(
             agent_id="supervisor",
             role=AgentRole.SUPERVISOR,
-            system_prompt=supervisor_system_prompt,
             tools=supervisor_tools
         )
 
@@ -122,52 +527,29 @@ class MultiAgentSystem:
         # Агент по анализу рынка
         market_analyst_tools = [
             get_token_price,
+            get_token_prices,
             get_trending_coins,
             search_cryptocurrencies,
             get_crypto_price
         ]
 
-        market_analyst_prompt = """
-        Ты - агент-аналитик рынка. Твоя задача - анализировать текущие цены,
-        тренды и рыночные показатели криптовалют. Используй доступные инструменты
-        для получения и анализа данных о ценах и трендах.
-        """
-
         self.agents["market_analyst"] = CryptoAgent(
             agent_id="market_analyst",
             role=AgentRole.MARKET_ANALYST,
-            system_prompt=market_analyst_prompt,
             tools=market_analyst_tools
         )
 
         # Агент технического анализа
         tech_analyst_tools = [
             get_token_historical_data,
+            analyze_tokens_bulk,
             get_klines_history,
             get_market_info
         ]
 
-        tech_analyst_prompt = """
-        ы - агент технического анализа. Твоя задача - анализировать исторические данные,
-        графики и технические индикаторы для криптовалют.
-
-        ВАЖНО: Для получения исторических данных о токенах используй инструмент get_token_historical_data
-        с правильными параметрами:
-        - Для Ethereum: token_id="ethereum", token_label="Ethereum"
-        - Для Bitcoin: token_id="bitcoin", token_label="Bitcoin"
-        - Для других токенов: соответствующие идентификаторы
-
-        Когда запрос касается изменения капитализации или цен за определенный период,
-        всегда указывай точный период в днях в параметре days.
-
-        Анализируй полученные данные, выделяя тренды, уровни поддержки и сопротивления,
-        и предоставляй обоснованные прогнозы на основе технических индикаторов.
-        """
-
         self.agents["technical_analyst"] = CryptoAgent(
             agent_id="technical_analyst",
             role=AgentRole.TECHNICAL_ANALYST,
-            system_prompt=tech_analyst_prompt,
             tools=tech_analyst_tools
         )
 
@@ -179,19 +561,13 @@ class MultiAgentSystem:
             get_token_unlocks,
             get_project_raises,
             get_polymarket_data,
+            get_llamafeed_bundle,
             get_market_summary
         ]
 
-        news_researcher_prompt = """
-        Ты - агент-исследователь новостей. Твоя задача - собирать и анализировать
-        новости, твиты и события, связанные с криптовалютами. Выделяй ключевые события,
-        которые могут влиять на рынок, и оценивай их потенциальное воздействие.
-        """
-
         self.agents["news_researcher"] = CryptoAgent(
             agent_id="news_researcher",
             role=AgentRole.NEWS_RESEARCHER,
-            system_prompt=news_researcher_prompt,
             tools=news_researcher_tools
         )
 
@@ -202,69 +578,68 @@ class MultiAgentSystem:
             get_account_info
         ]
 
-        trader_prompt = """
-        Ты - агент-трейдер. Твоя задача - выполнять торговые операции на основе
-        аналитических данных, предоставленных другими агентами. Учитывай риски,
-        оценивай потенциальную прибыль и контролируй исполнение сделок.
-        """
-
         self.agents["trader"] = CryptoAgent(
             agent_id="trader",
             role=AgentRole.TRADER,
-            system_prompt=trader_prompt,
             tools=trader_tools
         )
 
         # Аналитик протоколов
         protocol_analyst_tools = [
             analyze_protocol,
+            analyze_protocols_bulk,
             analyze_pools_geckoterminal,
-            analyze_token_holders
+            analyze_token_holders,
+            analyze_holders_bulk
         ]
 
-        protocol_analyst_prompt = """
-        Ты - агент-аналитик протоколов. Твоя задача - анализировать блокчейн-протоколы,
-        пулы ликвидности и данные о холдерах. Выявляй риски, оценивай ликвидность
-        и анализируй показатели здоровья протоколов.
-        """
-
         self.agents["protocol_analyst"] = CryptoAgent(
             agent_id="protocol_analyst",
             role=AgentRole.PROTOCOL_ANALYST,
-            system_prompt=protocol_analyst_prompt,
             tools=protocol_analyst_tools
         )
 
-    def _create_delegate_task_tool(self):
-        """Создает инструмент для делегирования задач другим агентам."""
-        def delegate_task(agent_id: str, task_title: str, task_description: str, priority: int = 1) -> str:
+    def _create_plan_tasks_tool(self):
+        """Создает инструмент для планирования набора задач с зависимостями."""
+        def plan_tasks(plan: List[PlannedTask]) -> str:
             """
-            Делегирует задачу указанному агенту.
+            Создает сразу все задачи плана. Независимые задачи выполняются параллельно,
+            задача с depends_on запускается после успешного завершения указанных шагов.
 
             Args:
-                agent_id: ID агента, которому делегируется задача
-                task_title: Заголовок задачи
-                task_description: Описание задачи
-                priority: Приоритет задачи (1-5, где 5 - наивысший)
+                plan: Список шагов плана
 
             Returns:
-                ID созданной задачи
+                Список созданных задач с их ID
             """
-            agent_id = agent_id.lower()
-            if agent_id not in self.agents:
-                return f"Ошибка: агент с ID {agent_id} не найден"
-
-            task = Task(
-                title=task_title,
-                description=task_description,
-                assigned_agent_id=agent_id,
-                priority=priority
-            )
-
-            self.tasks[task.task_id] = task
-            return f"Задача успешно делегирована агенту {agent_id}. ID задачи: {task.task_id}"
-
-        return delegate_task
+            steps = [PlannedTask.model_validate(step) if isinstance(step, dict) else step for step in plan]
+
+            unknown = [step.agent_id for step in steps if step.agent_id.lower() not in self.agents]
+            if unknown:
+                return f"Ошибка: агенты с ID {', '.join(unknown)} не найдены"
+
+            # step_id -> task_id, чтобы хранить зависимости в терминах реальных задач
+            step_to_task = {step.step_id: uuid4().hex for step in steps}
+            missing = {dep for step in steps for dep in step.depends_on if dep not in step_to_task}
+            if missing:
+                return f"Ошибка: неизвестные шаги в depends_on: {', '.join(sorted(missing))}"
+
+            created = []
+            for step in steps:
+                task = Task(
+                    task_id=step_to_task[step.step_id],
+                    title=step.title,
+                    description=step.description,
+                    assigned_agent_id=step.agent_id.lower(),
+                    priority=step.priority,
+                    metadata={"deps": [step_to_task[dep] for dep in step.depends_on]}
+                )
+                self._add_task(task)
+                created.append(f"{step.step_id} -> {task.assigned_agent_id}: {task.task_id}")
+
+            return "План создан. Задачи:\n" + "\n".join(created)
+
+        return plan_tasks
 
     def _create_check_task_status_tool(self):
         """Создает инструмент для проверки статуса задачи."""
@@ -278,10 +653,10 @@ class MultiAgentSystem:
             Returns:
                 Словарь с информацией о задаче
             """
-            if task_id not in self.tasks:
+            task = self.tasks.get(task_id)
+            if task is None:
                 return {"error": f"Задача с ID {task_id} не найдена"}
 
-            task = self.tasks[task_id]
             return {
                 "task_id": task.task_id,
                 "title": task.title,
@@ -292,12 +667,83 @@ class MultiAgentSystem:
 
         return check_task_status
 
+    async def merge_results(self, task_ids: List[str], summary_title: str) -> Dict[str, Any]:
+        """
+        Объединяет результаты указанных задач в структурированный отчет.
+
+        Вызывается инструментом супервизора и напрямую, когда ID задач уже известны.
+
+        Args:
+            task_ids: Список ID задач, результаты которых нужно объединить
+            summary_title: Заголовок итогового отчета
+
+        Returns:
+            Структурированный отчет на основе результатов задач
+        """
+        task_results = {}
+        missing_tasks = []
+        incomplete_tasks = []
+        tasks_info = []
+
+        # Собираем результаты всех задач
+        for task_id in task_ids:
+            task = self.tasks.get(task_id)
+            if task is None:
+                missing_tasks.append(task_id)
+                continue
+
+            tasks_info.append({
+                "task_id": task_id,
+                "title": task.title,
+                "agent_id": task.assigned_agent_id,
+                "status": task.status
+            })
+
+            if task.status != "completed":
+                incomplete_tasks.append(task_id)
+                continue
+
+            task_results[task.title] = task.result
+
+        # Статичная часть шаблона идет первой, чтобы провайдер мог кэшировать префикс промпта
+        payload = _results_payload(task_results)
+        report_prompt = _REPORT_TEMPLATE.format(
+            title=summary_title,
+            payload=payload,
+            incomplete=incomplete_tasks,
+            missing=missing_tasks
+        )
+
+        # Генерируем структурированный отчет с помощью LLM. Потоковый вызов отдает токены
+        # в обработчики графа (stream_mode="messages") по мере генерации
+        try:
+            parts = []
+            report_formatter_llm = make_llm(0.2, FORMATTER_LLM_MODEL)
+            async for chunk in report_formatter_llm.astream([{"role": "user", "content": report_prompt}]):
+                parts.append(chunk.content)
+            structured_report = "".join(parts)
+        except Exception as e:
+            # В случае ошибки просто соединяем результаты с минимальным форматированием
+            structured_report = f"# {summary_title}\n\n"
+            structured_report += "## Результаты выполненных задач\n\n"
+            for title, result in task_results.items():
+                structured_report += f"### {title}\n\n{result}\n\n---\n\n"
+            structured_report += f"\n\n⚠️ Примечание: При формировании отчета произошла ошибка: {str(e)}"
+
+        # Возвращаем структурированный отчет и мета-информацию
+        return {
+            "summary_title": summary_title,
+            "structured_report": structured_report,
+            "raw_results": task_results,
+            "tasks_info": tasks_info,
+            "missing_tasks": missing_tasks,
+            "incomplete_tasks": incomplete_tasks,
+            "timestamp": datetime.now().isoformat()
+        }
+
     def _create_merge_results_tool(self):
         """Создает инструмент для объединения результатов нескольких задач в структурированный отчет."""
 
-        # Создаем LLM для формирования отчета
-        report_formatter_llm = ChatOpenAI(model=LLM_MODEL, temperature=0.2)
-
         async def merge_results(task_ids: List[str], summary_title: str) -> Dict[str, Any]:
             """
             Объединяет результаты указанных задач в структурированный отчет.
@@ -309,122 +755,12 @@ class MultiAgentSystem:
             Returns:
                 Структурированный отчет на основе результатов задач
             """
-            task_results = {}
-            missing_tasks = []
-            incomplete_tasks = []
-            tasks_info = []
-
-            # Собираем результаты всех задач
-            for task_id in task_ids:
-                if task_id not in self.tasks:
-                    missing_tasks.append(task_id)
-                    continue
-
-                task = self.tasks[task_id]
-                tasks_info.append({
-                    "task_id": task_id,
-                    "title": task.title,
-                    "agent_id": task.assigned_agent_id,
-                    "status": task.status
-                })
-
-                if task.status != "completed":
-                    incomplete_tasks.append(task_id)
-                    continue
+            return await self.merge_results(task_ids, summary_title)
 
-                task_results[task.title] = task.result
-
-            # Формируем промпт для создания структурированного отчета
-            report_prompt = f"""
-            # Инструкция по форматированию комплексного криптоаналитического отчета
-
-            Твоя задача - создать хорошо структурированный, комплексный аналитический отчет на основе результатов нескольких исследовательских задач.
-
-            ## Основная структура отчета:
-
-            Твой отчет должен ВСЕГДА содержать следующие разделы:
-
-            1. **📋 СВОДНОЕ РЕЗЮМЕ (EXECUTIVE SUMMARY)** - 3-5 предложений с ключевыми выводами
-            2. **📊 РЫНОЧНЫЙ АНАЛИЗ** - цены, объемы, капитализация, тренды
-            3. **📈 ТЕХНИЧЕСКИЙ АНАЛИЗ** - паттерны, индикаторы, уровни поддержки/сопротивления
-            4. **📰 НОВОСТИ И НАСТРОЕНИЯ** - ключевые новости, социальные сигналы
-            5. **🔍 ФУНДАМЕНТАЛЬНЫЙ АНАЛИЗ** - технология, команда, развитие проекта
-            6. **⚠️ РИСКИ И ВОЗМОЖНОСТИ** - обзор потенциальных рисков и возможностей
-            7. **🔮 ПРОГНОЗ И РЕКОМЕНДАЦИИ** - обоснованное мнение о перспективах
-            8. **📚 ИСТОЧНИКИ ДАННЫХ** - перечисление использованных источников
-
-            ## Принципы форматирования:
-
-            - Используй **жирный шрифт** для выделения важных моментов
-            - Структурируй информацию с использованием заголовков ## и подзаголовков ###
-            - Применяй эмодзи в начале разделов для лучшей визуальной навигации
-            - Используй маркированные списки для перечисления пунктов
-            - Выделяй предупреждения и важные замечания в отдельные блоки
-            - Включай таблицы для сравнительного анализа, где уместно
-            - Каждый вывод должен быть подкреплен данными
-
-            ## Правила обработки данных:
-
-            1. Объедини похожую информацию из разных источников
-            2. При противоречивых данных указывай на расхождения и приводи все версии
-            3. Все числовые данные должны сопровождаться единицами измерения и временными метками
-            4. Все сложные термины должны быть кратко объяснены
-            5. Для всех прогнозов указывай степень уверенности и временной горизонт
-
-            ## Результаты исследовательских задач:
-
-            {json.dumps(task_results, indent=2, ensure_ascii=False)}
-
-            ## Задачи, которые не удалось выполнить (учти это в отчете):
-
-            Невыполненные задачи: {incomplete_tasks}
-            Отсутствующие задачи: {missing_tasks}
-
-            ## Заголовок отчета:
-
-            {summary_title}
-
-            Сформируй ПОЛНЫЙ, комплексный отчет, максимально интегрируя и структурируя всю предоставленную информацию в соответствии с указанными принципами. Каждый раздел отчета должен содержать конкретную и релевантную информацию, даже если для этого нужно сделать обоснованные выводы на основе имеющихся данных.
-            """
-
-            # Генерируем структурированный отчет с помощью LLM
-            try:
-                report_response = await report_formatter_llm.ainvoke([{"role": "user", "content": report_prompt}])
-                structured_report = report_response.content
-            except Exception as e:
-                # В случае ошибки просто соединяем результаты с минимальным форматированием
-                structured_report = f"# {summary_title}\n\n"
-                structured_report += "## Результаты выполненных задач\n\n"
-                for title, result in task_results.items():
-                    structured_report += f"### {title}\n\n{result}\n\n---\n\n"
-                structured_report += f"\n\n⚠️ Примечание: При формировании отчета произошла ошибка: {str(e)}"
-
-            # Возвращаем структурированный отчет и мета-информацию
-            return {
-                "summary_title": summary_title,
-                "structured_report": structured_report,
-                "raw_results": task_results,
-                "tasks_info": tasks_info,
-                "missing_tasks": missing_tasks,
-                "incomplete_tasks": incomplete_tasks,
-                "timestamp": datetime.now().isoformat()
-            }
-
-        # Создаем синхронную обертку для асинхронной функции
-        def sync_merge_results(task_ids: List[str], summary_title: str) -> Dict[str, Any]:
-            """Синхронная обертка для асинхронной функции merge_results."""
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                # Если event loop уже запущен, создаем новый
-                new_loop = asyncio.new_event_loop()
-                result = new_loop.run_until_complete(merge_results(task_ids, summary_title))
-                new_loop.close()
-            else:
-                # Иначе используем существующий loop
-                result = loop.run_until_complete(merge_results(task_ids, summary_title))
-            return result
-
-        return sync_merge_results
+        # Инструмент асинхронный: ToolNode сам ожидает корутину в общем event loop,
+        # не блокируя остальных агентов на время генерации отчета; токены отчета
+        # доступны через process_user_input_stream
+        return StructuredTool.from_function(coroutine=merge_results)
 
     async def create_custom_agent(self, agent_id: str, system_prompt: str, tools: List[Any]) -> str:
         """
@@ -451,18 +787,88 @@ class MultiAgentSystem:
         self.agents[agent_id] = custom_agent
         return f"Агент {agent_id} успешно создан"
 
-    async def process_user_input(self, user_input: str) -> str:
+    async def process_user_input(self, user_input: str) -> Tuple[str, List[str]]:
         """
-        Обрабатывает запрос пользователя с помощью супервизорного агента.
+        Обрабатывает запрос пользователя: супервизор составляет план,
+        после чего задачи плана сразу выполняются волнами.
 
         Args:
             user_input: Запрос пользователя
 
         Returns:
-            Ответ супервизорного агента
+            Кортеж (ответ супервизорного агента, ID задач, созданных за этот запрос)
         """
+        agent_id = self._fast_route(user_input)
+        if agent_id is not None:
+            return await self.agents[agent_id].process_user_input(user_input), []
+
         supervisor = self.agents["supervisor"]
-        return await supervisor.process_user_input(user_input)
+        tasks_before = len(self.tasks)
+        response = await supervisor.process_user_input(user_input)
+        new_task_ids = self._tasks_since(tasks_before)
+        await self._execute_new_tasks(new_task_ids)
+        return response, new_task_ids
+
+    async def process_user_input_stream(self, user_input: str) -> AsyncIterator[str]:
+        """
+        Обрабатывает запрос пользователя, отдавая ответ супервизора по мере генерации.
+
+        Args:
+            user_input: Запрос пользователя
+
+        Yields:
+            Фрагменты ответа супервизорного агента (включая отчет merge_results)
+        """
+        agent_id = self._fast_route(user_input)
+        if agent_id is not None:
+            async for chunk in self.agents[agent_id].process_user_input_stream(user_input):
+                yield chunk
+            return
+
+        supervisor = self.agents["supervisor"]
+        tasks_before = len(self.tasks)
+        async for chunk in supervisor.process_user_input_stream(user_input):
+            yield chunk
+        await self._execute_new_tasks(self._tasks_since(tasks_before))
+
+    def _fast_route(self, user_input: str) -> Optional[str]:
+        """
+        Определяет специалиста для запроса без вызова LLM.
+
+        Returns:
+            ID агента, если запросу соответствует ровно один специалист
+            и запрос не торговый, иначе None
+        """
+        if _TRADE_PATTERN.search(user_input):
+            return None
+
+        matched = {agent_id for pattern, agent_id in _FAST_ROUTES if pattern.search(user_input)}
+        if len(matched) != 1:
+            return None
+
+        agent_id = matched.pop()
+        return agent_id if agent_id in self.agents else None
+
+    def _tasks_since(self, count: int) -> List[str]:
+        """Возвращает ID задач, созданных после того, как их было count (без просмотра старых задач)."""
+        new_count = len(self.tasks) - count
+        if new_count <= 0:
+            return []
+        return list(islice(reversed(self.tasks), new_count))[::-1]
+
+    async def _execute_new_tasks(self, new_task_ids: List[str]) -> None:
+        """Выполняет задачи, запланированные супервизором за ход, и возвращает ему результаты."""
+        if not new_task_ids:
+            return
+
+        results = await self.execute_all_pending_tasks()
+
+        # Возвращаем результаты супервизору, чтобы он учитывал их в следующих ответах
+        lines = [
+            f"- {self.tasks[item['task_id']].title} [{self.tasks[item['task_id']].status}]: {item['result']}"
+            for item in results
+        ]
+        self.agents["supervisor"].state.add_system_message("Результаты выполнения задач плана:\n" + "\n".join(lines))
 
     async def execute_task(self, task_id: str) -> Dict[str, Any]:
         """
@@ -474,59 +880,112 @@ class MultiAgentSystem:
         Returns:
             Результат выполнения задачи
         """
-        if task_id not in self.tasks:
+        task = self.tasks.get(task_id)
+        if task is None:
             return {"error": f"Задача с ID {task_id} не найдена"}
 
-        task = self.tasks[task_id]
-        print(f"Executing task: {task.title} (ID: {task.task_id})")
+        logger.debug("Executing task: %s (ID: %s)", task.title, task.task_id)
         agent_id = task.assigned_agent_id
+        logger.debug("Assigned agent ID: %s", agent_id)
 
-        print(f"Assigned agent ID: {agent_id}")
-
-        if agent_id not in self.agents:
-            task.status = "failed"
-            task.result = {"error": f"Агент с ID {agent_id} не найден"}
-            return task.result
-
-        agent = self.agents[agent_id]
-        task.status = "in_progress"
+        agent = self.agents.get(agent_id)
+        if agent is None:
+            return self._fail_task(task, f"Агент с ID {agent_id} не найден")
 
-        print(f"in_progress: {task.status}")
+        self._ensure_guards()
+        async with self._global_sem, self._agent_locks.setdefault(agent_id, asyncio.Lock()):
+            self._pending.pop(task_id, None)
+            task.status = "in_progress"
+            self.tasks_version += 1
+            logger.debug("Task %s is in progress", task.task_id)
 
-        try:
-            result = await agent.process_user_input(task.description)
-            task.result = result
-            task.status = "completed"
-            print(f"Task completed: {task.title} (ID: {task.task_id})")
-        except Exception as e:
-            task.status = "failed"
-            task.result = {"error": str(e)}
+            try:
+                result = await agent.process_user_input(task.description)
+                task.result = result
+                task.status = "completed"
+                logger.debug("Task completed: %s (ID: %s)", task.title, task.task_id)
+            except Exception as e:
+                task.status = "failed"
+                task.result = {"error": str(e)}
+                logger.warning("Task failed: %s (ID: %s): %s", task.title, task.task_id, e)
 
-        task.updated_at = datetime.now()
+        task.updated_at = _now()
+        self.tasks_version += 1
         return task.result
 
     async def execute_all_pending_tasks(self) -> List[Dict[str, Any]]:
         """
-        Выполняет все ожидающие задачи параллельно.
+        Выполняет все ожидающие задачи параллельно с учетом зависимостей (metadata["deps"]):
+        задача запускается сразу, как только выполнены все ее зависимости, не дожидаясь
+        остальных задач, запущенных вместе с ними.
 
         Returns:
-            Список результатов выполнения задач
+            Список результатов выполнения задач (в порядке завершения)
         """
-        pending_tasks = [task_id for task_id, task in self.tasks.items() if task.status == "pending"]
-        if not pending_tasks:
-            return []
+        pending = dict(self._pending)
+        summary = []
+        running: Dict[asyncio.Task, str] = {}
+
+        def start_ready() -> None:
+            """Запускает задачи с выполненными зависимостями и проваливает задачи с проваленными."""
+            for task_id in list(pending):
+                task = self.tasks[task_id]
+                deps = [self.tasks.get(dep) for dep in task.metadata.get("deps", [])]
 
-        # Создаем и запускаем задачи асинхронно
-        coroutines = [self.execute_task(task_id) for task_id in pending_tasks]
-        results = await asyncio.gather(*coroutines, return_exceptions=True)
+                # Зависимость не найдена или провалена - задача выполниться не сможет
+                if any(dep is None or dep.status == "failed" for dep in deps):
+                    del pending[task_id]
+                    result = self._fail_task(task, "Не выполнены зависимости задачи")
+                    summary.append({"task_id": task_id, "result": result})
+                elif all(dep.status == "completed" for dep in deps):
+                    del pending[task_id]
+                    running[asyncio.create_task(self.execute_task(task_id))] = task_id
 
-        return [
-            {
-                "task_id": task_id,
-                "result": result if not isinstance(result, Exception) else str(result)
-            }
-            for task_id, result in zip(pending_tasks, results)
-        ]
+        try:
+            start_ready()
+            while running:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+
+                aborted = False
+                for future in done:
+                    task_id = running.pop(future)
+                    if future.exception() is not None:
+                        # Исключение вне обработки execute_task - помечаем задачу как проваленную
+                        result = self._fail_task(self.tasks[task_id], str(future.exception()))
+                        aborted = True
+                    else:
+                        result = future.result()
+                    summary.append({"task_id": task_id, "result": result})
+
+                if aborted:
+                    # Непредвиденная ошибка прерывает план: выполняющиеся задачи отменяются,
+                    # а не тратят вызовы LLM, оставшиеся не запускаются
+                    for future in running:
+                        future.cancel()
+                    await asyncio.gather(*running, return_exceptions=True)
+                    for task_id in running.values():
+                        result = self._fail_task(self.tasks[task_id], "Задача отменена")
+                        summary.append({"task_id": task_id, "result": result})
+                    running.clear()
+
+                    for task_id in pending:
+                        result = self._fail_task(self.tasks[task_id], "Выполнение плана прервано")
+                        summary.append({"task_id": task_id, "result": result})
+                    pending.clear()
+                    break
+
+                start_ready()
+        finally:
+            # При отмене самого вызова не оставляем задачи выполняться в фоне
+            for future in running:
+                future.cancel()
+
+        # Оставшиеся задачи ждут друг друга (цикл в плане) - выполнить их нельзя
+        for task_id in pending:
+            result = self._fail_task(self.tasks[task_id], "Циклическая зависимость задач")
+            summary.append({"task_id": task_id, "result": result})
+
+        return summary
 
     def get_task_status(self, task_id: str) -> Dict[str, Any]:
         """
@@ -538,10 +997,10 @@ class MultiAgentSystem:
         Returns:
             Информация о задаче
         """
-        if task_id not in self.tasks:
+        task = self.tasks.get(task_id)
+        if task is None:
             return {"error": f"Задача с ID {task_id} не найдена"}
 
-        task = self.tasks[task_id]
         return {
             "task_id": task.task_id,
             "title": task.title,
@@ -558,6 +1017,8 @@ class MultiAgentSystem:
         """Сбрасывает состояние системы, очищая задачи и состояния агентов."""
         self.tasks = {}
         self.global_state = {}
+        self._pending.clear()
+        self.tasks_version += 1
 
         for agent in self.agents.values():
             agent.reset_state()
@@ -566,90 +1027,51 @@ class MultiAgentSystem:
 class CryptoAgent:
     """Класс агента для анализа криптовалют с использованием LLM и инструментов."""
 
-    def __init__(self, agent_id: str, role: AgentRole, system_prompt: str, tools: List[Any]):
+    def __init__(self, agent_id: str, role: AgentRole, tools: List[Any], system_prompt: Optional[str] = None):
         """
         Инициализация агента и его компонентов.
 
         Args:
             agent_id: Уникальный идентификатор агента
             role: Роль агента в системе
-            system_prompt: Системный промпт для агента
             tools: Список инструментов агента
+            system_prompt: Системный промпт для агента (по умолчанию - стандартный промпт роли)
         """
         self.agent_id = agent_id
         self.role = role
-        self.system_prompt = system_prompt
-        self.state = AgentState()
-        self.llm = ChatOpenAI(model=LLM_MODEL, temperature=LLM_TEMPERATURE)
         self.tools = tools
 
-        # Добавляем системное сообщение с промптом
-        self.state.add_system_message(system_prompt)
-
-        # Привязка инструментов к модели
-        self.llm_with_tools = self.llm.bind_tools(self.tools)
-
-        # Создание графа агента
-        self.agent = self._create_agent_graph()
-
-    def _create_agent_graph(self):
-        """Создает и возвращает граф агента с инструментами."""
-        # Создание ToolNode с инструментами
-        tool_node = ToolNode(self.tools)
-
-        # Создание графа состояния
-        workflow = StateGraph(MessagesState)
+        # Стандартные роли используют готовое системное сообщение, общее для всех агентов роли
+        if system_prompt is None:
+            self.system_prompt = _AGENT_PROMPTS[role]
+            self._system_message = _SYSTEM_MESSAGES[role]
+        else:
+            self.system_prompt = system_prompt
+            self._system_message = Message(role=MessageRole.SYSTEM, content=system_prompt)
 
-        # Добавление узлов и ребер
-        workflow.add_node("agent", self._call_model)
-        workflow.add_node("tools", tool_node)
-
-        workflow.set_entry_point("agent")
-        workflow.add_conditional_edges(
-            "agent",
-            self._should_continue,
-            {"tools": "tools", "end": END}
-        )
-        workflow.add_edge("tools", "agent")
-
-        # Компиляция графа
-        return workflow.compile()
-
-    async def _call_model(self, state: MessagesState):
-        """Вызывает модель с текущими сообщениями."""
-        messages = state["messages"]
-
-        # Засекаем время выполнения
-        start_time = time.time()
-
-        # Вызываем модель
-        response = await self.llm_with_tools.ainvoke(messages)
-
-        # Записываем время выполнения
-        execution_time = time.time() - start_time
-
-        # Обновляем состояние агента
-        if hasattr(response, "content") and response.content:
-            self.state.add_assistant_message(response.content)
+        # Добавляем системное сообщение с промптом
+        self.state = AgentState()
+        self.state.add_message(self._system_message)
 
-        # Обрабатываем вызовы инструментов, если они есть
-        if hasattr(response, "tool_calls") and response.tool_calls:
-            for tool_call in response.tool_calls:
-                tool_name = tool_call.get("name", "unknown_tool")
-                tool_args = tool_call.get("args", {})
+        # Собственное у агента только состояние диалога, модель с инструментами
+        # и граф общие для всех агентов с тем же набором инструментов
+        self.llm = make_llm(LLM_TEMPERATURE)
+        self.llm_with_tools, self.agent = _build_compiled_graph(LLM_MODEL, LLM_TEMPERATURE, _ToolSet(tools))
 
-                # Регистрируем вызов инструмента
-                self.state.add_tool_call(tool_name, tool_args)
+    def _record_turn(self, new_messages) -> None:
+        """Записывает ответы модели и вызовы инструментов в состояние агента."""
+        for message in new_messages:
+            if not isinstance(message, AIMessage):
+                continue
 
-        return {"messages": [response]}
+            if message.content:
+                self.state.apply(TurnEvent(kind="assistant_message", content=message.content))
 
-    def _should_continue(self, state: MessagesState) -> Literal["tools", "end"]:
-        """Определяет, нужно ли вызывать инструменты или завершить обработку."""
-        messages = state["messages"]
-        last_message = messages[-1]
-        if hasattr(last_message, "tool_calls") and last_message.tool_calls:
-            return "tools"
-        return "end"
+            # Регистрируем все вызовы инструментов ответа одной операцией
+            self.state.extend_tool_calls([
+                (tool_call.get("name", "unknown_tool"), tool_call.get("args", {}))
+                for tool_call in message.tool_calls or ()
+            ])
 
     async def process_user_input(self, user_input: str) -> str:
         """
@@ -664,18 +1086,53 @@ class CryptoAgent:
         # Добавляем сообщение пользователя в состояние
         self.state.add_user_message(user_input)
 
+        # Старшая часть длинного диалога заменяется кратким содержанием (системный промпт сохраняется)
+        await compact_history(self.state, HISTORY_TOKEN_THRESHOLD, keep=1)
+
         # Преобразуем историю в формат для LangChain
-        langchain_messages = self.state.get_conversation_history()
+        langchain_messages = self.state.get_windowed_history(HISTORY_WINDOW_TOKENS)
 
         # Вызываем агента
         result = await self.agent.ainvoke({"messages": langchain_messages})
 
+        # Обновляем состояние агента новыми сообщениями графа
+        self._record_turn(result["messages"][len(langchain_messages):])
+
         # Получаем последний ответ
         last_message = result["messages"][-1]
         response_content = last_message.content if hasattr(last_message, "content") else str(last_message)
 
         return response_content
 
+    async def process_user_input_stream(self, user_input: str) -> AsyncIterator[str]:
+        """
+        Обрабатывает ввод пользователя, отдавая текст ответа по мере генерации.
+
+        Args:
+            user_input: Запрос пользователя
+
+        Yields:
+            Фрагменты текста от моделей графа, включая модели внутри инструментов
+        """
+        self.state.add_user_message(user_input)
+        await compact_history(self.state, HISTORY_TOKEN_THRESHOLD, keep=1)
+        langchain_messages = self.state.get_windowed_history(HISTORY_WINDOW_TOKENS)
+
+        final_messages = langchain_messages
+        async for mode, payload in self.agent.astream(
+            {"messages": langchain_messages}, stream_mode=["messages", "values"]
+        ):
+            if mode == "values":
+                final_messages = payload["messages"]
+                continue
+
+            chunk, _ = payload
+            if isinstance(chunk, AIMessageChunk) and chunk.content:
+                yield chunk.content
+
+        # Обновляем состояние агента новыми сообщениями графа
+        self._record_turn(final_messages[len(langchain_messages):])
+
     def get_state(self) -> AgentState:
         """Возвращает текущее состояние агента."""
         return self.state
@@ -684,7 +1141,7 @@ class CryptoAgent:
         """Сбрасывает состояние агента."""
         self.state = AgentState()
         # Добавляем системное сообщение с промптом
-        self.state.add_system_message(self.system_prompt)
+        self.state.add_message(self._system_message)
 
 
 # Функция для создания мультиагентной системы
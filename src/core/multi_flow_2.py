@@ -1,18 +1,23 @@
 """Мультиагентная система для анализа криптовалют с глубоким исследованием."""
 
+import functools
 import time
 import uuid
-from typing import Literal, Dict, Any, List, Optional, Union
+from typing import Literal, Dict, Any, List, Optional, Tuple, Union
 import asyncio
 from enum import Enum
+import orjson
+from openai import AsyncOpenAI
 from pydantic import BaseModel, Field
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, MessagesState, END
 from langgraph.prebuilt import ToolNode
 from datetime import datetime
 
 # Конфигурация
-from config.settings import LLM_MODEL, LLM_TEMPERATURE
+from config.settings import LLM_MODEL, LLM_TEMPERATURE, MAX_CONCURRENT_LLM
+from core.llm import SHARED_HTTPX, make_llm
 
 # Модели и инструменты
 from models.state import AgentState, MessageRole, Message, ToolCall, ToolResult
@@ -26,6 +31,10 @@ from tools import (
     get_polymarket_data, get_market_summary
 )
 
+# Пакетная обработка: одновременные запросы в онлайн-режиме и интервал опроса OpenAI Batch API
+BATCH_MAX_CONCURRENCY = 20
+BATCH_POLL_INTERVAL_S = 30
+
 class AgentRole(str, Enum):
     """Роли агентов в системе."""
     SUPERVISOR = "supervisor"
@@ -52,29 +61,43 @@ class Task(BaseModel):
     sub_tasks: List[str] = Field(default_factory=list)
     metadata: Dict[str, Any] = Field(default_factory=dict)
 
+class RefineQuery(BaseModel):
+    """Уточненный запрос и инструменты, нужные для его выполнения."""
+    query: str = Field(description="Уточненный технический запрос для системы")
+    tools: List[str] = Field(default_factory=list, description="Список требуемых инструментов")
+
+class RefineClarify(BaseModel):
+    """Вопрос пользователю, если запрос нельзя выполнить без уточнения."""
+    clarify: str = Field(description="Текст уточняющего вопроса")
+
+class RefineResult(BaseModel):
+    """Результат анализа запроса: уточненный запрос или просьба об уточнении."""
+    result: Union[RefineQuery, RefineClarify]
+
+# Промпт уточнения запроса (шаблон разбирается один раз при загрузке модуля)
+REFINE_TEMPLATE = """
+Анализируй запрос пользователя и генерируй:
+1. Уточненный технический запрос для системы и список требуемых инструментов
+2. Или запрос на уточнение
+
+Исходный запрос: {user_input}
+"""
+
 class ResearchPlanner:
     """Планировщик исследований с уточнением запросов."""
     
     def __init__(self):
-        self.llm = ChatOpenAI(model=LLM_MODEL, temperature=0.1)
+        # Ответ разбирается и валидируется LangChain через вызов функции, без eval
+        self.prompt = ChatPromptTemplate.from_template(REFINE_TEMPLATE)
+        self.llm = make_llm(0.1).with_structured_output(
+            RefineResult, method="function_calling"
+        )
+        self.chain = self.prompt | self.llm
         
-    async def refine_query(self, user_input: str) -> Union[str, Dict[str, str]]:
+    async def refine_query(self, user_input: str) -> Union[RefineQuery, RefineClarify]:
         """Генерирует уточненный запрос или просит пояснений."""
-        prompt = f"""
-        Анализируй запрос пользователя и генерируй:
-        1. Уточненный технический запрос для системы
-        2. Список требуемых инструментов
-        3. Или запрос на уточнение
-
-        Исходный запрос: {user_input}
-
-        Формат ответа:
-        {{"query": "уточненный_запрос", "tools": ["tool1", "tool2"]}}
-        или
-        {{"clarify": "текст_уточнения"}}
-        """
-        response = await self.llm.ainvoke(prompt)
-        return eval(response.content)
+        response = await self.chain.ainvoke({"user_input": user_input})
+        return response.result
 
 class MultiAgentSystem:
     """Управление мультиагентной системой с поддержкой глубокого исследования."""
@@ -132,19 +155,56 @@ class MultiAgentSystem:
             )
             self.agents[config["id"]] = agent
 
-    async def process_user_request(self, user_input: str) -> str:
-        """Обработка запроса с использованием глубокого исследования."""
+    async def process_user_request(self, user_input: Union[str, List[str]],
+                                   mode: Literal["online", "batch"] = "online") -> Union[str, List[str]]:
+        """
+        Обработка запроса с использованием глубокого исследования.
+
+        Список запросов (массовые исследования, прогон датасетов) обрабатывается
+        супервизором пакетно, без этапа уточнения, в режиме mode.
+        """
+        if isinstance(user_input, list):
+            return await self.agents["supervisor"].process_user_inputs(user_input, mode)
+
         # Этап 1: Уточнение запроса
         research_result = await self.research_planner.refine_query(user_input)
         
-        if "clarify" in research_result:
-            return research_result["clarify"]
+        if isinstance(research_result, RefineClarify):
+            return research_result.clarify
         
-        # Этап 2: Выполнение уточненного запроса
-        if "query" in research_result:
-            return await self.agents["supervisor"].process_user_input(research_result["query"])
-        
-        return "Не удалось обработать запрос"
+        if not isinstance(research_result, RefineQuery):
+            return "Не удалось обработать запрос"
+
+        # Этап 2: Агенты, владеющие требуемыми инструментами, работают параллельно,
+        # и время ответа определяется самым медленным агентом, а не их суммой
+        selected = self._select_agents(research_result.tools)
+        if not selected:
+            return await self.agents["supervisor"].process_user_input(research_result.query)
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM)
+
+        async def run_agent(agent_id: str) -> str:
+            async with semaphore:
+                return await self.agents[agent_id].process_user_input(research_result.query)
+
+        results = await asyncio.gather(*(run_agent(agent_id) for agent_id in selected), return_exceptions=True)
+
+        # Этап 3: Супервизор объединяет результаты за один проход
+        sections = "\n\n".join(
+            f"### {agent_id}\n{f'Ошибка: {result}' if isinstance(result, Exception) else result}"
+            for agent_id, result in zip(selected, results)
+        )
+        return await self.agents["supervisor"].process_user_input(
+            f"Объедини результаты агентов в единый ответ на запрос: {research_result.query}\n\n{sections}"
+        )
+
+    def _select_agents(self, tool_names: List[str]) -> List[str]:
+        """Возвращает ID специализированных агентов, у которых есть хотя бы один из инструментов."""
+        wanted = set(tool_names)
+        return [
+            agent_id for agent_id, agent in self.agents.items()
+            if agent_id != "supervisor" and any(getattr(tool, "name", None) in wanted for tool in agent.tools)
+        ]
 
     # Реализация инструментов супервизора
     def _create_delegate_task_tool(self):
@@ -165,9 +225,43 @@ class MultiAgentSystem:
 
     def _create_merge_results_tool(self):
         def merge_results(task_ids: List[str]):
-            return [self.tasks[tid] for tid in task_ids if tid in self.tasks]
+            return [task for task in map(self.tasks.get, task_ids) if task is not None]
         return merge_results
 
+async def _process_message(state: MessagesState):
+    """Обработка входящих сообщений (узел графа не зависит от конкретного агента)."""
+    response = await make_llm(LLM_TEMPERATURE).ainvoke(state["messages"])
+    return {"messages": [response]}
+
+class _ToolsKey:
+    """Ключ кэша графа: идентичность инструментов (StructuredTool не хэшируется)."""
+
+    def __init__(self, tools: list):
+        self.tools = tuple(tools)
+        self._ids: Tuple[int, ...] = tuple(id(tool) for tool in self.tools)
+
+    def __hash__(self) -> int:
+        return hash(self._ids)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _ToolsKey) and self._ids == other._ids
+
+@functools.lru_cache(maxsize=32)
+def _compile_workflow(tools_key: _ToolsKey):
+    """Создание графа обработки сообщений (один граф на набор инструментов)."""
+    workflow = StateGraph(MessagesState)
+    workflow.add_node("process", _process_message)
+    workflow.add_node("tools", ToolNode(list(tools_key.tools)))
+    
+    workflow.set_entry_point("process")
+    workflow.add_conditional_edges(
+        "process",
+        lambda s: "tools" if s["messages"][-1].tool_calls else "end",
+        {"tools": "tools", "end": END}
+    )
+    workflow.add_edge("tools", "process")
+    return workflow.compile()
+
 class CryptoAgent:
     """Агент с расширенными возможностями обработки запросов."""
     
@@ -175,29 +269,10 @@ class CryptoAgent:
         self.agent_id = agent_id
         self.role = role
         self.state = AgentState()
-        self.llm = ChatOpenAI(model=LLM_MODEL, temperature=LLM_TEMPERATURE)
+        self.llm = make_llm(LLM_TEMPERATURE)
         self.tools = tools
-        self.workflow = self._build_workflow()
-
-    def _build_workflow(self):
-        """Создание графа обработки сообщений."""
-        workflow = StateGraph(MessagesState)
-        workflow.add_node("process", self.process_message)
-        workflow.add_node("tools", ToolNode(self.tools))
-        
-        workflow.set_entry_point("process")
-        workflow.add_conditional_edges(
-            "process",
-            lambda s: "tools" if s["messages"][-1].tool_calls else "end",
-            {"tools": "tools", "end": END}
-        )
-        workflow.add_edge("tools", "process")
-        return workflow.compile()
-
-    async def process_message(self, state: MessagesState):
-        """Обработка входящих сообщений."""
-        response = await self.llm.ainvoke(state["messages"])
-        return {"messages": [response]}
+        # Скомпилированный граф общий для агентов с одинаковым набором инструментов
+        self.workflow = _compile_workflow(_ToolsKey(tools))
 
     async def process_user_input(self, user_input: str) -> str:
         """Основной метод обработки пользовательского ввода."""
@@ -205,6 +280,74 @@ class CryptoAgent:
         result = await self.workflow.ainvoke({"messages": self.state.get_conversation_history()})
         return result["messages"][-1].content
 
+    async def process_user_inputs(self, inputs: List[str],
+                                  mode: Literal["online", "batch"] = "online") -> List[str]:
+        """
+        Обрабатывает набор независимых запросов одним пакетом (один вызов LLM на запрос, без инструментов).
+
+        Args:
+            inputs: Запросы; каждый выполняется поверх текущей истории агента, но в историю не попадает
+            mode: "online" - параллельные запросы через abatch, "batch" - OpenAI Batch API
+                  (дешевле и с отдельным лимитом, но результат может занять до 24 часов)
+
+        Returns:
+            Ответы в порядке запросов
+        """
+        history = self.state.get_conversation_history()
+        conversations = [history + [{"role": "user", "content": text}] for text in inputs]
+
+        if mode == "batch":
+            return await self._run_openai_batch(conversations)
+
+        responses = await self.llm.abatch(conversations, config={"max_concurrency": BATCH_MAX_CONCURRENCY})
+        return [response.content for response in responses]
+
+    async def _run_openai_batch(self, conversations: List[List[Dict[str, Any]]]) -> List[str]:
+        """Отправляет диалоги в OpenAI Batch API и дожидается результатов."""
+        lines = [
+            orjson.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": LLM_MODEL,
+                    "temperature": LLM_TEMPERATURE,
+                    "messages": [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+                }
+            })
+            for i, messages in enumerate(conversations)
+        ]
+
+        client = AsyncOpenAI(http_client=SHARED_HTTPX)
+        batch_file = await client.files.create(file=("batch.jsonl", b"\n".join(lines)), purpose="batch")
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(BATCH_POLL_INTERVAL_S)
+            batch = await client.batches.retrieve(batch.id)
+
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(f"Пакет {batch.id} завершился со статусом {batch.status}")
+
+        output = await client.files.content(batch.output_file_id)
+        answers = [""] * len(conversations)
+        for line in output.text.splitlines():
+            if not line:
+                continue
+            item = orjson.loads(line)
+            body = (item.get("response") or {}).get("body") or {}
+            choices = body.get("choices") or []
+            if choices:
+                answers[int(item["custom_id"])] = choices[0]["message"]["content"]
+            else:
+                answers[int(item["custom_id"])] = f"Ошибка: {item.get('error')}"
+
+        return answers
+
 # Создание и запуск системы
 async def main():
     system = MultiAgentSystem()
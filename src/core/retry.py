@@ -0,0 +1,103 @@
+"""Повтор запросов к внешним API с экспоненциальной задержкой и jitter."""
+
+import asyncio
+import random
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+import aiohttp
+import httpx
+
+# Статус из текста исключения, например "HTTP error! status: 429 ..." у сервисов GOAT
+_STATUS_RE = re.compile(r'status:?\s*(\d{3})')
+
+
+def _status_of(error: Exception) -> Optional[int]:
+    """Возвращает HTTP-статус, связанный с исключением, если его удается определить."""
+    status = getattr(error, "status", None)
+    if isinstance(status, int):
+        return status
+    match = _STATUS_RE.search(str(error))
+    return int(match.group(1)) if match else None
+
+
+def is_retryable(error: Exception) -> bool:
+    """Определяет, имеет ли смысл повторить запрос после ошибки."""
+    # Таймауты и обрывы соединения - временные сбои
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ServerTimeoutError,
+                          httpx.TransportError)):
+        return True
+
+    # Из HTTP-ошибок повторяем только перегрузку (429) и ошибки сервера (5xx)
+    status = _status_of(error)
+    return status is not None and is_retryable_status(status)
+
+
+def is_retryable_status(status: int) -> bool:
+    """Определяет, стоит ли повторить запрос, получивший ответ с этим статусом."""
+    return status == 429 or status >= 500
+
+
+def backoff_delay(attempt: int, base: float = 0.2, cap: float = 2.0) -> float:
+    """Задержка перед повтором: экспонента от номера попытки с ограничением и jitter."""
+    return min(cap, base * 2 ** attempt) + random.random() * 0.1
+
+
+async def with_retry(coro_factory: Callable[[], Awaitable[Any]], *,
+                     attempts: int = 3, base: float = 0.2, cap: float = 2.0) -> Any:
+    """
+    Выполняет корутину, повторяя ее при временных ошибках.
+
+    Args:
+        coro_factory: Функция без аргументов, создающая новую корутину для каждой попытки
+        attempts: Максимальное число попыток
+        base: Базовая задержка в секундах (удваивается с каждой попыткой)
+        cap: Максимальная задержка в секундах
+
+    Returns:
+        Результат корутины
+    """
+    for attempt in range(attempts):
+        try:
+            return await coro_factory()
+        except Exception as e:
+            if attempt == attempts - 1 or not is_retryable(e):
+                raise
+            await asyncio.sleep(backoff_delay(attempt, base, cap))
+
+
+class CircuitOpenError(Exception):
+    """Запрос не выполнялся: внешний сервис недавно несколько раз подряд не ответил."""
+
+
+class CircuitBreaker:
+    """
+    Размыкатель цепи по ключу (обычно хосту API).
+
+    После failure_threshold временных ошибок подряд запросы по ключу сразу отклоняются
+    в течение reset_timeout секунд, не тратя время на заведомо недоступный сервис.
+    Первый запрос после паузы проходит как пробный: успех замыкает цепь.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # ключ -> (число ошибок подряд, момент до которого цепь разомкнута)
+        self._state: Dict[Hashable, Tuple[int, float]] = {}
+
+    def check(self, key: Hashable) -> None:
+        """Выбрасывает CircuitOpenError, если цепь по ключу разомкнута."""
+        failures, open_until = self._state.get(key, (0, 0.0))
+        if open_until > time.monotonic():
+            raise CircuitOpenError(f"{key}: сервис временно недоступен ({failures} ошибок подряд)")
+
+    def record_success(self, key: Hashable) -> None:
+        """Сбрасывает счетчик ошибок после успешного запроса."""
+        self._state.pop(key, None)
+
+    def record_failure(self, key: Hashable) -> None:
+        """Учитывает временную ошибку и размыкает цепь при достижении порога."""
+        failures = self._state.get(key, (0, 0.0))[0] + 1
+        open_until = time.monotonic() + self.reset_timeout if failures >= self.failure_threshold else 0.0
+        self._state[key] = (failures, open_until)
@@ -1,29 +1,76 @@
-from models.state import AgentState, Message, MessageRole
+"""Сессии диалога с сохранением состояния в SQLite через чекпойнтер LangGraph."""
+
+import asyncio
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+from config.settings import AGENT_LLM_MODEL, LLM_TEMPERATURE, SESSIONS_DB, SESSION_CONTEXT_MESSAGES
+from .agent import _build_workflow
+
+
+# Типы сообщений LangChain в роли истории диалога
+_ROLES = {"human": "user", "ai": "assistant"}
+
+# Граф с чекпойнтером и его соединение с базой создаются один раз при первом обращении
+_session_graph = None
+_session_saver = None
+_session_graph_lock = asyncio.Lock()
+
+
+async def get_session_graph():
+    """Возвращает граф агента, сохраняющий состояние каждого узла в SQLite."""
+    global _session_graph, _session_saver
+    async with _session_graph_lock:
+        if _session_graph is None:
+            import aiosqlite
+            from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+            _session_saver = AsyncSqliteSaver(await aiosqlite.connect(SESSIONS_DB))
+            workflow = _build_workflow(AGENT_LLM_MODEL, LLM_TEMPERATURE, SESSION_CONTEXT_MESSAGES)
+            _session_graph = workflow.compile(checkpointer=_session_saver)
+    return _session_graph
+
+
+async def close_session_store() -> None:
+    """Закрывает соединение с базой сессий."""
+    global _session_graph, _session_saver
+    if _session_saver is not None:
+        await _session_saver.conn.close()
+    _session_graph = None
+    _session_saver = None
 
 
 class Session:
-    """Класс для управления сессией взаимодействия с пользователем."""
-
-    def __init__(self):
-        """Инициализирует новую сессию."""
-        self.state = AgentState()
-
-    def add_user_message(self, message: str) -> Message:
-        """Добавляет сообщение пользователя в историю."""
-        return self.state.add_user_message(message)
-
-    def add_assistant_message(self, message: str) -> Message:
-        """Добавляет сообщение ассистента в историю."""
-        return self.state.add_assistant_message(message)
-
-    def get_messages(self):
-        """Возвращает полную историю сообщений."""
-        return self.state.get_conversation_history()
-
-    def clear_history(self):
-        """Очищает историю сообщений."""
-        self.state.clear_history()
-        
-    def get_state(self) -> AgentState:
-        """Возвращает полное состояние сессии."""
-        return self.state
\ No newline at end of file
+    """Класс для управления сессией взаимодействия с пользователем.
+
+    Сессия хранит только свой идентификатор: история диалога записывается
+    чекпойнтером по мере выполнения узлов графа, поэтому сессию можно
+    продолжить после перезапуска процесса по тому же session_id.
+    """
+
+    def __init__(self, session_id: Optional[str] = None):
+        """Инициализирует новую сессию или подключается к существующей."""
+        self.session_id = session_id or uuid4().hex
+        self._config = {"configurable": {"thread_id": self.session_id}}
+
+    async def process_user_input(self, user_input: str) -> str:
+        """Обрабатывает сообщение пользователя и возвращает ответ агента."""
+        graph = await get_session_graph()
+        result = await graph.ainvoke(
+            {"messages": [{"role": "user", "content": user_input}]}, self._config
+        )
+        return result["messages"][-1].content
+
+    async def get_messages(self, last_n: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Возвращает историю сообщений сессии (или только последние last_n)."""
+        graph = await get_session_graph()
+        snapshot = await graph.aget_state(self._config)
+        messages = snapshot.values.get("messages", [])
+        if last_n is not None:
+            messages = messages[-last_n:]
+        return [{"role": _ROLES.get(msg.type, msg.type), "content": msg.content} for msg in messages]
+
+    async def clear_history(self) -> None:
+        """Удаляет сохраненную историю сессии."""
+        await get_session_graph()
+        await _session_saver.adelete_thread(self.session_id)
@@ -0,0 +1,27 @@
+"""Подсчет токенов для промптов LLM."""
+
+import functools
+
+import tiktoken
+
+from config.settings import LLM_MODEL
+
+# Приблизительное число символов на токен, если токенизатор недоступен
+CHARS_PER_TOKEN = 4
+
+
+@functools.lru_cache(maxsize=1)
+def get_encoding():
+    """Возвращает токенизатор модели или None, если его не удалось загрузить (например, без сети)."""
+    try:
+        return tiktoken.encoding_for_model(LLM_MODEL)
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Считает токены в тексте (приблизительно, если токенизатор недоступен)."""
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
@@ -1,33 +1,43 @@
 """Основной файл приложения Crypto Analysis Assistant."""
 
+import argparse
 import asyncio
+import importlib.util
 import sys
 import time
 
-from config.settings import setup_environment
-from ui.interface import (
-    display_welcome,
-    display_response,
-    get_multiline_input,
-    display_thinking,
-    display_exit_message,
-    display_separator,
-    display_research_result
-)
-from core.agent import create_agent
-from rich.console import Console
-from rich import print as rprint
-from config.settings import setup_environment, OPENAI_API_KEY
 
-# Инициализация консоли
-console = Console()
+def parse_args(argv=None) -> argparse.Namespace:
+    """Разбирает аргументы командной строки (до загрузки LangChain и инструментов)."""
+    parser = argparse.ArgumentParser(description="Crypto Analysis Assistant: интерактивный анализ криптовалют")
+    return parser.parse_args(argv)
 
-# Настройка окружения
-setup_environment()
 
 async def main():
     """Основная функция приложения."""
-    
+    # Тяжелые зависимости (LangChain, LangGraph, инструменты) загружаются только при запуске диалога
+    from config.settings import setup_environment, OPENAI_API_KEY
+    from core.agent import create_agent
+    from core.cache import sweep_caches_periodically
+    from core.llm import close_llm_client, warm_up_llm_connection
+    from tools import close_session
+    from rich import print as rprint
+    from rich.console import Group
+    from rich.text import Text
+    from ui.interface import (
+        SEPARATOR,
+        console,
+        display_welcome,
+        display_response_stream,
+        get_multiline_input_async,
+        display_exit_message,
+        display_research_stream,
+        display_research_progress
+    )
+
+    # Настройка окружения
+    setup_environment()
+
     # Проверка наличия необходимых ключей API
     if not OPENAI_API_KEY:
         console.print("[bold red]ОШИБКА: OPENAI_API_KEY не установлен![/bold red]")
@@ -35,18 +45,30 @@ async def main():
         return
     # Инициализация
     display_welcome()
+    # Соединение с OpenAI устанавливается в фоне, пока создается агент и пользователь вводит запрос
+    warmup = asyncio.create_task(warm_up_llm_connection())
     agent = create_agent()
+
+    # Пока пользователь вводит запрос, в фоне удаляются устаревшие записи кэшей
+    sweeper = asyncio.create_task(sweep_caches_periodically())
     
     # Основной цикл
     while True:
         # Получаем ввод пользователя
-        user_input = get_multiline_input()
+        user_input = await get_multiline_input_async()
         
         # Проверяем выход
         if user_input.lower() in ["exit", "quit", "q"]:
             display_exit_message()
+            warmup.cancel()
+            sweeper.cancel()
+            await close_session()
+            await close_llm_client()
             break
             
+        # Первый запрос к модели идет по уже открытому соединению
+        await warmup
+
         # Проверяем, является ли это запросом на deep research
         if user_input.lower().startswith("/research"):
             # Извлекаем символ токена из команды
@@ -57,40 +79,41 @@ async def main():
                 
             token_symbol = parts[1].strip().upper()
             
-            # Выполняем deep research
-            with display_thinking():
-                result = await agent.perform_deep_research(token_symbol)
-            
-            # Отображаем результат
-            display_research_result(result, token_symbol)
+            # Выполняем deep research, отображая отчет по мере генерации
+            await display_research_stream(
+                agent.perform_deep_research_stream(token_symbol, on_progress=display_research_progress),
+                token_symbol
+            )
             continue
         
         # Стандартная обработка запроса
         # Засекаем время обработки запроса
-        start_time = time.time()
+        start_time = time.perf_counter()
         
-        # Вызываем модель
-        with display_thinking():
-            response = await agent.process_user_input(user_input)
+        # Вызываем модель, отображая ответ по мере генерации
+        await display_response_stream(agent.process_user_input_stream(user_input))
         
         # Вычисляем время обработки
-        processing_time = time.time() - start_time
-        
-        # Отображаем ответ
-        display_response(response)
-        
-        # Показываем информацию о времени обработки
-        rprint(f"[dim italic]Запрос обработан за {processing_time:.2f} сек[/dim italic]")
-        
-        display_separator()
+        processing_time = time.perf_counter() - start_time
         
-        # Получаем состояние для отладки
+        # Время обработки, разделитель и состояние диалога выводятся одним вызовом
         state = agent.get_state()
-        rprint(f"[dim]Диалог содержит {len(state.messages)} сообщений, {len(state.tool_calls)} вызовов инструментов[/dim]")
+        console.print(Group(
+            Text(f"Запрос обработан за {processing_time:.2f} сек", style="dim italic"),
+            SEPARATOR,
+            Text(f"Диалог содержит {len(state.messages)} сообщений, {len(state.tool_calls)} вызовов инструментов", style="dim")
+        ))
 
 if __name__ == "__main__":
+    parse_args()
+    # uvloop быстрее обрабатывает сокеты event loop; на Windows пакета нет - стандартный asyncio
+    run = asyncio.run
+    if importlib.util.find_spec("uvloop") is not None:
+        import uvloop
+        run = uvloop.run
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
-        console.print("\n[bold red]Программа прервана пользователем[/bold red]")
+        from rich import print as rprint
+        rprint("\n[bold red]Программа прервана пользователем[/bold red]")
         sys.exit(0)
\ No newline at end of file
@@ -0,0 +1,16 @@
+"""Базовые модели, общие для состояния агента и схем инструментов."""
+
+import time
+from datetime import datetime
+
+from pydantic import BaseModel, Field
+
+
+class TimestampedModel(BaseModel):
+    """Модель с временем создания: при создании один вызов time_ns, datetime вычисляется только при чтении."""
+    timestamp_ns: int = Field(default_factory=time.time_ns)
+
+    @property
+    def timestamp(self) -> datetime:
+        """Время создания объекта."""
+        return datetime.fromtimestamp(self.timestamp_ns / 1e9)
@@ -1,9 +1,22 @@
 """Модели состояния для криптоаналитического агента."""
 
+import time
+from collections import deque
+from uuid import uuid4
 from enum import Enum
-from typing import Dict, List, Optional, Union, Any
+from typing import Deque, Dict, List, Literal, Optional, Tuple, Union, Any
 from datetime import datetime
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, field_validator
+
+from core.tokens import count_tokens
+from .base import TimestampedModel
+
+
+# Максимальное число сообщений, хранимых в истории диалога
+MAX_HISTORY_MESSAGES = 64
+
+# Максимальное число хранимых вызовов инструментов и их результатов
+MAX_TOOL_RECORDS = 1000
 
 
 class MessageRole(str, Enum):
@@ -21,14 +34,17 @@ class MessageContent(BaseModel):
     additional_data: Optional[Dict[str, Any]] = None
 
 
-class Message(BaseModel):
+class Message(TimestampedModel):
     """Модель для представления сообщения в диалоге."""
     role: MessageRole
     content: Union[str, MessageContent]
-    timestamp: datetime = Field(default_factory=datetime.now)
-    message_id: str = Field(default_factory=lambda: f"msg_{datetime.now().timestamp()}")
+    message_id: str = Field(default_factory=lambda: f"msg_{uuid4().hex}")
+
+    # Сообщения не изменяются после создания
+    model_config = ConfigDict(frozen=True)
 
-    @validator("content", pre=True)
+    @field_validator("content", mode="before")
+    @classmethod
     def validate_content(cls, v):
         """Преобразует строковый контент в объект MessageContent."""
         if isinstance(v, str):
@@ -36,12 +52,14 @@ class Message(BaseModel):
         return v
 
 
-class ToolCall(BaseModel):
+class ToolCall(TimestampedModel):
     """Модель вызова инструмента."""
     tool_name: str
     arguments: Dict[str, Any]
-    timestamp: datetime = Field(default_factory=datetime.now)
-    call_id: str = Field(default_factory=lambda: f"tool_{datetime.now().timestamp()}")
+    call_id: str = Field(default_factory=lambda: f"tool_{uuid4().hex}")
+
+    # Вызовы не изменяются после регистрации
+    model_config = ConfigDict(frozen=True)
 
 
 class ToolResult(BaseModel):
@@ -54,41 +72,107 @@ class ToolResult(BaseModel):
     execution_time: float = 0.0
 
 
+class TurnEvent(BaseModel):
+    """Событие хода агента, применяемое к состоянию после завершения хода."""
+    kind: Literal["assistant_message", "tool_call"]
+    content: str = ""
+    tool_name: str = ""
+    arguments: Dict[str, Any] = Field(default_factory=dict)
+
+
+def _msg_to_dict(msg: Message) -> Dict[str, str]:
+    """Преобразует сообщение в формат истории для LLM (валидатор гарантирует MessageContent)."""
+    return {"role": msg.role.value, "content": msg.content.text}
+
+
 class AgentState(BaseModel):
     """Основная модель состояния агента."""
-    conversation_id: str = Field(default_factory=lambda: f"conv_{datetime.now().timestamp()}")
-    messages: List[Message] = Field(default_factory=list)
-    tool_calls: List[ToolCall] = Field(default_factory=list)
-    tool_results: List[ToolResult] = Field(default_factory=list)
+    conversation_id: str = Field(default_factory=lambda: f"conv_{uuid4().hex}")
+    messages: Deque[Message] = Field(default_factory=deque)
+    tool_calls: Deque[ToolCall] = Field(default_factory=lambda: deque(maxlen=MAX_TOOL_RECORDS))
+    tool_results: Deque[ToolResult] = Field(default_factory=lambda: deque(maxlen=MAX_TOOL_RECORDS))
     current_context: Dict[str, Any] = Field(default_factory=dict)
     created_at: datetime = Field(default_factory=datetime.now)
     updated_at: datetime = Field(default_factory=datetime.now)
     metadata: Dict[str, Any] = Field(default_factory=dict)
 
-    class Config:
-        """Конфигурация модели."""
-        validate_assignment = True
+    # История в формате для LLM: ведется параллельно messages и дополняется
+    # при каждом изменении истории, а не пересобирается на каждом ходе
+    _history: Deque[Dict[str, str]] = PrivateAttr(default_factory=deque)
 
-    def add_user_message(self, content: str) -> Message:
-        """Добавляет сообщение пользователя в историю."""
-        message = Message(role=MessageRole.USER, content=content)
+    # Без validate_assignment: состояние меняется на каждом сообщении (updated_at и т.п.),
+    # а поля изменяются только методами модели
+    model_config = ConfigDict(validate_assignment=False)
+
+    @field_validator("messages")
+    @classmethod
+    def messages_deque(cls, v):
+        """Хранит историю в deque (ограничение длины - в _bound_history)."""
+        return v if isinstance(v, deque) and v.maxlen is None else deque(v)
+
+    @field_validator("tool_calls", "tool_results")
+    @classmethod
+    def bound_tool_records(cls, v):
+        """Ограничивает журналы инструментов последними MAX_TOOL_RECORDS записями."""
+        if isinstance(v, deque) and v.maxlen == MAX_TOOL_RECORDS:
+            return v
+        return deque(v, maxlen=MAX_TOOL_RECORDS)
+
+    def model_post_init(self, __context: Any) -> None:
+        """Заполняет историю для LLM сообщениями, переданными при создании состояния."""
+        self._history.extend(map(_msg_to_dict, self.messages))
+        self._bound_history()
+
+    def _bound_history(self) -> None:
+        """
+        Ограничивает историю MAX_HISTORY_MESSAGES сообщениями.
+
+        Вытесняется самое старое сообщение после ведущих системных (промпт агента,
+        краткое содержание): deque(maxlen) выбросил бы именно системный промпт.
+        """
+        while len(self.messages) > MAX_HISTORY_MESSAGES:
+            head = 0
+            while head < len(self._history) and self._history[head]["role"] == MessageRole.SYSTEM.value:
+                head += 1
+            # Если вся история из системных сообщений, сохраняется хотя бы первое
+            index = head if head < len(self.messages) else 1
+            del self.messages[index]
+            del self._history[index]
+
+    def add_message(self, message: Message) -> Message:
+        """Добавляет готовое сообщение в историю и в кэш истории для LLM."""
         self.messages.append(message)
+        self._history.append(_msg_to_dict(message))
+        self._bound_history()
         self.updated_at = datetime.now()
         return message
 
-    def add_assistant_message(self, content: str) -> Message:
-        """Добавляет сообщение ассистента в историю."""
-        message = Message(role=MessageRole.ASSISTANT, content=content)
+    def _append(self, role: MessageRole, content: str) -> Message:
+        """Создает сообщение без повторной валидации и добавляет его в историю и кэш истории за один шаг."""
+        timestamp_ns = time.time_ns()
+        message = Message.model_construct(
+            role=role,
+            content=MessageContent(text=content),
+            timestamp_ns=timestamp_ns,
+            message_id=f"msg_{uuid4().hex}"
+        )
         self.messages.append(message)
-        self.updated_at = datetime.now()
+        self._history.append({"role": role.value, "content": content})
+        self._bound_history()
+        self.updated_at = datetime.fromtimestamp(timestamp_ns / 1e9)
         return message
 
+    def add_user_message(self, content: str) -> Message:
+        """Добавляет сообщение пользователя в историю."""
+        return self._append(MessageRole.USER, content)
+
+    def add_assistant_message(self, content: str) -> Message:
+        """Добавляет сообщение ассистента в историю."""
+        return self._append(MessageRole.ASSISTANT, content)
+
     def add_system_message(self, content: str) -> Message:
         """Добавляет системное сообщение в историю."""
-        message = Message(role=MessageRole.SYSTEM, content=content)
-        self.messages.append(message)
-        self.updated_at = datetime.now()
-        return message
+        return self._append(MessageRole.SYSTEM, content)
 
     def add_tool_call(self, tool_name: str, arguments: Dict[str, Any]) -> ToolCall:
         """Регистрирует вызов инструмента."""
@@ -97,6 +181,20 @@ class AgentState(BaseModel):
         self.updated_at = datetime.now()
         return tool_call
 
+    def extend_tool_calls(self, pairs: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """Регистрирует несколько вызовов инструментов за один раз."""
+        if not pairs:
+            return
+        self.tool_calls.extend(ToolCall(tool_name=name, arguments=args) for name, args in pairs)
+        self.updated_at = datetime.now()
+
+    def apply(self, event: TurnEvent) -> None:
+        """Применяет событие хода к состоянию."""
+        if event.kind == "assistant_message":
+            self.add_assistant_message(event.content)
+        elif event.kind == "tool_call":
+            self.add_tool_call(event.tool_name, event.arguments)
+
     def add_tool_result(self, call_id: str, tool_name: str, result: Any,
                         success: bool = True, error: Optional[str] = None,
                         execution_time: float = 0.0) -> ToolResult:
@@ -115,18 +213,61 @@ class AgentState(BaseModel):
 
     def get_conversation_history(self) -> List[Dict[str, str]]:
         """Возвращает историю диалога в формате, подходящем для LLM."""
-        return [
-            {"role": msg.role, "content": msg.content.text if isinstance(msg.content, MessageContent) else msg.content}
-            for msg in self.messages
-        ]
+        return list(self._history)
+
+    def get_windowed_history(self, max_tokens: int) -> List[Dict[str, str]]:
+        """
+        Возвращает хвост истории для LLM, укладывающийся в бюджет токенов.
+
+        Системные сообщения в начале истории (промпт, краткое содержание) сохраняются всегда,
+        остальные сообщения набираются с конца, пока не исчерпан бюджет; последнее
+        сообщение включается в любом случае.
+        """
+        history = list(self._history)
+        head = 0
+        while head < len(history) and history[head]["role"] == MessageRole.SYSTEM.value:
+            head += 1
+
+        budget = max_tokens - sum(count_tokens(msg["content"]) for msg in history[:head])
+        start = len(history)
+        while start > head:
+            cost = count_tokens(history[start - 1]["content"])
+            if cost > budget:
+                break
+            budget -= cost
+            start -= 1
+
+        if start == len(history) and start > head:
+            start -= 1
+        return history[:head] + history[start:]
 
     def get_last_n_messages(self, n: int) -> List[Message]:
         """Возвращает последние N сообщений."""
-        return self.messages[-n:] if len(self.messages) >= n else self.messages[:]
+        messages = list(self.messages)
+        return messages[-n:] if len(messages) >= n else messages
+
+    def summarize_oldest(self, count: int, summary: str, keep: int = 0) -> None:
+        """
+        Заменяет count самых старых сообщений одним системным сообщением с их кратким содержанием.
+
+        Первые keep сообщений (например, системный промпт) остаются на своих местах.
+        """
+        kept = [(self.messages.popleft(), self._history.popleft()) for _ in range(min(keep, len(self.messages)))]
+        for _ in range(min(count, len(self.messages))):
+            self.messages.popleft()
+            self._history.popleft()
+        message = Message(role=MessageRole.SYSTEM, content=summary)
+        self.messages.appendleft(message)
+        self._history.appendleft(_msg_to_dict(message))
+        for message, entry in reversed(kept):
+            self.messages.appendleft(message)
+            self._history.appendleft(entry)
+        self.updated_at = datetime.now()
 
     def clear_history(self) -> None:
         """Очищает историю диалога и инструментов."""
-        self.messages = []
-        self.tool_calls = []
-        self.tool_results = []
+        self.messages.clear()
+        self._history.clear()
+        self.tool_calls.clear()
+        self.tool_results.clear()
         self.updated_at = datetime.now()
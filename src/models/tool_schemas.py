@@ -1,10 +1,13 @@
 """Схемы данных для криптовалютных инструментов агента."""
 
 from typing import List, Dict, Optional, Any, Union
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field, model_validator
 from datetime import datetime
 from enum import Enum
 import time
+from uuid import uuid4
+
+from .base import TimestampedModel
 
 
 class ToolType(str, Enum):
@@ -43,18 +46,18 @@ class TokenPriceRequest(BaseModel):
     symbol: str = Field(..., description="Символ токена (например, BTC, ETH)")
 
 
-class TokenPriceResponse(BaseModel):
+class TokenPriceResponse(TimestampedModel):
     """Ответ с ценой токена."""
     symbol: str
     price: Optional[float] = None
     currency: str = "USD"
     error: Optional[str] = None
-    timestamp: datetime = Field(default_factory=datetime.now)
     success: bool = True
     
-    @validator('success', always=True)
-    def check_success(cls, v, values):
-        return values.get('error') is None and values.get('price') is not None
+    @model_validator(mode="after")
+    def check_success(self):
+        self.success = self.error is None and self.price is not None
+        return self
 
 
 # === Модели для get_trending_coins ===
@@ -80,16 +83,16 @@ class TrendingCoin(BaseModel):
     platforms: Optional[Dict[str, str]] = None
 
 
-class TrendingCoinsResponse(BaseModel):
+class TrendingCoinsResponse(TimestampedModel):
     """Ответ со списком трендовых монет."""
     coins: List[TrendingCoin] = Field(default_factory=list)
-    timestamp: datetime = Field(default_factory=datetime.now)
     error: Optional[str] = None
     success: bool = True
     
-    @validator('success', always=True)
-    def check_success(cls, v, values):
-        return values.get('error') is None
+    @model_validator(mode="after")
+    def check_success(self):
+        self.success = self.error is None
+        return self
 
 
 # === Модели для search_cryptocurrencies ===
@@ -108,12 +111,11 @@ class SearchCryptoResult(BaseModel):
     market_cap_rank: Optional[int] = None
 
 
-class SearchCryptoResponse(BaseModel):
+class SearchCryptoResponse(TimestampedModel):
     """Ответ с результатами поиска криптовалют."""
     results: List[SearchCryptoResult] = Field(default_factory=list)
     query: str
     total_found: int
-    timestamp: datetime = Field(default_factory=datetime.now)
     error: Optional[str] = None
     success: bool = True
 
@@ -140,13 +142,12 @@ class ProtocolTVLData(BaseModel):
     chains: List[ChainTVLData] = Field(default_factory=list)
 
 
-class ProtocolAnalysisResponse(BaseModel):
+class ProtocolAnalysisResponse(TimestampedModel):
     """Ответ с анализом протокола."""
     protocol_id: str
     protocol_label: str
     market_cap: Optional[float] = None
     tvl_data: ProtocolTVLData
-    timestamp: datetime = Field(default_factory=datetime.now)
     error: Optional[str] = None
     success: bool = True
 
@@ -172,7 +173,7 @@ class PoolData(BaseModel):
     sells: Optional[int] = None
 
 
-class PoolsAnalysisResponse(BaseModel):
+class PoolsAnalysisResponse(TimestampedModel):
     """Ответ с анализом пулов протокола."""
     network: str
     protocol_id: str
@@ -183,7 +184,6 @@ class PoolsAnalysisResponse(BaseModel):
     top_pools: List[PoolData] = Field(default_factory=list)
     total_volume_24h: float
     average_volume_per_pool: float
-    timestamp: datetime = Field(default_factory=datetime.now)
     error: Optional[str] = None
     success: bool = True
 
@@ -219,7 +219,7 @@ class VolumePoint(BaseModel):
     date: datetime
 
 
-class TokenHistoricalResponse(BaseModel):
+class TokenHistoricalResponse(TimestampedModel):
     """Ответ с историческими данными токена."""
     token_id: str
     token_label: str
@@ -236,7 +236,6 @@ class TokenHistoricalResponse(BaseModel):
     current_volume: float
     avg_volume: float
     prices: Optional[List[PricePoint]] = None  # Можно включать полные данные при необходимости
-    timestamp: datetime = Field(default_factory=datetime.now)
     error: Optional[str] = None
     success: bool = True
 
@@ -265,7 +264,7 @@ class ConcentrationLevel(str, Enum):
     LOW = "Низкая"
 
 
-class HoldersAnalysisResponse(BaseModel):
+class HoldersAnalysisResponse(TimestampedModel):
     """Ответ с анализом держателей токена."""
     token_address: str
     token_label: str
@@ -275,7 +274,6 @@ class HoldersAnalysisResponse(BaseModel):
     top50_percentage: float
     concentration: ConcentrationLevel
     total_holders_analyzed: int
-    timestamp: datetime = Field(default_factory=datetime.now)
     error: Optional[str] = None
     success: bool = True
 
@@ -297,27 +295,25 @@ class NewsArticle(BaseModel):
     summary: Optional[str] = None
 
 
-class CryptoNewsResponse(BaseModel):
+class CryptoNewsResponse(TimestampedModel):
     """Ответ с новостями о криптовалютах."""
     query: str
     articles: List[NewsArticle] = Field(default_factory=list)
     total_found: int
-    timestamp: datetime = Field(default_factory=datetime.now)
     error: Optional[str] = None
     success: bool = True
 
 
 # === Общие модели для работы с инструментами ===
 
-class ToolRequest(BaseModel):
+class ToolRequest(TimestampedModel):
     """Обобщенная модель запроса к инструменту."""
     tool_type: ToolType
-    request_id: str = Field(default_factory=lambda: f"req_{datetime.now().timestamp()}")
+    request_id: str = Field(default_factory=lambda: f"req_{uuid4().hex}")
     params: Dict[str, Any]
-    timestamp: datetime = Field(default_factory=datetime.now)
 
 
-class ToolResponse(BaseModel):
+class ToolResponse(TimestampedModel):
     """Обобщенная модель ответа от инструмента."""
     tool_type: ToolType
     request_id: str
@@ -325,8 +321,7 @@ class ToolResponse(BaseModel):
     data: Optional[Any] = None
     error: Optional[str] = None
     execution_time: float = 0.0
-    timestamp: datetime = Field(default_factory=datetime.now)
 
     def set_execution_time(self, start_time: float):
-        """Устанавливает время выполнения инструмента."""
-        self.execution_time = time.time() - start_time
\ No newline at end of file
+        """Устанавливает время выполнения инструмента (start_time - значение time.perf_counter())."""
+        self.execution_time = time.perf_counter() - start_time
\ No newline at end of file
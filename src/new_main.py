@@ -1,23 +1,32 @@
 """Основной файл мультиагентной системы криптоанализа."""
 
-import json
 import asyncio
+import importlib.util
+import re
 import sys
 import time
-from typing import List, Dict, Any
+from collections import Counter
+from typing import List, Dict, Any, Optional, Tuple
 
-from rich.console import Console
+from rich.console import Console, Group, RenderableType
+from rich.text import Text
 from rich import print as rprint
 
-from config.settings import setup_environment, OPENAI_API_KEY
-from core.multi_flow import MultiAgentSystem, create_multi_agent_system
+from config.settings import setup_environment, FORMATTER_LLM_MODEL, OPENAI_API_KEY
+from core.batch import get_batch_results, submit_batch
+from core.cache import sweep_caches_periodically
+from core.llm import LLM_RESPONSE_CACHE, cached_astream, telemetry_summary, warm_up_llm_connection
+from core.multi_flow import MultiAgentSystem, build_format_prompt, create_multi_agent_system, make_llm, close_llm_client
+from tools import close_session
 from ui.interface import (
     display_welcome,
-    display_response,
-    get_multiline_input,
+    display_response_stream,
+    get_multiline_input_async,
     display_thinking,
     display_exit_message,
     display_separator,
+    display_turn_summary,
+    SEPARATOR,
     display_research_result,
     display_task_status,
     display_agents_list
@@ -26,6 +35,19 @@ from ui.interface import (
 # Инициализация консоли
 console = Console()
 
+# Модель форматирования отчетов создается один раз и работает на общем пуле соединений
+FORMATTER_LLM = make_llm(0.2, FORMATTER_LLM_MODEL) if OPENAI_API_KEY else None
+
+# Признаки готовой markdown-разметки: заголовки, жирный текст, маркированные списки
+_MARKDOWN_RE = re.compile(r"^(#{1,3} |- )|\*\*", re.MULTILINE)
+
+# Число запросов, для которых форматирование через LLM не понадобилось
+_llm_calls_avoided = 0
+
+def _looks_like_markdown(text: Any) -> bool:
+    """Проверяет, что результат задачи уже оформлен в markdown и не требует форматирования."""
+    return isinstance(text, str) and _MARKDOWN_RE.search(text) is not None
+
 async def main():
     """Основная функция приложения."""
     # Настройка окружения
@@ -38,18 +60,30 @@ async def main():
 
     # Инициализация системы
     display_welcome()
+    # Соединение с OpenAI устанавливается в фоне, пока создается система и пользователь вводит запрос
+    warmup = asyncio.create_task(warm_up_llm_connection())
     system = create_multi_agent_system()
 
+    # Пока пользователь вводит запрос, в фоне удаляются устаревшие записи кэшей
+    sweeper = asyncio.create_task(sweep_caches_periodically())
+
     # Основной цикл
     while True:
         try:
-            user_input = get_multiline_input()
+            user_input = await get_multiline_input_async()
 
             # Выход из программы
             if user_input.lower() in ["exit", "quit", "q"]:
                 display_exit_message()
+                warmup.cancel()
+                sweeper.cancel()
+                await close_session()
+                await close_llm_client()
                 break
 
+            # Первый запрос к модели идет по уже открытому соединению
+            await warmup
+
             # Специальные команды
             if user_input.startswith('/'):
                 await handle_special_commands(user_input, system)
@@ -71,8 +105,19 @@ async def handle_special_commands(command: str, system: Any) -> None:
             rprint("[red]Укажите символ токена: /research BTC[/red]")
             return
 
-        token = parts[1].strip().upper()
-        await perform_deep_research(token, system)
+        # С флагом --batch задачи отправляются в Batch API: дешевле, но результат приходит позже
+        args = parts[1].split()
+        batch = "--batch" in args
+        args = [arg for arg in args if arg != "--batch"]
+        if not args:
+            rprint("[red]Укажите символ токена: /research [--batch] BTC[/red]")
+            return
+
+        token = args[0].upper()
+        if batch:
+            await submit_deep_research_batch(token, system)
+        else:
+            await perform_deep_research(token, system)
 
     elif command == "/tasks":
         display_all_tasks(system)
@@ -85,179 +130,224 @@ async def handle_special_commands(command: str, system: Any) -> None:
         if len(parts) < 2:
             rprint("[red]Укажите ID задачи: /task TASK_ID[/red]")
             return
-        display_task_status(system.get_task_status(parts[1]))
+        if parts[1] in system.global_state.get("batches", {}):
+            await display_research_batch(parts[1], system)
+        else:
+            display_task_status(system.get_task_status(parts[1]))
 
     else:
         rprint(f"[red]Неизвестная команда: {command}[/red]")
 
 async def process_user_request(input_text: str, system: Any) -> None:
     """Обрабатывает пользовательский запрос через мультиагентную систему."""
-    start_time = time.time()
-
-    # Отправляем запрос супервизору
-    with display_thinking("Супервизор планирует задачи..."):
-        supervisor_initial_response = await system.process_user_input(input_text)
+    global _llm_calls_avoided
+    start_ns = time.perf_counter_ns()
 
-    # Извлекаем ID задач из ответа супервизора
-    task_ids = []
-    for task_id, task in system.tasks.items():
-        if task.status == "pending" and task.created_at.timestamp() > start_time:
-            task_ids.append(task_id)
-
-    # Параллельно выполняем все созданные задачи
-    with display_thinking("Выполнение запланированных задач..."):
-        await system.execute_all_pending_tasks()
+    # Супервизор планирует задачи, система сразу выполняет план и возвращает ID созданных задач
+    with display_thinking("Супервизор планирует и выполняет задачи..."):
+        supervisor_initial_response, task_ids = await system.process_user_input(input_text)
 
     # Если были созданы задачи
     if task_ids:
-        completed_task_ids = []
-        for task_id in task_ids:
-            if task_id in system.tasks and system.tasks[task_id].status == "completed":
-                completed_task_ids.append(task_id)
-
-        if completed_task_ids:
-            with display_thinking("Форматирование отчета с помощью LLM..."):
-                # Собираем результаты задач
-                task_results = {}
-                for task_id in completed_task_ids:
-                    task = system.tasks[task_id]
-                    task_results[task.title] = task.result
-
+        # Каждая задача извлекается из словаря один раз
+        tasks = [task for task in map(system.tasks.get, task_ids) if task is not None]
+        completed_tasks = [task for task in tasks if task.status == "completed"]
+
+        if completed_tasks:
+            # Собираем результаты задач
+            task_results = {task.title: task.result for task in completed_tasks}
+
+            single_result = next(iter(task_results.values())) if len(task_results) == 1 else None
+            if _looks_like_markdown(single_result):
+                # Единственный результат уже оформлен агентом - вызов LLM не нужен
+                _llm_calls_avoided += 1
+                final_response_to_display = single_result
+            else:
                 # Подготавливаем данные для LLM
-                from langchain_openai import ChatOpenAI
-                from config.settings import LLM_MODEL
-
-                formatter_llm = ChatOpenAI(model=LLM_MODEL, temperature=0.2)
-
-                format_prompt = f"""
-                # Задача: Форматирование аналитического отчета
-
-                Создай хорошо структурированный, профессиональный отчет на основе следующих данных анализа.
-
-                ## Инструкции по форматированию:
-                - Используй заголовки и подзаголовки (##, ###)
-                - Выделяй важные цифры и результаты **жирным шрифтом**
-                - Используй эмодзи в начале разделов для улучшения восприятия
-                - Организуй данные в логические разделы
-                - Добавь краткое резюме в начале
-
-                ## Исходный запрос:
-                {input_text}
-
-                ## Данные анализа:
-                {json.dumps(task_results, indent=2, ensure_ascii=False)}
-
-                Форматируй отчет так, чтобы он был максимально информативным и легко читаемым.
-                """
+                format_prompt = build_format_prompt(input_text, task_results)
 
+                # Отчет отображается по мере генерации, а не после полного ответа модели
                 try:
-                    response = await formatter_llm.ainvoke([{"role": "user", "content": format_prompt}])
-                    final_response_to_display = response.content
+                    await display_response_stream(
+                        cached_astream(FORMATTER_LLM, [{"role": "user", "content": format_prompt}])
+                    )
+                    final_response_to_display = None
                 except Exception as e:
                     rprint(f"[red]Ошибка при форматировании: {e}[/red]")
                     final_response_to_display = "\n\n".join([str(result) for result in task_results.values()])
         else:
             # Если нет успешно выполненных задач
             successful_results = []
-            for task_id in task_ids:
-                if task_id in system.tasks:
-                    task = system.tasks[task_id]
-                    status_info = f"Статус задачи: {task.status}"
-                    if task.result:
-                        successful_results.append(f"{status_info}\n{str(task.result)}")
-                    else:
-                        successful_results.append(f"{status_info}\nРезультат отсутствует")
+            for task in tasks:
+                status_info = f"Статус задачи: {task.status}"
+                if task.result:
+                    successful_results.append(f"{status_info}\n{str(task.result)}")
+                else:
+                    successful_results.append(f"{status_info}\nРезультат отсутствует")
 
             final_response_to_display = "\n\n".join(successful_results)
     else:
         # Если супервизор не создал задач
         final_response_to_display = supervisor_initial_response
 
-    # Отображаем финальный ответ
-    display_response(final_response_to_display)
-
-    total_time = time.time() - start_time
-    rprint(f"[dim]Общее время обработки: {total_time:.2f} сек[/dim]")
-    display_separator()
-    display_system_stats(system)
+    total_time = (time.perf_counter_ns() - start_ns) / 1e9
 
-async def perform_deep_research(token: str, system: Any) -> None:
-    """Выполняет глубокое исследование токена через мультиагентную систему."""
-    start_time = time.time()
+    # Финальный ответ (если отчет не выведен потоком), время и статистика выводятся одним вызовом
+    footer = [Text(f"Общее время обработки: {total_time:.2f} сек", style="dim"), SEPARATOR]
+    footer.extend(_render_system_stats(system))
+    display_turn_summary(final_response_to_display, footer)
 
-    # Создаем задачи исследования
-    research_tasks = [
+def _research_tasks(token: str) -> List[Tuple[str, str]]:
+    """Задачи глубокого исследования токена: (ID агента, описание задачи)."""
+    return [
         ("market_analyst", f"Проанализировать рыночные данные для {token}"),
         ("technical_analyst", f"Сделать технический анализ {token}"),
         ("news_researcher", f"Найти последние новости о {token}"),
         ("protocol_analyst", f"Проанализировать протоколы для {token}")
     ]
 
-    # Создаем и выполняем задачи
-    task_ids = []
-    for agent_id, description in research_tasks:
-        task_id = system.agents["supervisor"].process_user_input(
-            f"Добавить задачу для {agent_id}: {description}"
-        )
-        task_ids.append(task_id)
+async def perform_deep_research(token: str, system: Any) -> None:
+    """Выполняет глубокое исследование токена через мультиагентную систему."""
+    start_ns = time.perf_counter_ns()
+
+    # Создаем задачи исследования
+    research_tasks = _research_tasks(token)
+
+    # Задачи исследования известны заранее: создаем их сразу, без вызовов супервизора,
+    # и выполняем одной волной - все четыре агента работают параллельно
+    task_ids = system.create_tasks([
+        (agent_id, f"{agent_id}: {token}", description)
+        for agent_id, description in research_tasks
+    ])
 
-    # Запускаем выполнение
     with display_thinking(f"Выполнение исследования {token}..."):
-        results = await system.execute_all_pending_tasks()
+        await system.execute_all_pending_tasks()
 
-    # Объединяем результаты
-    merged = system.agents["supervisor"].process_user_input(
-        f"Объединить результаты задач {', '.join(task_ids)}"
-    )
+        # ID задач известны: отчет строится напрямую, без еще одного хода супервизора
+        merged = await system.merge_results(task_ids, f"Исследование {token}")
 
     # Отображаем результаты
-    display_research_result(merged, token)
-    rprint(f"[dim]Исследование выполнено за {time.time()-start_time:.2f} сек[/dim]")
+    display_research_result(merged["structured_report"], token)
+    rprint(f"[dim]Исследование выполнено за {(time.perf_counter_ns() - start_ns) / 1e9:.2f} сек[/dim]")
     display_separator()
 
-def display_system_stats(system: Any) -> None:
-    """Отображает статистику работы системы."""
+async def submit_deep_research_batch(token: str, system: Any) -> None:
+    """Отправляет задачи исследования токена одним пакетом в OpenAI Batch API."""
+    research_tasks = _research_tasks(token)
+
+    # В пакетном режиме агенты не вызывают инструменты: каждый отвечает по своему системному промпту
+    requests = [
+        {
+            "custom_id": agent_id,
+            "messages": [
+                {"role": "system", "content": system.agents[agent_id].system_prompt},
+                {"role": "user", "content": description}
+            ]
+        }
+        for agent_id, description in research_tasks
+    ]
+
+    with display_thinking(f"Отправка пакета исследования {token}..."):
+        batch_id = await submit_batch(requests)
+
+    system.global_state.setdefault("batches", {})[batch_id] = token
+    rprint(f"[green]Пакет исследования {token} отправлен: {batch_id}[/green]")
+    rprint(f"[dim]Результаты будут доступны в течение 24 часов: /task {batch_id}[/dim]")
+    display_separator()
+
+async def display_research_batch(batch_id: str, system: Any) -> None:
+    """Отображает результаты пакета исследования (или его текущий статус)."""
+    token = system.global_state["batches"][batch_id]
+    with display_thinking(f"Проверка пакета {batch_id}..."):
+        info = await get_batch_results(batch_id)
+
+    if info["status"] != "completed":
+        rprint(f"[yellow]Пакет {batch_id} ({token}): {info['status']}[/yellow]")
+        return
+
+    report = "\n\n".join(f"## {agent_id}\n\n{content}" for agent_id, content in info["results"].items())
+    display_research_result(report, token)
+
+# Версия задач системы на момент последнего вывода статистики
+_last_stats_version: Optional[int] = None
+
+def _render_system_stats(system: Any) -> List[RenderableType]:
+    """Формирует блок статистики системы (пустой, если задачи не изменились с прошлого вывода)."""
+    global _last_stats_version
+    if system.tasks_version == _last_stats_version:
+        return []
+    _last_stats_version = system.tasks_version
+
+    # Статусы задач считаются за один проход
+    status_counts = Counter(t.status for t in system.tasks.values())
     stats = {
         "Агентов": len(system.agents),
         "Всего задач": len(system.tasks),
-        "Выполнено": sum(1 for t in system.tasks.values() if t.status == "completed"),
-        "В процессе": sum(1 for t in system.tasks.values() if t.status == "in_progress"),
-        "Ошибок": sum(1 for t in system.tasks.values() if t.status == "failed")
+        "Выполнено": status_counts["completed"],
+        "В процессе": status_counts["in_progress"],
+        "Ошибок": status_counts["failed"],
+        "Кэш ответов LLM (попадания/промахи)": f"{LLM_RESPONSE_CACHE.hits}/{LLM_RESPONSE_CACHE.misses}",
+        "Вызовов LLM сэкономлено": _llm_calls_avoided
     }
 
-    rprint("[bold cyan]Статистика системы:[/bold cyan]")
-    for k, v in stats.items():
-        rprint(f"  [bold]{k}:[/bold] {v}")
-    display_separator()
+    # Задержка и токены считаются по ограниченному буферу последних вызовов модели
+    telemetry = telemetry_summary()
+    if telemetry:
+        stats["Вызовов LLM (из кэша)"] = f"{telemetry['calls']} ({telemetry['cache_hits']})"
+        stats["Задержка LLM (средняя/p95)"] = (
+            f"{telemetry['mean_latency_s']:.2f}/{telemetry['p95_latency_s']:.2f} сек"
+        )
+        stats["Токенов (вход/выход)"] = f"{telemetry['tokens_in']}/{telemetry['tokens_out']}"
+
+    lines = ["[bold cyan]Статистика системы:[/bold cyan]"]
+    lines.extend(f"  [bold]{k}:[/bold] {v}" for k, v in stats.items())
+    return [Text.from_markup("\n".join(lines)), SEPARATOR]
+
+def display_system_stats(system: Any) -> None:
+    """Отображает статистику работы системы (только если задачи изменились с прошлого вывода)."""
+    renderables = _render_system_stats(system)
+    if renderables:
+        # Блок выводится одним вызовом: терминал перерисовывается один раз, а не на каждую строку
+        console.print(Group(*renderables))
 
 def display_all_tasks(system: Any) -> None:
     """Отображает список всех задач системы."""
-    rprint("[bold cyan]Список задач:[/bold cyan]")
-    for task_id, task in system.tasks.items():
-        status_color = {
-            "completed": "green",
-            "in_progress": "yellow",
-            "failed": "red"
-        }.get(task.status, "white")
+    status_colors = {
+        "completed": "green",
+        "in_progress": "yellow",
+        "failed": "red"
+    }
+    separator = "\n" + "-" * 80 + "\n"
 
-        rprint(f"  [bold]{task_id}[/bold] - {task.title}")
-        rprint(f"  Статус: [{status_color}]{task.status}[/{status_color}]")
-        rprint(f"  Агент: [blue]{task.assigned_agent_id}[/blue]")
-        display_separator()
+    # Список собирается целиком и выводится одним вызовом, а не несколькими на каждую задачу
+    lines = ["[bold cyan]Список задач:[/bold cyan]"]
+    for task_id, task in system.tasks.items():
+        status_color = status_colors.get(task.status, "white")
+        lines.append(f"  [bold]{task_id}[/bold] - {task.title}")
+        lines.append(f"  Статус: [{status_color}]{task.status}[/{status_color}]")
+        lines.append(f"  Агент: [blue]{task.assigned_agent_id}[/blue]")
+        lines.append(separator)
+    rprint("\n".join(lines))
 
 def display_task_execution_results(results: List[Dict[str, Any]]) -> None:
     """Отображает результаты выполнения задач."""
-    rprint("[bold cyan]Результаты выполнения задач:[/bold cyan]")
+    lines = ["[bold cyan]Результаты выполнения задач:[/bold cyan]"]
     for result in results:
         if isinstance(result.get('result'), Exception):
-            rprint(f"  [red]Ошибка в задаче {result['task_id']}: {result['result']}[/red]")
+            lines.append(f"  [red]Ошибка в задаче {result['task_id']}: {result['result']}[/red]")
         else:
-            rprint(f"  [green]Задача {result['task_id']} выполнена успешно[/green]")
+            lines.append(f"  [green]Задача {result['task_id']} выполнена успешно[/green]")
+    rprint("\n".join(lines))
     display_separator()
 
 if __name__ == "__main__":
+    # uvloop быстрее обрабатывает сокеты event loop; на Windows пакета нет - стандартный asyncio
+    run = asyncio.run
+    if importlib.util.find_spec("uvloop") is not None:
+        import uvloop
+        run = uvloop.run
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         console.print("\n[bold red]Программа завершена[/bold red]")
         sys.exit(0)
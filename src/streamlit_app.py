@@ -1,51 +1,96 @@
 import streamlit as st
 import asyncio
+import os
+import traceback
 from datetime import datetime
+from pathlib import Path
 import re
 import time
-import json
 
 
-from config.settings import setup_environment, APP_NAME, APP_COLOR, OPENAI_API_KEY
-from core.agent import create_agent
-
 from config.settings import (
     setup_environment,
     APP_NAME,
     APP_COLOR,
+    FORMATTER_LLM_MODEL,
     OPENAI_API_KEY,
     COINGECKO_API_KEY,
     BITQUERY_API_KEY
 )
+from core.agent import create_agent
+from core.llm import cached_astream, make_llm
+from core.multi_flow import build_format_prompt, create_multi_agent_system
+
+# Число последних сообщений, отображаемых в чате (ранние - по кнопке)
+VISIBLE_MESSAGES = 20
+
+# Стили приложения
+CSS_PATH = Path(__file__).parent / "assets" / "app.css"
+
+@st.cache_data
+def load_css() -> str:
+    """Возвращает стили приложения."""
+    return CSS_PATH.read_text(encoding="utf-8")
+
+# Иконки сообщений по ролям
+MESSAGE_ICONS = {"user": "👤", "assistant": "🤖"}
+
+def make_message(role, content):
+    """Создает сообщение чата вместе с его HTML-разметкой (чтобы не строить ее при каждом перезапуске)."""
+    icon = MESSAGE_ICONS.get(role, "ℹ️")
+    html = (
+        f"<div class='chat-row'><div class='chat-icon'>{icon}</div>"
+        f"<div class='chat-message {role}'>{content}</div></div>"
+    )
+    return {"role": role, "content": content, "html": html}
+
+# Переменные окружения с API-ключами
+API_KEY_ENV = {
+    "openai": "OPENAI_API_KEY",
+    "coingecko": "COINGECKO_API_KEY",
+    "bitquery": "BITQUERY_API_KEY"
+}
+
+def resolve_api_keys():
+    """
+    Возвращает API-ключи сессии: введенные пользователем или из переменных окружения.
+
+    Ключи определяются один раз и хранятся в st.session_state.resolved_api_keys,
+    поэтому повторные запуски скрипта не обращаются к os.environ.
+    """
+    if "resolved_api_keys" not in st.session_state:
+        entered = st.session_state.get("api_keys", {})
+        st.session_state.resolved_api_keys = {
+            name: entered.get(name, os.environ.get(env_name, ""))
+            for name, env_name in API_KEY_ENV.items()
+        }
+    return st.session_state.resolved_api_keys
+
+def save_api_keys(keys, skip_empty=False):
+    """
+    Сохраняет введенные API-ключи в сессии и переменных окружения.
+
+    Args:
+        keys: Ключи по именам из API_KEY_ENV
+        skip_empty: Не изменять переменные окружения для пустых ключей
+    """
+    st.session_state.api_keys = keys
+    st.session_state.resolved_api_keys = dict(keys)
+    for name, value in keys.items():
+        if skip_empty and not value:
+            continue
+        # Переменная окружения меняется только при изменении ключа
+        if os.environ.get(API_KEY_ENV[name]) != value:
+            os.environ[API_KEY_ENV[name]] = value
 
 def check_api_keys():
     """Проверяет наличие всех необходимых API-ключей."""
     # Проверяем только обязательный ключ OpenAI API
-    keys_set = bool(OPENAI_API_KEY)
-
-    # Проверяем ключи в session_state (на случай, если пользователь их уже ввел)
-    if not keys_set and 'api_keys' in st.session_state and 'openai' in st.session_state.api_keys:
-        keys_set = bool(st.session_state.api_keys['openai'])
-
-    return keys_set
+    return bool(OPENAI_API_KEY or get_api_key("openai"))
 
 def get_api_key(key_name):
     """Возвращает API ключ из session_state или из переменных окружения."""
-    if 'api_keys' in st.session_state and key_name in st.session_state.api_keys:
-        return st.session_state.api_keys[key_name]
-
-    # Иначе возвращаем значение из переменных окружения
-    import os
-    key_mapping = {
-        "openai": "OPENAI_API_KEY",
-        "coingecko": "COINGECKO_API_KEY",
-        "bitquery": "BITQUERY_API_KEY"
-    }
-
-    if key_name in key_mapping:
-        return os.environ.get(key_mapping[key_name], "")
-
-    return ""
+    return resolve_api_keys().get(key_name, "")
 
 def show_api_key_form():
     """Отображает форму для ввода API-ключей."""
@@ -87,20 +132,12 @@ def show_api_key_form():
                 st.error("⚠️ OpenAI API ключ обязателен для работы приложения!")
                 return False
 
-            # Сохраняем ключи в session_state
-            st.session_state.api_keys = {
+            # Сохраняем ключи в session_state и переменных окружения
+            save_api_keys({
                 "openai": openai_key,
                 "coingecko": coingecko_key,
                 "bitquery": bitquery_key
-            }
-
-            # Устанавливаем ключи в переменные окружения
-            import os
-            os.environ["OPENAI_API_KEY"] = openai_key
-            if coingecko_key:
-                os.environ["COINGECKO_API_KEY"] = coingecko_key
-            if bitquery_key:
-                os.environ["BITQUERY_API_KEY"] = bitquery_key
+            }, skip_empty=True)
 
             st.success("✅ Ключи успешно сохранены!")
             return True
@@ -133,7 +170,6 @@ if not keys_ready:
 
 # Установка переменных состояния сессии
 if 'agent' not in st.session_state:
-    from core.multi_flow import create_multi_agent_system
     st.session_state.agent = create_multi_agent_system()
 
 if 'messages' not in st.session_state:
@@ -160,158 +196,11 @@ if 'chat_to_rename' not in st.session_state:
 if 'show_settings' not in st.session_state:
     st.session_state.show_settings = False
 
-# CSS для улучшения внешнего вида
-st.markdown("""
-<style>
-
-    /* Стили для формы переименования */
-    .sidebar .stForm {
-        background-color: #f1f3f4;
-        padding: 0.5rem;
-        border-radius: 0.3rem;
-        margin-bottom: 0.5rem;
-    }
-
-    .sidebar .stForm .stButton {
-        margin-top: 0;
-    }
-
-    .sidebar .stTextInput > div > div > input {
-        font-size: 0.9rem;
-        padding: 0.3rem;
-    }
-
-    /* Стили для сайдбара */
-    .sidebar .sidebar-content {
-        background-color: #f8f9fa;
-    }
-
-    /* Стили для кнопок в сайдбаре */
-    .sidebar .stButton > button {
-        background-color: transparent;
-        border: none;
-        text-align: left;
-        padding: 0.5rem 0;
-        color: #333;
-        width: 100%;
-    }
-
-    .sidebar .stButton > button:hover {
-        background-color: #e9ecef;
-        border-radius: 0.3rem;
-    }
-
-    /* Основные стили */
-    .main .block-container {
-        padding-top: 2rem;
-        padding-bottom: 2rem;
-    }
-
-    /* Стили для кнопок */
-    .stButton > button {
-        width: 100%;
-        height: 2.75rem;
-        padding: 0 0.5rem;
-        white-space: nowrap;
-    }
-
-    /* Одинаковые колонки для кнопок */
-    .button-cols {
-        min-width: 12rem;
-    }
-
-    /* Стили сообщений */
-    .chat-message {
-        padding: 1rem;
-        border-radius: 0.5rem;
-        margin-bottom: 0.5rem;
-        display: flex;
-        flex-direction: column;
-    }
-
-    .chat-message.user {
-        background-color: #E3F2FD;
-        border-left: 4px solid #1E88E5;
-        margin-left: 60px;
-    }
-
-    .chat-message.assistant {
-        background-color: #F5F5F5;
-        border-left: 4px solid #7E57C2;
-        margin-right: 60px;
-    }
-
-    .chat-message.system {
-        background-color: #FFF8E1;
-        border-left: 4px solid #FFC107;
-    }
-
-    .message-content {
-        display: flex;
-        margin-bottom: 0.5rem;
-    }
-
-    .message-content img {
-        width: 2.5rem;
-        height: 2.5rem;
-        border-radius: 50%;
-        object-fit: cover;
-        margin-right: 1rem;
-    }
-
-    .message-content p {
-        margin: 0;
-    }
-
-    /* Прикрепить поле ввода к низу */
-    .input-container {
-        position: fixed;
-        bottom: 0;
-        left: 0;
-        right: 0;
-        padding: 1rem;
-        background-color: white;
-        z-index: 100;
-        border-top: 1px solid #ddd;
-    }
-
-    /* Добавить отступ для сообщений, чтобы они не перекрывались с полем ввода */
-    .chat-window {
-        margin-bottom: 5rem;
-    }
+if 'show_all_messages' not in st.session_state:
+    st.session_state.show_all_messages = False
 
-    /* Стили для спиннера в области ввода */
-        .loading-spinner {
-            display: inline-block;
-            width: 20px;
-            height: 20px;
-            margin-left: 10px;
-            border: 3px solid rgba(0, 0, 0, 0.1);
-            border-radius: 50%;
-            border-top-color: #2196F3;
-            animation: spin 1s ease-in-out infinite;
-    }
-
-    @keyframes spin {
-        to { transform: rotate(360deg); }
-    }
-
-    .input-with-spinner {
-        display: flex;
-        align-items: center;
-    }
-
-    .status-message {
-        margin-left: 10px;
-        color: #2196F3;
-        font-size: 0.9em;
-    }
-
-    /* Скрыть стандартные элементы streamlit */
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
-</style>
-""", unsafe_allow_html=True)
+# CSS для улучшения внешнего вида (файл читается один раз, а не при каждом перезапуске скрипта)
+st.markdown(f"<style>{load_css()}</style>", unsafe_allow_html=True)
 
 def create_new_chat():
     chat_id = f"chat_{st.session_state.chat_counter}"
@@ -337,73 +226,58 @@ def delete_chat(chat_id):
         st.session_state.messages = st.session_state.chats[st.session_state.current_chat_id]["messages"]
     st.rerun()
 
-def rename_chat(chat_id, new_title):
+def start_rename(chat_id):
+    st.session_state.chat_to_rename = chat_id
+
+def rename_chat(chat_id):
+    # Вызывается как обработчик формы: новое название берется из ее поля ввода
+    new_title = st.session_state.get(f"new_title_{chat_id}")
     if new_title and new_title.strip():
         st.session_state.chats[chat_id]["title"] = new_title.strip()
     st.session_state.chat_to_rename = None
-    st.rerun()
 
 # Функция для асинхронной обработки сообщений
-async def process_message(message):
+async def process_message(message, placeholder=None, status=None):
+    """
+    Обрабатывает сообщение; отчет форматировщика по мере генерации выводится в placeholder.
+
+    Если передан status (контейнер st.status), в нем отображаются этапы обработки запроса.
+    """
     try:
-        # Запоминаем время начала для отслеживания новых задач
-        start_time = time.time()
-        
-        # 1. Получаем ответ супервизора
-        initial_response = await st.session_state.agent.process_user_input(message)
-        
+        agent = st.session_state.agent
+
+        # 1. Получаем ответ (мультиагентная система сразу выполняет план
+        # и возвращает ID задач, созданных для этого запроса)
+        if hasattr(agent, 'execute_all_pending_tasks') and hasattr(agent, 'tasks'):
+            initial_response, new_tasks = await agent.process_user_input(message)
+        else:
+            initial_response, new_tasks = await agent.process_user_input(message), None
+
         # 2. Если используется мультиагентная система
-        if hasattr(st.session_state.agent, 'execute_all_pending_tasks') and hasattr(st.session_state.agent, 'tasks'):
-            # Определяем новые задачи, созданные для этого запроса
-            new_tasks = []
-            for task_id, task in st.session_state.agent.tasks.items():
-                if hasattr(task, 'created_at') and task.created_at.timestamp() > start_time - 5:
-                    new_tasks.append(task_id)
-            
+        if new_tasks is not None:
             if new_tasks:
-                # 3. Выполняем все задачи
-                await st.session_state.agent.execute_all_pending_tasks()
-                
-                # 4. Собираем результаты выполненных задач
+                # 3. Собираем результаты выполненных задач
                 tasks_results = {}
-                for task_id in new_tasks:
-                    if task_id in st.session_state.agent.tasks:
-                        task = st.session_state.agent.tasks[task_id]
-                        if task.status == "completed" and task.result:
-                            tasks_results[task.title] = task.result
+                for task in map(st.session_state.agent.tasks.get, new_tasks):
+                    if task is not None and task.status == "completed" and task.result:
+                        tasks_results[task.title] = task.result
+                    if task is not None and status is not None:
+                        status.write(f"{'✅' if task.status == 'completed' else '⚠️'} {task.title}")
                 
-                # 5. Форматируем финальный отчет
+                # 4. Форматируем финальный отчет
                 if tasks_results:
-                    from langchain_openai import ChatOpenAI
-                    from config.settings import LLM_MODEL
-                    import json
-                    
-                    formatter_llm = ChatOpenAI(model=LLM_MODEL, temperature=0.2)
-                    
-                    format_prompt = f"""
-                    # Задача: Форматирование аналитического отчета
-                    
-                    Создай хорошо структурированный, профессиональный отчет на основе следующих данных анализа.
-                    
-                    ## Инструкции по форматированию:
-                    - Используй заголовки и подзаголовки (##, ###)
-                    - Выделяй важные цифры и результаты **жирным шрифтом**
-                    - Используй эмодзи в начале разделов для улучшения восприятия
-                    - Организуй данные в логические разделы
-                    - Добавь краткое резюме в начале
-                    
-                    ## Исходный запрос:
-                    {message}
-                    
-                    ## Данные анализа:
-                    {json.dumps(tasks_results, indent=2, ensure_ascii=False)}
-                    
-                    Форматируй отчет так, чтобы он был максимально информативным и легко читаемым.
-                    """
+                    if status is not None:
+                        status.update(label=f"Выполнено задач: {len(tasks_results)} из {len(new_tasks)}. Формирование отчета...")
+                    format_prompt = build_format_prompt(message, tasks_results)
                     
                     try:
-                        response = await formatter_llm.ainvoke([{"role": "user", "content": format_prompt}])
-                        return response.content
+                        # Отчет отображается по мере генерации, а не после полного ответа модели
+                        report = ""
+                        async for chunk in cached_astream(make_llm(0.2, FORMATTER_LLM_MODEL), [{"role": "user", "content": format_prompt}]):
+                            report += chunk
+                            if placeholder is not None:
+                                placeholder.markdown(report + "▌")
+                        return report
                     except Exception as e:
                         # Если форматирование не удалось, возвращаем простое объединение
                         result_text = "# Результаты анализа\n\n"
@@ -417,30 +291,43 @@ async def process_message(message):
         # Если это не мультиагентная система или нет новых задач
         return initial_response
     except Exception as e:
-        import traceback
         return f"Произошла ошибка при обработке запроса: {str(e)}\n\n{traceback.format_exc()}"
 
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Возвращает event loop сессии Streamlit (создается при первом запросе).
+
+    Loop живет между запросами, поэтому пулы соединений с OpenAI, CoinGecko и LlamaFeed
+    не пересоздаются на каждое сообщение.
+    """
+    if "event_loop" not in st.session_state:
+        st.session_state.event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(st.session_state.event_loop)
+    return st.session_state.event_loop
+
 def process_pending_request():
     if st.session_state.thinking and hasattr(st.session_state, 'current_question'):
-        with st.spinner("ИИ обрабатывает ваш запрос..."):
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+        # Этапы обработки отображаются в st.status, отчет - под ним по мере генерации
+        status = st.status("ИИ обрабатывает ваш запрос...", expanded=False)
+        placeholder = st.empty()
+        with status:
+            loop = get_event_loop()
 
             try:
-                # Проверьте, использовать ли сохраненные API ключи
-                if 'api_keys' in st.session_state and 'openai' in st.session_state.api_keys:
-                    import os
-                    os.environ["OPENAI_API_KEY"] = st.session_state.api_keys['openai']
-
-                response = loop.run_until_complete(process_message(st.session_state.current_question))
-                st.session_state.messages.append({"role": "assistant", "content": response})
+                # Используем сохраненный ключ OpenAI (переменная меняется, только если ключ другой)
+                openai_key = get_api_key("openai")
+                if openai_key and os.environ.get("OPENAI_API_KEY") != openai_key:
+                    os.environ["OPENAI_API_KEY"] = openai_key
+
+                response = loop.run_until_complete(process_message(st.session_state.current_question, placeholder, status))
+                st.session_state.messages.append(make_message("assistant", response))
+                status.update(label="Запрос обработан", state="complete")
             except Exception as e:
-                st.session_state.messages.append({
-                    "role": "system",
-                    "content": f"⚠️ Произошла ошибка: {str(e)}"
-                })
+                status.update(label="Ошибка обработки запроса", state="error")
+                st.session_state.messages.append(make_message("system", f"⚠️ Произошла ошибка: {str(e)}"))
             finally:
-                loop.close()
+                # Готовый ответ выводится в истории сообщений
+                placeholder.empty()
                 st.session_state.thinking = False
                 if hasattr(st.session_state, 'current_question'):
                     delattr(st.session_state, 'current_question')
@@ -453,7 +340,7 @@ def handle_submit():
 
     if user_message.strip():
         # Добавляем сообщение пользователя в историю
-        st.session_state.messages.append({"role": "user", "content": user_message})
+        st.session_state.messages.append(make_message("user", user_message))
         # Синхронизируем с текущим чатом
         st.session_state.chats[st.session_state.current_chat_id]["messages"] = st.session_state.messages
 
@@ -467,7 +354,10 @@ st.title(APP_NAME)
 
 # Боковая панель с историей чатов
 # В блоке с боковой панелью
-with st.sidebar:
+# Боковая панель - фрагмент: переименование чатов и открытие настроек перезапускают только ее,
+# а не весь скрипт с историей сообщений (смена текущего чата по-прежнему обновляет все приложение)
+@st.fragment
+def render_sidebar():
     st.title("История чатов")
 
     # Кнопка для создания нового чата
@@ -501,17 +391,12 @@ with st.sidebar:
             )
 
             if st.form_submit_button("Сохранить"):
-                st.session_state.api_keys = {
+                # Обновляем ключи сессии и переменные окружения
+                save_api_keys({
                     "openai": openai_key,
                     "coingecko": coingecko_key,
                     "bitquery": bitquery_key
-                }
-
-                # Обновляем переменные окружения
-                import os
-                os.environ["OPENAI_API_KEY"] = openai_key
-                os.environ["COINGECKO_API_KEY"] = coingecko_key
-                os.environ["BITQUERY_API_KEY"] = bitquery_key
+                })
 
                 # Пересоздаем агента с новыми ключами
                 st.session_state.agent = create_agent()
@@ -527,13 +412,10 @@ with st.sidebar:
             with st.form(key=f"rename_form_{chat_id}", clear_on_submit=True):
                 col1, col2 = st.columns([4, 1])
                 with col1:
-                    new_title = st.text_input("Новое название", value=chat_data["title"],
-                                              key=f"new_title_{chat_id}", label_visibility="collapsed")
+                    st.text_input("Новое название", value=chat_data["title"],
+                                  key=f"new_title_{chat_id}", label_visibility="collapsed")
                 with col2:
-                    submit_button = st.form_submit_button("✓")
-
-                if submit_button:
-                    rename_chat(chat_id, new_title)
+                    st.form_submit_button("✓", on_click=rename_chat, args=(chat_id,))
         else:
             col1, col2, col3 = st.columns([3, 1, 1])
 
@@ -547,9 +429,7 @@ with st.sidebar:
 
             with col2:
                 # Кнопка редактирования названия
-                if st.button("✏️", key=f"edit_{chat_id}"):
-                    st.session_state.chat_to_rename = chat_id
-                    st.rerun()
+                st.button("✏️", key=f"edit_{chat_id}", on_click=start_rename, args=(chat_id,))
 
             with col3:
                 # Кнопка удаления чата (если их больше одного)
@@ -557,34 +437,31 @@ with st.sidebar:
                     if st.button("🗑️", key=f"delete_{chat_id}"):
                         delete_chat(chat_id)
 
+with st.sidebar:
+    render_sidebar()
+
 process_pending_request()
 
 # Если нет сообщений, показываем приветствие
 if not st.session_state.messages:
-    st.session_state.messages.append({
-        "role": "assistant",
-        "content": "👋 Привет! Я криптоаналитический ассистент. Задайте мне вопрос о криптовалютах, токенах, DeFi или рынке в целом!"
-    })
+    st.session_state.messages.append(make_message(
+        "assistant",
+        "👋 Привет! Я криптоаналитический ассистент. Задайте мне вопрос о криптовалютах, токенах, DeFi или рынке в целом!"
+    ))
 
 # Контейнер для сообщений
 chat_container = st.container()
 
-# Отображение сообщений
+# Отображение сообщений: вся история выводится одним элементом, а не парой колонок на сообщение
 with chat_container:
-    for message in st.session_state.messages:
-        role = message["role"]
-        content = message["content"]
-
-        # Определяем иконку для роли
-        icon = "👤" if role == "user" else "🤖" if role == "assistant" else "ℹ️"
+    messages = st.session_state.messages
+    hidden_count = 0 if st.session_state.show_all_messages else max(0, len(messages) - VISIBLE_MESSAGES)
+    if hidden_count and st.button(f"Показать ранние сообщения ({hidden_count})"):
+        st.session_state.show_all_messages = True
+        st.rerun()
 
-        # Создаем стилизованный контейнер для сообщения
-        with st.container():
-            col1, col2 = st.columns([1, 20])
-            with col1:
-                st.markdown(f"<div style='font-size:1.5rem;'>{icon}</div>", unsafe_allow_html=True)
-            with col2:
-                st.markdown(f"<div class='chat-message {role}'>{content}</div>", unsafe_allow_html=True)
+    # HTML сообщений построен при их добавлении
+    st.markdown("\n".join(message["html"] for message in messages[hidden_count:]), unsafe_allow_html=True)
 
 # Разделитель перед полем ввода
 st.markdown("<hr>", unsafe_allow_html=True)
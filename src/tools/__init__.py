@@ -1,8 +1,8 @@
 # Импортируем все инструменты для доступности через tools.*
-from .coingecko_tools import get_token_price, get_trending_coins, search_cryptocurrencies
-from .defi_protocol_tools import analyze_protocol, analyze_pools_geckoterminal
-from .token_analysis_tools import get_token_historical_data
-from .holder_analysis_tools import analyze_token_holders
+from .coingecko_tools import get_token_price, get_token_prices, get_trending_coins, search_cryptocurrencies
+from .defi_protocol_tools import analyze_protocol, analyze_protocols_bulk, analyze_pools_geckoterminal
+from .token_analysis_tools import get_token_historical_data, analyze_tokens_bulk
+from .holder_analysis_tools import analyze_token_holders, analyze_holders_bulk
 # from .crypto_news_tools import fetch_crypto_news
 from .hyperliquid_tools import (
     get_crypto_price,
@@ -20,18 +20,26 @@ from .llamafeed_tools import (
     get_token_unlocks,
     get_project_raises,
     get_polymarket_data,
+    get_llamafeed_bundle,
     get_market_summary
 )
 
+# Общая HTTP-сессия инструментов (закрывается при завершении приложения)
+from ._http import close_session
+
 # Список всех доступных инструментов для импорта
 __all__ = [
     'get_token_price',
+    'get_token_prices',
     'get_trending_coins',
     'search_cryptocurrencies',
     'analyze_protocol',
+    'analyze_protocols_bulk',
     'analyze_pools_geckoterminal',
     'get_token_historical_data',
+    'analyze_tokens_bulk',
     'analyze_token_holders',
+    'analyze_holders_bulk',
     # 'fetch_crypto_news',
     # Новые инструменты HyperLiquid
     'get_crypto_price',
@@ -48,5 +56,6 @@ __all__ = [
     'get_token_unlocks',
     'get_project_raises',
     'get_polymarket_data',
+    'get_llamafeed_bundle',
     'get_market_summary'
 ]
\ No newline at end of file
@@ -0,0 +1,8 @@
+"""Общий лимит запросов к API CoinGecko для всех инструментов."""
+
+from config.settings import COINGECKO_MAX_CONCURRENCY, COINGECKO_REQUESTS_PER_SECOND
+from core.dispatcher import Dispatcher
+
+# Все обращения инструментов к CoinGecko (сервис GOAT и прямые запросы к REST API)
+# проходят через общий лимит: параллельные агенты не упираются в 429 бесплатного тарифа
+COINGECKO_DISPATCHER = Dispatcher(COINGECKO_MAX_CONCURRENCY, COINGECKO_REQUESTS_PER_SECOND)
@@ -0,0 +1,168 @@
+"""Общая HTTP-сессия для инструментов, работающих с внешними API."""
+
+import asyncio
+import importlib.util
+import weakref
+from typing import Any, Callable, Dict, List, Optional
+
+import aiohttp
+import httpx
+from yarl import URL
+
+from config.settings import HTTP_BREAKER_RESET_S, HTTP_BREAKER_THRESHOLD, HTTP_ETAG_CACHE_TTL, HTTP_RETRY_ATTEMPTS
+from core.cache import TTLCache
+from core.retry import CircuitBreaker, backoff_delay, is_retryable, is_retryable_status
+
+# Одна сессия на event loop: соединения (TCP + TLS) переиспользуются между вызовами инструментов.
+# Сессия привязана к loop, в котором создана, поэтому у каждого loop (например, у каждой
+# сессии Streamlit) своя; после сборки loop его запись удаляется автоматически
+_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]" = weakref.WeakKeyDictionary()
+
+# JSON API отвечают в 4-8 раз меньшими телами в сжатом виде; br aiohttp распаковывает
+# при установленном пакете Brotli
+_DEFAULT_HEADERS = {"Accept-Encoding": "gzip, br", "Accept": "application/json"}
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Возвращает общую aiohttp-сессию для текущего event loop (создается при первом вызове)."""
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=128, limit_per_host=64, ttl_dns_cache=300, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=30),
+            headers=_DEFAULT_HEADERS,
+            auto_decompress=True
+        )
+        _sessions[loop] = session
+
+    return session
+
+
+# Размыкатель цепи по хосту: недоступный API не задерживает каждый вызов инструмента на таймауты
+_breaker = CircuitBreaker(failure_threshold=HTTP_BREAKER_THRESHOLD, reset_timeout=HTTP_BREAKER_RESET_S)
+
+
+async def request(method: str, url: str, **kwargs: Any) -> aiohttp.ClientResponse:
+    """
+    Выполняет запрос через общую сессию, повторяя его при 429/5xx и обрывах соединения.
+
+    Ответ возвращается непрочитанным (используется как `async with await request(...)`);
+    после исчерпания попыток возвращается последний ответ с ошибкой. Если хост
+    несколько раз подряд не ответил, выбрасывается CircuitOpenError без запроса.
+    """
+    host = URL(url).host
+    _breaker.check(host)
+    session = await get_session()
+
+    # Ошибкой для размыкателя считается вызов, не удавшийся после всех попыток
+    for attempt in range(HTTP_RETRY_ATTEMPTS):
+        last_attempt = attempt == HTTP_RETRY_ATTEMPTS - 1
+        try:
+            response = await session.request(method, url, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            if last_attempt:
+                _breaker.record_failure(host)
+                raise
+        else:
+            if not is_retryable_status(response.status):
+                _breaker.record_success(host)
+                return response
+            if last_attempt:
+                _breaker.record_failure(host)
+                return response
+            response.release()
+        await asyncio.sleep(backoff_delay(attempt))
+
+
+async def invoke_bulk(tool: Any, keys: List[str], labels: Optional[List[str]],
+                      make_args: Callable[[str, str], Dict[str, Any]], max_concurrency: int) -> str:
+    """
+    Вызывает инструмент для каждого ключа параллельно и объединяет отчеты (общая часть *_bulk-инструментов).
+
+    Args:
+        tool: Инструмент, вызываемый для одного ключа
+        keys: Ключи (идентификаторы токенов, протоколов, адреса)
+        labels: Читаемые названия в том же порядке (недостающие заменяются ключами)
+        make_args: Аргументы вызова инструмента по ключу и названию
+        max_concurrency: Лимит одновременных вызовов (лимит API провайдера)
+    """
+    padded = list(labels or [])
+    padded += keys[len(padded):]
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def invoke(key: str, label: str) -> str:
+        async with semaphore:
+            return await tool.ainvoke(make_args(key, label))
+
+    results = await asyncio.gather(*(invoke(key, label) for key, label in zip(keys, padded)))
+    return "\n\n".join(results)
+
+
+# HTTP/2-клиенты по тем же правилам: параллельные запросы к одному хосту (CoinGecko)
+# мультиплексируются в одном TLS-соединении
+_http2_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+
+def get_http2_client() -> httpx.AsyncClient:
+    """Возвращает общий httpx-клиент с HTTP/2 для текущего event loop (без пакета h2 - HTTP/1.1)."""
+    loop = asyncio.get_running_loop()
+    client = _http2_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16)
+        )
+        _http2_clients[loop] = client
+
+    return client
+
+
+# Последний ответ с ETag по каждому URL. Живет дольше кэшей инструментов: когда их запись
+# устаревает, запрос уходит с If-None-Match, и на 304 тело берется отсюда без загрузки и разбора
+_etag_bodies = TTLCache(ttl_s=HTTP_ETAG_CACHE_TTL, maxsize=256)
+
+
+def conditional_headers(url: str, headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Добавляет к заголовкам If-None-Match, если для URL сохранен ETag."""
+    headers = dict(headers or {})
+    entry = _etag_bodies.get(url)
+    if entry is not None:
+        headers["If-None-Match"] = entry[0]
+    return headers
+
+
+def not_modified_body(url: str, response: aiohttp.ClientResponse) -> Optional[Any]:
+    """Возвращает сохраненное тело, если сервер ответил 304 Not Modified, иначе None."""
+    if response.status != 304:
+        return None
+    entry = _etag_bodies.get(url)
+    return entry[1] if entry is not None else None
+
+
+def last_good_body(url: str) -> Optional[Any]:
+    """Возвращает последнее сохраненное тело ответа по URL (запасной вариант при недоступном API)."""
+    entry = _etag_bodies.get(url)
+    return entry[1] if entry is not None else None
+
+
+def remember_etag(url: str, response: aiohttp.ClientResponse, body: Any) -> None:
+    """Сохраняет ETag успешного ответа вместе с разобранным телом."""
+    etag = response.headers.get("ETag")
+    if etag:
+        _etag_bodies.set(url, (etag, body))
+
+
+async def close_session() -> None:
+    """Закрывает общие сессии текущего event loop (вызывается при завершении приложения)."""
+    loop = asyncio.get_running_loop()
+    session = _sessions.pop(loop, None)
+    if session is not None and not session.closed:
+        await session.close()
+    client = _http2_clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
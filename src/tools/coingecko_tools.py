@@ -1,31 +1,104 @@
 import asyncio
-from typing import Optional, List
+import functools
+import os
+import orjson
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 from langchain_core.tools import tool
 from goat_plugins.coingecko.service import CoinGeckoService
-from config.settings import COINGECKO_API_KEY
+from config.settings import (
+    COINGECKO_API_KEY,
+    COINGECKO_CACHE_TTL,
+    TOKEN_PRICE_CACHE_TTL
+)
+from core.cache import TTLCache, single_flight
+from ._coingecko import COINGECKO_DISPATCHER
+from ._http import get_http2_client
+
+class CoinGeckoHTTPError(Exception):
+    """Ответ API CoinGecko с неуспешным HTTP-статусом (статус доступен в status для повторов)."""
+
+    def __init__(self, status: int, text: str):
+        super().__init__(f"HTTP error! status: {status} {text}")
+        self.status = status
+
+class SharedClientCoinGeckoService(CoinGeckoService):
+    """
+    CoinGeckoService, выполняющий запросы через общий HTTP/2-клиент.
+
+    Исходный сервис открывает новую aiohttp-сессию (и TLS-соединение) на каждый запрос;
+    здесь все запросы идут по одному соединению с api.coingecko.com.
+    """
+
+    async def _get(self, path: str, params: Dict[str, Any]) -> Any:
+        """Выполняет GET-запрос к API CoinGecko и возвращает JSON ответа."""
+        response = await get_http2_client().get(
+            f"{self.base_url}{path}",
+            params={**params, "x_cg_demo_api_key": self.api_key}
+        )
+        if not response.is_success:
+            raise CoinGeckoHTTPError(response.status_code, response.text)
+        return orjson.loads(response.content)
+
+    async def get_trending_coins(self, parameters: dict):
+        return await self._get("/search/trending", {})
+
+    async def get_coin_price(self, parameters: dict):
+        return await self._get("/simple/price", {
+            "ids": parameters["coin_id"],
+            "vs_currencies": parameters["vs_currency"],
+            "include_market_cap": str(parameters["include_market_cap"]).lower(),
+            "include_24hr_vol": str(parameters["include_24hr_vol"]).lower(),
+            "include_24hr_change": str(parameters["include_24hr_change"]).lower(),
+            "include_last_updated_at": str(parameters["include_last_updated_at"]).lower()
+        })
+
+    async def search_coins(self, parameters: dict):
+        query = parameters["query"]
+        data = await self._get("/search", {"query": query})
+        if parameters["exact_match"]:
+            data["coins"] = [
+                coin for coin in data.get("coins", [])
+                if coin.get("id") == query
+                or coin.get("symbol", "").lower() == query.lower()
+                or coin.get("name", "").lower() == query.lower()
+            ]
+        return data
+
+@functools.lru_cache(maxsize=1)
+def _coingecko_service(api_key: Optional[str]) -> CoinGeckoService:
+    """Сервис CoinGecko, общий для всех вызовов инструментов с тем же ключом API."""
+    return SharedClientCoinGeckoService(api_key=api_key)
 
 def create_coingecko_service():
-    return CoinGeckoService(api_key=COINGECKO_API_KEY)
+    # Ключ читается из окружения: после его смены в форме настроек создается новый сервис
+    return _coingecko_service(os.getenv("COINGECKO_API_KEY") or COINGECKO_API_KEY)
+
+# Цены запрашиваются разными агентами почти одновременно, поэтому короткий TTL убирает повторы
+_PRICE_CACHE = TTLCache(ttl_s=TOKEN_PRICE_CACHE_TTL, maxsize=512)
+
+async def _request(method: Callable[[Dict[str, Any]], Awaitable[Any]], params: Dict[str, Any]) -> Any:
+    """Вызывает метод CoinGeckoService с учетом общего лимита запросов."""
+    return await COINGECKO_DISPATCHER.submit(lambda: method(params))
+
+# Тренды и результаты поиска меняются за минуты: повторные запросы пользователя не идут в сеть
+_RESPONSE_CACHE = TTLCache(ttl_s=COINGECKO_CACHE_TTL, maxsize=256)
 
 @tool
 async def get_token_price(symbol: str) -> str:
     """
     Получает текущую цену токена по его символу (например, BTC, ETH).
     """
-    cg_service = create_coingecko_service()
+    return await _PRICE_CACHE.get_or_set(symbol.upper(), lambda: _fetch_token_price(symbol))
 
-    search_result = await cg_service.search_coins({
-        "query": symbol.lower(),
-        "exact_match": True
-    })
+async def _fetch_token_price(symbol: str) -> str:
+    """Запрашивает текущую цену токена в CoinGecko."""
+    cg_service = create_coingecko_service()
 
-    coins = search_result.get("coins", [])
-    if not coins:
+    coin_id = await _resolve_coin_id(cg_service, symbol)
+    if coin_id is None:
         return f"Не удалось найти токен с символом {symbol.upper()}"
 
-    coin_id = coins[0]["id"]
-
-    price_data = await cg_service.get_coin_price({
+    price_data = await _request(cg_service.get_coin_price, {
         "coin_id": coin_id,
         "vs_currency": "usd",
         "include_market_cap": False,
@@ -40,6 +113,54 @@ async def get_token_price(symbol: str) -> str:
     price = price_data[coin_id]["usd"]
     return f"Текущая цена {symbol.upper()}: {price} USD"
 
+async def _resolve_coin_id(cg_service: CoinGeckoService, symbol: str) -> Optional[str]:
+    """Находит ID монеты CoinGecko по символу токена."""
+    search_result = await _RESPONSE_CACHE.get_or_set(
+        ("search", symbol.lower(), True),
+        lambda: _request(cg_service.search_coins, {
+            "query": symbol.lower(),
+            "exact_match": True
+        })
+    )
+
+    coins = search_result.get("coins", [])
+    return coins[0]["id"] if coins else None
+
+@tool
+@single_flight
+async def get_token_prices(symbols: List[str]) -> str:
+    """
+    Получает текущие цены нескольких токенов одним запросом (например, ["BTC", "ETH", "SOL"]).
+    """
+    cg_service = create_coingecko_service()
+
+    # Символы разрешаются в ID параллельно, а цены запрашиваются одним вызовом для всех монет
+    symbols = [symbol.upper() for symbol in symbols]
+    coin_ids = await asyncio.gather(*(_resolve_coin_id(cg_service, symbol) for symbol in symbols))
+    found = {symbol: coin_id for symbol, coin_id in zip(symbols, coin_ids) if coin_id is not None}
+
+    price_data = {}
+    if found:
+        price_data = await _request(cg_service.get_coin_price, {
+            "coin_id": ",".join(dict.fromkeys(found.values())),
+            "vs_currency": "usd",
+            "include_market_cap": False,
+            "include_24hr_vol": False,
+            "include_24hr_change": False,
+            "include_last_updated_at": False
+        }) or {}
+
+    lines = []
+    for symbol in symbols:
+        coin_id = found.get(symbol)
+        if coin_id is None:
+            lines.append(f"Не удалось найти токен с символом {symbol}")
+        elif coin_id not in price_data:
+            lines.append(f"Не удалось получить цену для {symbol}")
+        else:
+            lines.append(f"Текущая цена {symbol}: {price_data[coin_id]['usd']} USD")
+    return "\n".join(lines)
+
 @tool
 async def get_trending_coins(limit: Optional[int] = None, include_platform: bool = False) -> str:
     """
@@ -51,10 +172,13 @@ async def get_trending_coins(limit: Optional[int] = None, include_platform: bool
     """
     cg_service = create_coingecko_service()
 
-    trending_data = await cg_service.get_trending_coins({
-        "limit": limit,
-        "include_platform": include_platform
-    })
+    trending_data = await _RESPONSE_CACHE.get_or_set(
+        ("trending", limit, include_platform),
+        lambda: _request(cg_service.get_trending_coins, {
+            "limit": limit,
+            "include_platform": include_platform
+        })
+    )
 
     if not trending_data or "coins" not in trending_data:
         return "Не удалось получить информацию о трендовых монетах."
@@ -96,10 +220,13 @@ async def search_cryptocurrencies(query: str, exact_match: bool = False) -> str:
     """
     cg_service = create_coingecko_service()
 
-    search_result = await cg_service.search_coins({
-        "query": query,
-        "exact_match": exact_match
-    })
+    search_result = await _RESPONSE_CACHE.get_or_set(
+        ("search", query.lower(), exact_match),
+        lambda: _request(cg_service.search_coins, {
+            "query": query,
+            "exact_match": exact_match
+        })
+    )
 
     coins = search_result.get("coins", [])
 
@@ -1,5 +1,5 @@
-import aiohttp
 from langchain_core.tools import tool
+from ._http import get_session
 
 async def get_crypto_news(query: str, max_pages: int = 1) -> str:
     """Функция для отправки запроса к MCP серверу через HTTP"""
@@ -7,13 +7,13 @@ async def get_crypto_news(query: str, max_pages: int = 1) -> str:
     payload = {"query": query, "max_pages": max_pages}
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as response:
-                if response.status == 200:
-                    return await response.text()
-                else:
-                    error_text = await response.text()
-                    return f"Ошибка при запросе к серверу: {response.status}, {error_text}"
+        session = await get_session()
+        async with session.post(url, json=payload) as response:
+            if response.status == 200:
+                return await response.text()
+            else:
+                error_text = await response.text()
+                return f"Ошибка при запросе к серверу: {response.status}, {error_text}"
     except Exception as e:
         return f"Ошибка при подключении к MCP серверу: {str(e)}\n\nУбедитесь, что сервер запущен на порту 6274."
 
@@ -1,10 +1,55 @@
-import aiohttp
-import pandas as pd
-from typing import List
+import asyncio
+import heapq
+import orjson
+from operator import itemgetter
+from typing import Any, Dict, List, Optional
 from langchain_core.tools import tool
+from config.settings import (
+    DEFILLAMA_CACHE_TTL,
+    DEFILLAMA_MAX_CONCURRENCY,
+    GECKOTERMINAL_CACHE_TTL,
+    GECKOTERMINAL_META_CACHE_TTL
+)
+from core.cache import TTLCache, single_flight
+from core.retry import CircuitOpenError
+from ._http import conditional_headers, invoke_bulk, last_good_body, not_modified_body, remember_etag, request
+
+# История TVL и списки пулов меняются медленно: повторные запросы агентов не идут в сеть
+_PROTOCOL_CACHE = TTLCache(ttl_s=DEFILLAMA_CACHE_TTL, maxsize=128)
+_POOLS_CACHE = TTLCache(ttl_s=GECKOTERMINAL_CACHE_TTL, maxsize=128)
+
+# Списки сетей и DEX GeckoTerminal меняются за недели
+_GECKOTERMINAL_META_CACHE = TTLCache(ttl_s=GECKOTERMINAL_META_CACHE_TTL, maxsize=64)
+
+_GECKOTERMINAL_API = "https://api.geckoterminal.com/api/v2"
+
+# Маппинг для коррекции идентификаторов сетей
+_NETWORK_MAP = {
+    "ethereum": "eth",
+    "arbitrum": "arbitrum_one",
+    "binance": "bsc",
+    "polygon": "polygon_pos",
+    "optimism": "optimism",
+    "base": "base",
+}
+_NETWORK_VALS = frozenset(_NETWORK_MAP.values())
+
+# Маппинг для коррекции идентификаторов протоколов
+_PROTOCOL_MAP = {
+    "uniswap": "uniswap_v3",
+    "uniswap_v2": "uniswap_v2",
+    "uniswap_v3": "uniswap_v3",
+    "sushi": "sushiswap",
+    "sushiswap": "sushiswap",
+    "pancake": "pancakeswap_v2",
+    "pancakeswap": "pancakeswap_v2",
+    "curve": "curve",
+    "balancer": "balancer_ethereum",
+}
+_PROTOCOL_VALS = frozenset(_PROTOCOL_MAP.values())
 
 @tool
-def analyze_protocol(protocol_id: str, protocol_label: str, chains_to_show: List[str]) -> str:
+async def analyze_protocol(protocol_id: str, protocol_label: str, chains_to_show: List[str]) -> str:
     """
     Получает данные протокола с DeFiLlama и анализирует TVL.
 
@@ -13,18 +58,32 @@ def analyze_protocol(protocol_id: str, protocol_label: str, chains_to_show: List
         protocol_label: читаемое название протокола для отображения
         chains_to_show: список сетей для анализа TVL (например, ["Ethereum", "Arbitrum"])
     """
-    import requests
-    
-    url = f'https://api.llama.fi/protocol/{protocol_id}'
-    response = requests.get(url)
-    
-    if response.status_code != 200:
-        return f"Ошибка запроса для {protocol_label}: {response.status_code} {response.reason}"
-
-    try:
-        protocol_data = response.json()
-    except Exception as e:
-        return f"Ошибка декодирования JSON для {protocol_label}: {e}"
+    protocol_data = _PROTOCOL_CACHE.get(protocol_id)
+    if protocol_data is None:
+        url = f'https://api.llama.fi/protocol/{protocol_id}'
+
+        # Запрос не блокирует event loop: другие инструменты выполняются параллельно.
+        # Если данные не изменились с прошлого ответа, сервер вернет 304 без тела
+        try:
+            async with await request("GET", url, headers=conditional_headers(url)) as response:
+                protocol_data = not_modified_body(url, response)
+                if protocol_data is None:
+                    if response.status != 200:
+                        return f"Ошибка запроса для {protocol_label}: {response.status} {response.reason}"
+
+                    try:
+                        protocol_data = orjson.loads(await response.read())
+                    except Exception as e:
+                        return f"Ошибка декодирования JSON для {protocol_label}: {e}"
+                    remember_etag(url, response, protocol_data)
+
+            # Кэшируются только успешные ответы
+            _PROTOCOL_CACHE.set(protocol_id, protocol_data)
+        except CircuitOpenError as e:
+            # DeFiLlama недоступен: отвечаем последними полученными данными, если они есть
+            protocol_data = last_good_body(url)
+            if protocol_data is None:
+                return f"Ошибка запроса для {protocol_label}: {e}"
 
     result = f"=== {protocol_label} Summary ===\n\n"
 
@@ -33,19 +92,16 @@ def analyze_protocol(protocol_id: str, protocol_label: str, chains_to_show: List
         result += f"Market Cap: ${protocol_data['mcap']:,.2f}\n"
 
     if "tvl" in protocol_data and protocol_data["tvl"]:
-        tvl_data = pd.DataFrame(protocol_data["tvl"])
-
-        # Конвертируем Unix timestamp в datetime
-        tvl_data['datetime'] = pd.to_datetime(tvl_data['date'], unit='s')
-        tvl_data = tvl_data.sort_values('datetime')
+        # DeFiLlama отдает историю TVL по дням в хронологическом порядке
+        tvl_data = protocol_data["tvl"]
 
         # Получаем текущий TVL (последняя запись)
-        current_tvl = tvl_data.iloc[-1]['totalLiquidityUSD']
+        current_tvl = tvl_data[-1]['totalLiquidityUSD']
         result += f"Текущий TVL: ${current_tvl:,.2f}\n"
 
         # Рассчитываем изменение TVL за месяц
         if len(tvl_data) > 30:
-            month_ago_tvl = tvl_data.iloc[-31]['totalLiquidityUSD']
+            month_ago_tvl = tvl_data[-31]['totalLiquidityUSD']
             monthly_change_pct = ((current_tvl - month_ago_tvl) / month_ago_tvl) * 100
             result += f"Изменение TVL за 30 дней: {monthly_change_pct:.2f}%\n"
 
@@ -66,6 +122,61 @@ def analyze_protocol(protocol_id: str, protocol_label: str, chains_to_show: List
     return result
 
 @tool
+async def analyze_protocols_bulk(protocol_ids: List[str], chains_to_show: List[str],
+                                 protocol_labels: Optional[List[str]] = None) -> str:
+    """
+    Получает данные сразу нескольких протоколов с DeFiLlama и анализирует их TVL.
+
+    Используйте вместо нескольких вызовов analyze_protocol, например для сравнения протоколов.
+
+    Args:
+        protocol_ids: идентификаторы протоколов в DeFiLlama
+        chains_to_show: список сетей для анализа TVL (например, ["Ethereum", "Arbitrum"])
+        protocol_labels: читаемые названия протоколов в том же порядке (по умолчанию - идентификаторы)
+    """
+    # Протоколы запрашиваются параллельно, но не больше лимита DeFiLlama одновременно
+    return await invoke_bulk(
+        analyze_protocol, protocol_ids, protocol_labels,
+        lambda protocol_id, protocol_label: {
+            "protocol_id": protocol_id,
+            "protocol_label": protocol_label,
+            "chains_to_show": chains_to_show
+        },
+        DEFILLAMA_MAX_CONCURRENCY
+    )
+
+async def _get_json(url: str) -> Optional[Any]:
+    """Выполняет GET-запрос и возвращает JSON ответа или None, если статус не 200."""
+    async with await request("GET", url) as response:
+        if response.status != 200:
+            return None
+        return orjson.loads(await response.read())
+
+async def _get_geckoterminal_ids(path: str) -> Optional[Dict[str, str]]:
+    """
+    Возвращает идентификаторы из списка GeckoTerminal с названиями в нижнем регистре.
+
+    Успешные ответы кэшируются, ошибки - нет: следующий вызов повторит запрос.
+    """
+    ids = _GECKOTERMINAL_META_CACHE.get(path)
+    if ids is None:
+        data = await _get_json(f"{_GECKOTERMINAL_API}{path}")
+        if data is None:
+            return None
+        ids = {item["id"]: item["attributes"].get("name", "").lower() for item in data.get("data", [])}
+        _GECKOTERMINAL_META_CACHE.set(path, ids)
+    return ids
+
+async def _get_geckoterminal_networks() -> Optional[Dict[str, str]]:
+    """Возвращает сети GeckoTerminal: идентификатор -> название."""
+    return await _get_geckoterminal_ids("/networks")
+
+async def _get_geckoterminal_dexes(network: str) -> Optional[Dict[str, str]]:
+    """Возвращает DEX сети в GeckoTerminal: идентификатор -> название."""
+    return await _get_geckoterminal_ids(f"/networks/{network}/dexes")
+
+@tool
+@single_flight
 async def analyze_pools_geckoterminal(network: str, protocol_id: str, protocol_label: str) -> str:
     """
     Анализирует пулы протокола с использованием данных GeckoTerminal.
@@ -75,99 +186,80 @@ async def analyze_pools_geckoterminal(network: str, protocol_id: str, protocol_l
         protocol_id: Идентификатор DEX в GeckoTerminal (например, "uniswap")
         protocol_label: Читаемое название протокола
     """
-    # Маппинг для коррекции идентификаторов сетей
-    network_mapping = {
-        "ethereum": "eth",
-        "arbitrum": "arbitrum_one",
-        "binance": "bsc",
-        "polygon": "polygon_pos",
-        "optimism": "optimism",
-        "base": "base",
-    }
-
-    # Маппинг для коррекции идентификаторов протоколов
-    protocol_mapping = {
-        "uniswap": "uniswap_v3",
-        "uniswap_v2": "uniswap_v2",
-        "uniswap_v3": "uniswap_v3",
-        "sushi": "sushiswap",
-        "sushiswap": "sushiswap",
-        "pancake": "pancakeswap_v2",
-        "pancakeswap": "pancakeswap_v2",
-        "curve": "curve",
-        "balancer": "balancer_ethereum",
-    }
-
     # Нормализуем входные параметры
-    normalized_network = network_mapping.get(network.lower(), network.lower())
-    normalized_protocol = protocol_mapping.get(protocol_id.lower(), protocol_id.lower())
+    normalized_network = _NETWORK_MAP.get(network.lower(), network.lower())
+    normalized_protocol = _PROTOCOL_MAP.get(protocol_id.lower(), protocol_id.lower())
 
     print(f"Запрос к GeckoTerminal: сеть={normalized_network}, протокол={normalized_protocol}")
 
-    base_url = "https://api.geckoterminal.com/api/v2"
-
     # Сначала проверим доступные сети и протоколы, если параметры не очевидны
-    if normalized_network not in network_mapping.values() or normalized_protocol not in protocol_mapping.values():
+    if normalized_network not in _NETWORK_VALS or normalized_protocol not in _PROTOCOL_VALS:
         try:
-            # Получаем список доступных сетей
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{base_url}/networks") as response:
-                    if response.status == 200:
-                        networks_data = await response.json()
-                        available_networks = [net["id"] for net in networks_data.get("data", [])]
-
-                        # Если наша нормализованная сеть не найдена, ищем ближайшую по имени
-                        if normalized_network not in available_networks:
-                            for net in networks_data.get("data", []):
-                                if network.lower() in net["attributes"].get("name", "").lower():
-                                    normalized_network = net["id"]
-                                    break
-
-            # Если сеть найдена, получаем список доступных протоколов для этой сети
-            if normalized_network:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(f"{base_url}/networks/{normalized_network}/dexes") as response:
-                        if response.status == 200:
-                            dexes_data = await response.json()
-                            available_dexes = [dex["id"] for dex in dexes_data.get("data", [])]
-
-                            # Если наш нормализованный протокол не найден, ищем ближайший по имени
-                            if normalized_protocol not in available_dexes:
-                                for dex in dexes_data.get("data", []):
-                                    dex_name = dex["attributes"].get("name", "").lower()
-                                    if protocol_id.lower() in dex_name or protocol_id.lower() in dex["id"]:
-                                        normalized_protocol = dex["id"]
-                                        break
+            # Список сетей и список протоколов предполагаемой сети запрашиваются параллельно
+            networks, dexes = await asyncio.gather(
+                _get_geckoterminal_networks(),
+                _get_geckoterminal_dexes(normalized_network)
+            )
+
+            # Если наша нормализованная сеть не найдена, ищем ближайшую по имени
+            if networks is not None and normalized_network not in networks:
+                for net_id, net_name in networks.items():
+                    if network.lower() in net_name:
+                        normalized_network = net_id
+                        # Протоколы запрашиваются заново уже для найденной сети
+                        dexes = await _get_geckoterminal_dexes(normalized_network)
+                        break
+
+            # Если наш нормализованный протокол не найден, ищем ближайший по имени
+            if dexes is not None and normalized_protocol not in dexes:
+                for dex_id, dex_name in dexes.items():
+                    if protocol_id.lower() in dex_name or protocol_id.lower() in dex_id:
+                        normalized_protocol = dex_id
+                        break
         except Exception as e:
             print(f"Ошибка при получении доступных сетей/протоколов: {e}")
 
     # Формируем URL с нормализованными параметрами
-    pools_url = f"{base_url}/networks/{normalized_network}/dexes/{normalized_protocol}/pools"
+    pools_url = f"{_GECKOTERMINAL_API}/networks/{normalized_network}/dexes/{normalized_protocol}/pools"
     headers = {"Accept": "application/json"}
 
-    # Выполняем запрос к API
-    async with aiohttp.ClientSession() as session:
-        async with session.get(pools_url, headers=headers) as response:
-            if response.status != 200:
-                error_text = await response.text()
-                print(f"Ошибка запроса: {response.status} - {error_text}")
-
-                # Формируем понятное сообщение об ошибке
-                if response.status == 404:
-                    return (f"Ошибка запроса для {protocol_label}: ресурс не найден (404).\n"
-                           f"Проверьте корректность идентификаторов:\n"
-                           f"- Сеть: {normalized_network} (изначально: {network})\n"
-                           f"- Протокол: {normalized_protocol} (изначально: {protocol_id})\n\n"
-                           f"Популярные сети: eth, arbitrum_one, bsc, polygon_pos, optimism, base\n"
-                           f"Популярные протоколы: uniswap_v3, uniswap_v2, sushiswap, pancakeswap_v2, curve")
-                return f"Ошибка запроса для {protocol_label}: {response.status}"
-
-            pools_data = await response.json()
+    # Выполняем запрос к API (если пулов нет в кэше)
+    pools_key = (normalized_network, normalized_protocol)
+    pools_data = _POOLS_CACHE.get(pools_key)
+    if pools_data is None:
+        try:
+            async with await request("GET", pools_url, headers=conditional_headers(pools_url, headers)) as response:
+                pools_data = not_modified_body(pools_url, response)
+                if pools_data is None:
+                    if response.status != 200:
+                        error_text = await response.text()
+                        print(f"Ошибка запроса: {response.status} - {error_text}")
+
+                        # Формируем понятное сообщение об ошибке
+                        if response.status == 404:
+                            return (f"Ошибка запроса для {protocol_label}: ресурс не найден (404).\n"
+                                   f"Проверьте корректность идентификаторов:\n"
+                                   f"- Сеть: {normalized_network} (изначально: {network})\n"
+                                   f"- Протокол: {normalized_protocol} (изначально: {protocol_id})\n\n"
+                                   f"Популярные сети: eth, arbitrum_one, bsc, polygon_pos, optimism, base\n"
+                                   f"Популярные протоколы: uniswap_v3, uniswap_v2, sushiswap, pancakeswap_v2, curve")
+                        return f"Ошибка запроса для {protocol_label}: {response.status}"
+
+                    pools_data = orjson.loads(await response.read())
+                    remember_etag(pools_url, response, pools_data)
+            _POOLS_CACHE.set(pools_key, pools_data)
+        except CircuitOpenError as e:
+            # GeckoTerminal недоступен: отвечаем последними полученными данными, если они есть
+            pools_data = last_good_body(pools_url)
+            if pools_data is None:
+                return f"Ошибка запроса для {protocol_label}: {e}"
 
     if 'data' not in pools_data or not pools_data['data']:
         return f"Нет данных о пулах для {protocol_label} (сеть: {normalized_network}, протокол: {normalized_protocol})"
 
+    # Объем торгов суммируется прямо при разборе пулов: отдельный проход не нужен
     pools = []
+    total_volume = 0.0
     for pool in pools_data['data']:
         pool_info = pool['attributes']
         tokens = pool_info['name'].split(' / ')
@@ -179,6 +271,7 @@ async def analyze_pools_geckoterminal(network: str, protocol_id: str, protocol_l
         tx_buys = int(pool_info['transactions']['h24']['buys'])
         tx_sells = int(pool_info['transactions']['h24']['sells'])
         transactions = tx_buys + tx_sells
+        total_volume += volume_24h
 
         pools.append({
             'pool_address': pool['id'],
@@ -189,29 +282,26 @@ async def analyze_pools_geckoterminal(network: str, protocol_id: str, protocol_l
             'transactions': transactions
         })
 
-    df_pools = pd.DataFrame(pools)
-
     result = f"=== Анализ пулов для {protocol_label} ===\n"
     result += f"Сеть: {normalized_network}, Протокол: {normalized_protocol}\n\n"
-    result += f"Общее количество пулов (в выборке): {len(df_pools)}\n\n"
+    result += f"Общее количество пулов (в выборке): {len(pools)}\n\n"
 
     # Находим топ-3 пула по количеству транзакций
-    if not df_pools.empty:
-        top3_pools = df_pools.sort_values(by="transactions", ascending=False).head(3)
+    if pools:
+        top3_pools = heapq.nlargest(3, pools, key=itemgetter('transactions'))
         result += "Топ-3 пула по числу транзакций:\n"
 
-        for i, (_, pool) in enumerate(top3_pools.iterrows(), 1):
+        for i, pool in enumerate(top3_pools, 1):
             result += f"{i}. {pool['token_pair']} - {pool['transactions']} транзакций\n"
             result += f"   Объем торгов 24ч: ${pool['volume_24h']:,.2f}\n"
             result += f"   Ликвидность: ${pool['liquidity_usd']:,.2f}\n"
             result += f"   Изменение цены 24ч: {pool['price_change_24h']:.2f}%\n\n"
 
-        total_tx_top3 = top3_pools["transactions"].sum()
+        total_tx_top3 = sum(pool['transactions'] for pool in top3_pools)
         result += f"Суммарное количество транзакций в топ-3 пулах: {total_tx_top3}\n"
 
         # Статистика по объемам торгов
-        total_volume = df_pools["volume_24h"].sum()
-        avg_volume = df_pools["volume_24h"].mean()
+        avg_volume = total_volume / len(pools)
         result += f"\nОбщий объем торгов за 24ч: ${total_volume:,.2f}\n"
         result += f"Средний объем торгов на пул: ${avg_volume:,.2f}\n"
     else:
@@ -1,9 +1,93 @@
-import aiohttp
-import pandas as pd
+import bisect
+import heapq
+import math
+from typing import List, Optional, Tuple
+
+import ijson
+import numpy as np
 from langchain_core.tools import tool
-from config.settings import BITQUERY_API_KEY
+from ._http import invoke_bulk, request
+from config.settings import BITQUERY_API_KEY, BITQUERY_CACHE_TTL, BITQUERY_MAX_CONCURRENCY
+from core.cache import TTLCache, single_flight
+from core.retry import CircuitOpenError
+
+# Состав крупных держателей меняется медленно: повторный анализ токена не идет в Bitquery
+_HOLDERS_CACHE = TTLCache(ttl_s=BITQUERY_CACHE_TTL, maxsize=128)
+
+# Текст запроса постоянный, сеть и адрес передаются переменными GraphQL: подстановка
+# значений в запрос не может изменить его структуру
+_HOLDERS_QUERY = """
+query ($network: evm_network!, $token: String!) {
+  EVM(dataset: archive, network: $network) {
+    TokenHolders(
+      tokenSmartContract: $token
+      limit: {count: 1000}
+      orderBy: {descending: Balance_Amount}
+    ) {
+      Holder {
+        Address
+      }
+      Balance {
+        Amount
+      }
+    }
+  }
+}
+"""
+
+# Пороги доли топ-10 держателей (%) и оценки концентрации между ними
+_CONCENTRATION_THRESHOLDS = (50, 70, 90)
+_CONCENTRATION_LABELS = ("Низкая", "Средняя", "Высокая", "Очень высокая")
+
+# Размер куска ответа Bitquery, который передается потоковому парсеру
+_CHUNK_SIZE = 64 * 1024
+
+async def _read_holders(response) -> Tuple[Tuple[List[str], np.ndarray], List[str]]:
+    """
+    Потоково разбирает ответ Bitquery по мере поступления данных.
+
+    Балансы сразу складываются в массив float64, адреса - в список: записи
+    ответа не материализуются целиком в виде словарей. Вместе с держателями
+    возвращаются сообщения из ключа errors: GraphQL сообщает об ошибках со статусом 200.
+    """
+    items = ijson.sendable_list()
+    parser = ijson.items_coro(items, 'data.EVM.TokenHolders.item')
+    errors = ijson.sendable_list()
+    errors_parser = ijson.items_coro(errors, 'errors.item')
+    addresses: List[str] = []
+    balances = np.empty(1000, dtype=np.float64)
+
+    def consume():
+        nonlocal balances
+        for holder in items:
+            amount = (holder.get('Balance') or {}).get('Amount')
+            if amount is None:
+                continue
+
+            try:
+                balance = float(amount)
+            except (TypeError, ValueError):
+                balance = 0.0
+
+            if len(addresses) == len(balances):
+                balances = np.resize(balances, len(balances) * 2)
+            balances[len(addresses)] = balance
+            addresses.append((holder.get('Holder') or {}).get('Address', 'Unknown'))
+        del items[:]
+
+    async for chunk in response.content.iter_chunked(_CHUNK_SIZE):
+        parser.send(chunk)
+        errors_parser.send(chunk)
+        consume()
+    parser.close()
+    errors_parser.close()
+    consume()
+
+    messages = [str(error.get('message', error)) if isinstance(error, dict) else str(error) for error in errors]
+    return (addresses, balances[:len(addresses)]), messages
 
 @tool
+@single_flight
 async def analyze_token_holders(token_address: str, token_label: str, chain: str = "ethereum") -> str:
     """
     Анализирует распределение держателей токена используя Bitquery.
@@ -28,95 +112,96 @@ async def analyze_token_holders(token_address: str, token_label: str, chain: str
             "Концентрация: средняя (топ-10 адресов владеют примерно 60% токенов)"
         )
 
-    url = "https://streaming.bitquery.io/graphql"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {BITQUERY_API_KEY}"
-    }
-
-    query = f"""
-    {{
-      EVM(dataset: archive, network: {chain}) {{
-        TokenHolders(
-          tokenSmartContract: "{token_address}"
-          limit: {{count: 1000}}
-          orderBy: {{descending: Balance_Amount}}
-        ) {{
-          Holder {{
-            Address
-          }}
-          Balance {{
-            Amount
-          }}
-        }}
-      }}
-    }}
-    """
+    cache_key = (chain, token_address.lower())
+    holders = _HOLDERS_CACHE.get(cache_key)
+    if holders is None:
+        url = "https://streaming.bitquery.io/graphql"
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {BITQUERY_API_KEY}"
+        }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json={"query": query}) as response:
+        try:
+            response = await request("POST", url, headers=headers, json={
+                "query": _HOLDERS_QUERY,
+                "variables": {"network": chain, "token": token_address}
+            })
+        except CircuitOpenError as e:
+            return f"Ошибка запроса: {e}"
+
+        async with response:
             if response.status != 200:
                 return f"Ошибка запроса: {response.status}"
 
             try:
-                response_data = await response.json()
-                holders = response_data['data']['EVM']['TokenHolders']
-            except Exception as e:
+                holders, errors = await _read_holders(response)
+            except ijson.JSONError as e:
                 return f"Ошибка парсинга JSON: {e}"
 
-    data = []
-    for holder in holders:
-        balance_info = holder.get('Balance', {})
-        amount_str = balance_info.get('Amount')
-        if amount_str is None:
-            continue
-
-        try:
-            balance = float(amount_str)
-        except:
-            balance = 0
+        # Ошибки запроса и пустой ответ не кэшируются: повторный вызов снова обратится к Bitquery
+        if errors:
+            return f"Ошибка запроса Bitquery: {'; '.join(errors)}"
+        if not holders[0]:
+            return "Нет данных о держателях токена."
 
-        address = holder.get('Holder', {}).get('Address', 'Unknown')
-        data.append({
-            'Balance': balance,
-            'Holder Address': address
-        })
+        _HOLDERS_CACHE.set(cache_key, holders)
 
-    if not data:
+    addresses, balances = holders
+    if not addresses:
         return "Нет данных о держателях токена."
 
-    df = pd.DataFrame(data)
-    total_balance = df['Balance'].sum()
-    df = df.sort_values(by='Balance', ascending=False)
-    df['Percentage'] = (df['Balance'] / total_balance) * 100
+    # Для отчета нужны только топ-50 держателей: частичный отбор через кучу
+    # вместо полной сортировки всех адресов
+    total_balance = math.fsum(balances)
+    top50 = heapq.nlargest(50, range(len(addresses)), key=balances.__getitem__)
+
+    def percentage(balance: float) -> float:
+        return 100.0 * balance / total_balance if total_balance else 0.0
 
     # Анализ распределения
     result = f"=== Анализ держателей токена {token_label} ===\n\n"
 
     # Топ-10 держателей
     result += "Топ-10 держателей:\n"
-    for i, (_, holder) in enumerate(df.head(10).iterrows(), 1):
-        addr = holder['Holder Address']
-        pct = holder['Percentage']
+    for i, idx in enumerate(top50[:10], 1):
+        addr = addresses[idx]
+        pct = percentage(balances[idx])
         result += f"{i}. {addr[:6]}...{addr[-4:]} - {pct:.2f}%\n"
 
     # Статистика концентрации
-    top10_pct = df.head(10)['Percentage'].sum()
-    top50_pct = df.head(50)['Percentage'].sum()
+    top10_pct = percentage(math.fsum(balances[top50[:10]]))
+    top50_pct = percentage(math.fsum(balances[top50]))
 
     result += f"\nТоп-10 держателей владеют {top10_pct:.2f}% токенов\n"
     result += f"Топ-50 держателей владеют {top50_pct:.2f}% токенов\n"
 
     # Оценка концентрации
-    if top10_pct > 90:
-        concentration = "Очень высокая"
-    elif top10_pct > 70:
-        concentration = "Высокая"
-    elif top10_pct > 50:
-        concentration = "Средняя"
-    else:
-        concentration = "Низкая"
+    concentration = _CONCENTRATION_LABELS[bisect.bisect_left(_CONCENTRATION_THRESHOLDS, top10_pct)]
 
     result += f"\nКонцентрация токенов: {concentration}"
 
     return result
+
+@tool
+async def analyze_holders_bulk(token_addresses: List[str], token_labels: Optional[List[str]] = None,
+                               chain: str = "ethereum") -> str:
+    """
+    Анализирует распределение держателей сразу нескольких токенов одной сети используя Bitquery.
+
+    Используйте вместо нескольких вызовов analyze_token_holders.
+
+    Args:
+        token_addresses: адреса контрактов токенов
+        token_labels: читаемые названия токенов в том же порядке (по умолчанию - адреса)
+        chain: блокчейн, на котором размещены токены (по умолчанию "ethereum")
+    """
+    # Токены запрашиваются параллельно, но не больше лимита Bitquery одновременно
+    return await invoke_bulk(
+        analyze_token_holders, token_addresses, token_labels,
+        lambda token_address, token_label: {
+            "token_address": token_address,
+            "token_label": token_label,
+            "chain": chain
+        },
+        BITQUERY_MAX_CONCURRENCY
+    )
@@ -1,20 +1,50 @@
 """Инструменты для работы с HyperLiquid"""
 
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, List, Dict, Any
 from langchain_core.tools import tool
 from pawn.hyperliquid_trader_worflow import HyperliquidWorkflow
+from config.settings import HYPERLIQUID_CACHE_TTL, HYPERLIQUID_PRICE_CACHE_TTL
+from core.cache import TTLCache
 
 # Создаем синглтон экземпляра HyperliquidWorkflow для переиспользования
 _workflow_instance = None
+# Инструменты вызываются из разных потоков (пул workflow, сессии Streamlit):
+# блокировка не дает создать два экземпляра одновременно
+_workflow_lock = threading.Lock()
 
 def get_hyperliquid_workflow():
     """Возвращает экземпляр HyperliquidWorkflow (синглтон)"""
     global _workflow_instance
     if _workflow_instance is None:
-        _workflow_instance = HyperliquidWorkflow()
+        with _workflow_lock:
+            if _workflow_instance is None:
+                _workflow_instance = HyperliquidWorkflow()
     return _workflow_instance
 
+# Пул потоков для синхронного workflow.invoke: пока workflow ждет модель и API,
+# event loop продолжает выполнять другие инструменты
+_WORKFLOW_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hyperliquid")
+
+async def _invoke(prompt: str) -> Any:
+    """Выполняет запрос к HyperliquidWorkflow в пуле потоков."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_WORKFLOW_EXECUTOR, get_hyperliquid_workflow().invoke, prompt)
+
+# Ответы workflow на запросы только для чтения: цены устаревают за секунды,
+# свечи и рыночная информация - за минуты. Сделки и данные аккаунта не кэшируются
+_PRICE_CACHE = TTLCache(ttl_s=HYPERLIQUID_PRICE_CACHE_TTL, maxsize=512)
+_MARKET_CACHE = TTLCache(ttl_s=HYPERLIQUID_CACHE_TTL, maxsize=512)
+
+async def _cached_invoke(cache: TTLCache, prompt: str) -> str:
+    """Выполняет запрос к HyperliquidWorkflow или берет ответ на тот же запрос из кэша."""
+    async def fetch():
+        return str(await _invoke(prompt))
+
+    return await cache.get_or_set(prompt, fetch)
+
 @tool
 async def get_crypto_price(symbol: str) -> str:
     """
@@ -23,9 +53,7 @@ async def get_crypto_price(symbol: str) -> str:
     Args:
         symbol: Символ актива (например, BTC, ETH, HYPE)
     """
-    workflow = get_hyperliquid_workflow()
-    result = workflow.invoke(f"What is {symbol} price now?")
-    return str(result)
+    return await _cached_invoke(_PRICE_CACHE, f"What is {symbol.upper()} price now?")
 
 @tool
 async def get_klines_history(symbol: str, days: int = 7) -> str:
@@ -36,9 +64,7 @@ async def get_klines_history(symbol: str, days: int = 7) -> str:
         symbol: Символ актива (например, BTC, ETH, HYPE)
         days: Количество дней истории (по умолчанию 7)
     """
-    workflow = get_hyperliquid_workflow()
-    result = workflow.invoke(f"Send me {symbol} klines history for last {days} days?")
-    return str(result)
+    return await _cached_invoke(_MARKET_CACHE, f"Send me {symbol.upper()} klines history for last {days} days?")
 
 @tool
 async def execute_trade(symbol: str, amount: float, side: str = "buy") -> str:
@@ -77,9 +103,8 @@ async def confirm_trade(symbol: str, amount: float, side: str = "buy") -> str:
         amount: Количество для торговли
         side: Сторона сделки ('buy' или 'sell', по умолчанию 'buy')
     """
-    workflow = get_hyperliquid_workflow()
     request = f"Make a trade for {amount} {symbol} {side}"
-    result = workflow.invoke(request)
+    result = await _invoke(request)
     return f"Операция выполнена: {side} {amount} {symbol}\nРезультат: {result}"
 
 @tool
@@ -90,15 +115,12 @@ async def get_market_info(symbol: str) -> str:
     Args:
         symbol: Символ актива (например, BTC, ETH, HYPE)
     """
-    workflow = get_hyperliquid_workflow()
-    result = workflow.invoke(f"Get market info for {symbol}")
-    return str(result)
+    return await _cached_invoke(_MARKET_CACHE, f"Get market info for {symbol.upper()}")
 
 @tool
 async def get_account_info() -> str:
     """
     Получает информацию о текущем аккаунте на HyperLiquid.
     """
-    workflow = get_hyperliquid_workflow()
-    result = workflow.invoke("Get my account information")
+    result = await _invoke("Get my account information")
     return str(result)
\ No newline at end of file
@@ -1,48 +1,179 @@
 """Инструменты для работы с LlamaFeed - получение новостей, твитов, информации о хаках и т.д."""
 
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, List, Dict, Any
 from datetime import datetime, timedelta, timezone
 from langchain_core.tools import tool
 from pawn.llamafeed_worflow.worflow import LlamaFeedWorkflow
+from config.settings import LLAMAFEED_CACHE_TTL, LLAMAFEED_MAX_CONCURRENCY
+from core.cache import TTLCache
 
 # Создаем синглтон экземпляра LlamaFeedWorkflow для переиспользования
 _llamafeed_instance = None
+# Блокировка не дает двум потокам одновременно создать два экземпляра
+_llamafeed_lock = threading.Lock()
 
 def get_llamafeed_workflow():
     """Возвращает экземпляр LlamaFeedWorkflow (синглтон)"""
     global _llamafeed_instance
     if _llamafeed_instance is None:
-        _llamafeed_instance = LlamaFeedWorkflow(openai_model="gpt-4o")
+        with _llamafeed_lock:
+            if _llamafeed_instance is None:
+                _llamafeed_instance = LlamaFeedWorkflow(openai_model="gpt-4o")
     return _llamafeed_instance
 
-@tool
-async def get_crypto_news(days: int = 3) -> str:
+# Пул потоков для синхронного workflow.invoke: запросы к разным лентам выполняются
+# параллельно и не блокируют event loop
+_WORKFLOW_EXECUTOR = ThreadPoolExecutor(max_workers=LLAMAFEED_MAX_CONCURRENCY, thread_name_prefix="llamafeed")
+
+# Ленты меняются за минуты, поэтому повторные запросы за тот же период берутся из кэша
+_QUERY_CACHE = TTLCache(ttl_s=LLAMAFEED_CACHE_TTL, maxsize=128)
+
+async def _query_feed(query: str, days: int) -> Dict[str, Any]:
     """
-    Получает новости о криптовалютах за указанное количество дней.
+    Выполняет запрос к LlamaFeed за последние days дней.
 
     Args:
-        days: Количество дней для получения новостей (по умолчанию 3)
+        query: Текст запроса с подстановкой {since} для начала периода
+        days: Длина периода в днях
     """
-    workflow = get_llamafeed_workflow()
-    since = datetime.now(timezone.utc) - timedelta(days=days)
-    result = workflow.invoke(f"Give me crypto news since {since.isoformat()}")
-
+    async def fetch():
+        since = datetime.now(timezone.utc) - timedelta(days=days)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _WORKFLOW_EXECUTOR, get_llamafeed_workflow().invoke, query.format(since=since.isoformat())
+        )
+
+    return await _QUERY_CACHE.get_or_set((query, days), fetch)
+
+# Шаблоны записей разделов: строки собираются в список и склеиваются одним join,
+# а не наращиваются через += (квадратичное копирование на длинных лентах)
+_NEWS_ITEM = "📌 **{title}**\n📅 {pub_date}\n🔍 Настроение: {sentiment}\n🔗 {link}\n\n"
+_TWEET_ITEM = "👤 **@{user_name}**\n💬 {tweet}\n📅 {created_at}\n🔍 Настроение: {sentiment}\n\n"
+_HACK_ITEM = "🔐 **{name}**\n📅 {timestamp}\n💰 Украдено: {amount}\n🛠️ Техника: {technique}\n🔗 {source_url}\n\n"
+_UNLOCK_ITEM = "🏢 **{project}**\n📅 Дата: {date}\n🔢 Количество: {amount}\n"
+_UNLOCK_PERCENTAGE = "📊 Процент от общего предложения: {percentage}\n"
+_RAISE_ITEM = "🏢 **{project}**\n📅 Дата: {date}\n💰 Сумма: {amount}\n👥 Инвесторы: {investors}\n\n"
+_POLYMARKET_ITEM = "❓ **{question}**\n📅 Дата окончания: {end_date}\n📊 Вероятность: {probability}\n💹 Объем: {volume}\n\n"
+
+def _format_news(result: Dict[str, Any]) -> str:
+    """Форматирует раздел новостей из ответа LlamaFeed."""
     # Форматируем результат для более удобного чтения
-    formatted_result = "🗞️ **ПОСЛЕДНИЕ КРИПТОНОВОСТИ**\n\n"
+    parts = ["🗞️ **ПОСЛЕДНИЕ КРИПТОНОВОСТИ**\n\n"]
 
     for item in result.get('news', [])[:10]:  # Ограничиваем 10 новостями для читаемости
-        title = item.get('title', 'Без заголовка')
-        pub_date = item.get('pub_date', 'Неизвестно')
-        sentiment = item.get('sentiment', 'нейтральный')
-        link = item.get('link', '#')
+        parts.append(_NEWS_ITEM.format_map({
+            'title': item.get('title', 'Без заголовка'),
+            'pub_date': item.get('pub_date', 'Неизвестно'),
+            'sentiment': item.get('sentiment', 'нейтральный'),
+            'link': item.get('link', '#')
+        }))
+
+    return "".join(parts)
+
+def _format_tweets(result: Dict[str, Any]) -> str:
+    """Форматирует раздел твитов из ответа LlamaFeed."""
+    # Форматируем результат
+    parts = ["🐦 **ВАЖНЫЕ КРИПТОТВИТЫ**\n\n"]
+
+    for item in result.get('tweets', [])[:10]:  # Ограничиваем 10 твитами
+        parts.append(_TWEET_ITEM.format_map({
+            'tweet': item.get('tweet', 'Нет текста'),
+            'created_at': item.get('tweet_created_at', 'Неизвестно'),
+            'user_name': item.get('user_name', 'Аноним'),
+            'sentiment': item.get('sentiment', 'нейтральный')
+        }))
 
-        formatted_result += f"📌 **{title}**\n"
-        formatted_result += f"📅 {pub_date}\n"
-        formatted_result += f"🔍 Настроение: {sentiment}\n"
-        formatted_result += f"🔗 {link}\n\n"
+    return "".join(parts)
+
+def _format_hacks(result: Dict[str, Any]) -> str:
+    """Форматирует раздел хаков из ответа LlamaFeed."""
+    # Форматируем результат
+    parts = ["⚠️ **НЕДАВНИЕ КРИПТОВАЛЮТНЫЕ ХАКИ**\n\n"]
+
+    for item in result.get('hacks', []):
+        parts.append(_HACK_ITEM.format_map({
+            'name': item.get('name', 'Неизвестный проект'),
+            'timestamp': item.get('timestamp', 'Неизвестно'),
+            'amount': item.get('amount', 'Неизвестная сумма'),
+            'source_url': item.get('source_url', '#'),
+            'technique': item.get('technique', 'Не указана')
+        }))
+
+    if not result.get('hacks'):
+        parts.append("За указанный период хаков не обнаружено.\n")
+
+    return "".join(parts)
+
+def _format_unlocks(result: Dict[str, Any]) -> str:
+    """Форматирует раздел разблокировок токенов из ответа LlamaFeed."""
+    # Форматируем результат
+    parts = ["🔓 **ПРЕДСТОЯЩИЕ РАЗБЛОКИРОВКИ ТОКЕНОВ**\n\n"]
+
+    for item in result.get('unlocks', []):
+        parts.append(_UNLOCK_ITEM.format_map({
+            'project': item.get('project', 'Неизвестный проект'),
+            'date': item.get('date', 'Неизвестная дата'),
+            'amount': item.get('amount', 'Неизвестное количество')
+        }))
+        percentage = item.get('percentage', 'Неизвестный процент')
+        if percentage:
+            parts.append(_UNLOCK_PERCENTAGE.format_map({'percentage': percentage}))
+        parts.append("\n")
+
+    if not result.get('unlocks'):
+        parts.append("За указанный период разблокировок не обнаружено.\n")
+
+    return "".join(parts)
+
+def _format_raises(result: Dict[str, Any]) -> str:
+    """Форматирует раздел привлечений средств из ответа LlamaFeed."""
+    # Форматируем результат
+    parts = ["💸 **НЕДАВНИЕ ПРИВЛЕЧЕНИЯ СРЕДСТВ**\n\n"]
+
+    for item in result.get('raises', []):
+        parts.append(_RAISE_ITEM.format_map({
+            'project': item.get('project', 'Неизвестный проект'),
+            'date': item.get('date', 'Неизвестная дата'),
+            'amount': item.get('amount', 'Неизвестная сумма'),
+            'investors': item.get('investors', 'Не указаны')
+        }))
+
+    if not result.get('raises'):
+        parts.append("За указанный период привлечений средств не обнаружено.\n")
+
+    return "".join(parts)
+
+def _format_polymarket(result: Dict[str, Any]) -> str:
+    """Форматирует раздел данных Polymarket из ответа LlamaFeed."""
+    # Форматируем результат
+    parts = ["🔮 **ДАННЫЕ ПРЕДИКТИВНОГО РЫНКА POLYMARKET**\n\n"]
+
+    for item in result.get('polymarket', []):
+        parts.append(_POLYMARKET_ITEM.format_map({
+            'question': item.get('question', 'Нет вопроса'),
+            'end_date': item.get('end_date', 'Неизвестно'),
+            'probability': item.get('probability', 'Неизвестно'),
+            'volume': item.get('volume', 'Неизвестно')
+        }))
+
+    if not result.get('polymarket'):
+        parts.append("За указанный период данных не обнаружено.\n")
+
+    return "".join(parts)
+
+@tool
+async def get_crypto_news(days: int = 3) -> str:
+    """
+    Получает новости о криптовалютах за указанное количество дней.
 
-    return formatted_result
+    Args:
+        days: Количество дней для получения новостей (по умолчанию 3)
+    """
+    result = await _query_feed("Give me crypto news since {since}", days)
+    return _format_news(result)
 
 @tool
 async def get_crypto_tweets(days: int = 3) -> str:
@@ -52,25 +183,8 @@ async def get_crypto_tweets(days: int = 3) -> str:
     Args:
         days: Количество дней для получения твитов (по умолчанию 3)
     """
-    workflow = get_llamafeed_workflow()
-    since = datetime.now(timezone.utc) - timedelta(days=days)
-    result = workflow.invoke(f"Fetch tweets since {since.isoformat()}")
-
-    # Форматируем результат
-    formatted_result = "🐦 **ВАЖНЫЕ КРИПТОТВИТЫ**\n\n"
-
-    for item in result.get('tweets', [])[:10]:  # Ограничиваем 10 твитами
-        tweet = item.get('tweet', 'Нет текста')
-        created_at = item.get('tweet_created_at', 'Неизвестно')
-        user_name = item.get('user_name', 'Аноним')
-        sentiment = item.get('sentiment', 'нейтральный')
-
-        formatted_result += f"👤 **@{user_name}**\n"
-        formatted_result += f"💬 {tweet}\n"
-        formatted_result += f"📅 {created_at}\n"
-        formatted_result += f"🔍 Настроение: {sentiment}\n\n"
-
-    return formatted_result
+    result = await _query_feed("Fetch tweets since {since}", days)
+    return _format_tweets(result)
 
 @tool
 async def get_crypto_hacks(days: int = 30) -> str:
@@ -80,30 +194,8 @@ async def get_crypto_hacks(days: int = 30) -> str:
     Args:
         days: Количество дней для получения данных о хаках (по умолчанию 30)
     """
-    workflow = get_llamafeed_workflow()
-    since = datetime.now(timezone.utc) - timedelta(days=days)
-    result = workflow.invoke(f"What crypto hacks happened since {since.isoformat()}?")
-
-    # Форматируем результат
-    formatted_result = "⚠️ **НЕДАВНИЕ КРИПТОВАЛЮТНЫЕ ХАКИ**\n\n"
-
-    for item in result.get('hacks', []):
-        name = item.get('name', 'Неизвестный проект')
-        timestamp = item.get('timestamp', 'Неизвестно')
-        amount = item.get('amount', 'Неизвестная сумма')
-        source_url = item.get('source_url', '#')
-        technique = item.get('technique', 'Не указана')
-
-        formatted_result += f"🔐 **{name}**\n"
-        formatted_result += f"📅 {timestamp}\n"
-        formatted_result += f"💰 Украдено: {amount}\n"
-        formatted_result += f"🛠️ Техника: {technique}\n"
-        formatted_result += f"🔗 {source_url}\n\n"
-
-    if not result.get('hacks'):
-        formatted_result += "За указанный период хаков не обнаружено.\n"
-
-    return formatted_result
+    result = await _query_feed("What crypto hacks happened since {since}?", days)
+    return _format_hacks(result)
 
 @tool
 async def get_token_unlocks(days: int = 30) -> str:
@@ -113,30 +205,8 @@ async def get_token_unlocks(days: int = 30) -> str:
     Args:
         days: Количество дней для получения данных о разблокировках (по умолчанию 30)
     """
-    workflow = get_llamafeed_workflow()
-    since = datetime.now(timezone.utc) - timedelta(days=days)
-    result = workflow.invoke(f"Are there any unlocks or raises since {since.isoformat()}?")
-
-    # Форматируем результат
-    formatted_result = "🔓 **ПРЕДСТОЯЩИЕ РАЗБЛОКИРОВКИ ТОКЕНОВ**\n\n"
-
-    for item in result.get('unlocks', []):
-        project = item.get('project', 'Неизвестный проект')
-        date = item.get('date', 'Неизвестная дата')
-        amount = item.get('amount', 'Неизвестное количество')
-        percentage = item.get('percentage', 'Неизвестный процент')
-
-        formatted_result += f"🏢 **{project}**\n"
-        formatted_result += f"📅 Дата: {date}\n"
-        formatted_result += f"🔢 Количество: {amount}\n"
-        if percentage:
-            formatted_result += f"📊 Процент от общего предложения: {percentage}\n"
-        formatted_result += "\n"
-
-    if not result.get('unlocks'):
-        formatted_result += "За указанный период разблокировок не обнаружено.\n"
-
-    return formatted_result
+    result = await _query_feed("Are there any unlocks or raises since {since}?", days)
+    return _format_unlocks(result)
 
 @tool
 async def get_project_raises(days: int = 30) -> str:
@@ -146,28 +216,8 @@ async def get_project_raises(days: int = 30) -> str:
     Args:
         days: Количество дней для получения данных о финансировании (по умолчанию 30)
     """
-    workflow = get_llamafeed_workflow()
-    since = datetime.now(timezone.utc) - timedelta(days=days)
-    result = workflow.invoke(f"Are there any unlocks or raises since {since.isoformat()}?")
-
-    # Форматируем результат
-    formatted_result = "💸 **НЕДАВНИЕ ПРИВЛЕЧЕНИЯ СРЕДСТВ**\n\n"
-
-    for item in result.get('raises', []):
-        project = item.get('project', 'Неизвестный проект')
-        date = item.get('date', 'Неизвестная дата')
-        amount = item.get('amount', 'Неизвестная сумма')
-        investors = item.get('investors', 'Не указаны')
-
-        formatted_result += f"🏢 **{project}**\n"
-        formatted_result += f"📅 Дата: {date}\n"
-        formatted_result += f"💰 Сумма: {amount}\n"
-        formatted_result += f"👥 Инвесторы: {investors}\n\n"
-
-    if not result.get('raises'):
-        formatted_result += "За указанный период привлечений средств не обнаружено.\n"
-
-    return formatted_result
+    result = await _query_feed("Are there any unlocks or raises since {since}?", days)
+    return _format_raises(result)
 
 @tool
 async def get_polymarket_data(days: int = 7) -> str:
@@ -177,28 +227,38 @@ async def get_polymarket_data(days: int = 7) -> str:
     Args:
         days: Количество дней для получения данных (по умолчанию 7)
     """
-    workflow = get_llamafeed_workflow()
-    since = datetime.now(timezone.utc) - timedelta(days=days)
-    result = workflow.invoke(f"Get Polymarket data since {since.isoformat()}")
-
-    # Форматируем результат
-    formatted_result = "🔮 **ДАННЫЕ ПРЕДИКТИВНОГО РЫНКА POLYMARKET**\n\n"
+    result = await _query_feed("Get Polymarket data since {since}", days)
+    return _format_polymarket(result)
+
+# Разделы пакетного запроса и их форматирование
+_BUNDLE_SECTIONS = {
+    "news": _format_news,
+    "tweets": _format_tweets,
+    "hacks": _format_hacks,
+    "unlocks": _format_unlocks,
+    "raises": _format_raises,
+    "polymarket": _format_polymarket
+}
 
-    for item in result.get('polymarket', []):
-        question = item.get('question', 'Нет вопроса')
-        end_date = item.get('end_date', 'Неизвестно')
-        probability = item.get('probability', 'Неизвестно')
-        volume = item.get('volume', 'Неизвестно')
+@tool
+async def get_llamafeed_bundle(days: int = 3, sections: Optional[List[str]] = None) -> str:
+    """
+    Получает сразу несколько разделов LlamaFeed одним запросом: новости, твиты, хаки,
+    разблокировки токенов, привлечения средств и данные Polymarket.
 
-        formatted_result += f"❓ **{question}**\n"
-        formatted_result += f"📅 Дата окончания: {end_date}\n"
-        formatted_result += f"📊 Вероятность: {probability}\n"
-        formatted_result += f"💹 Объем: {volume}\n\n"
+    Используйте вместо нескольких отдельных инструментов LlamaFeed, когда нужны несколько разделов.
 
-    if not result.get('polymarket'):
-        formatted_result += "За указанный период данных не обнаружено.\n"
+    Args:
+        days: Количество дней для получения данных (по умолчанию 3)
+        sections: Нужные разделы из news, tweets, hacks, unlocks, raises, polymarket (по умолчанию все)
+    """
+    selected = [section for section in (sections or _BUNDLE_SECTIONS) if section in _BUNDLE_SECTIONS]
+    if not selected:
+        return f"Неизвестные разделы. Доступные разделы: {', '.join(_BUNDLE_SECTIONS)}"
 
-    return formatted_result
+    # Один вызов workflow вместо отдельного запроса на каждый раздел
+    result = await _query_feed(f"Return JSON with keys {', '.join(selected)} since {{since}}", days)
+    return "\n".join(_BUNDLE_SECTIONS[section](result) for section in selected)
 
 @tool
 async def get_market_summary(days: int = 3) -> str:
@@ -208,38 +268,35 @@ async def get_market_summary(days: int = 3) -> str:
     Args:
         days: Количество дней для анализа (по умолчанию 3)
     """
-    workflow = get_llamafeed_workflow()
-    since = datetime.now(timezone.utc) - timedelta(days=days)
-
     # Собираем данные из разных источников
-    result = workflow.invoke(f"Provide a comprehensive market summary since {since.isoformat()} including news, tweets, and important events")
+    result = await _query_feed("Provide a comprehensive market summary since {since} including news, tweets, and important events", days)
 
     # Форматируем результат
-    formatted_result = "📊 **КОМПЛЕКСНЫЙ ОБЗОР КРИПТОВАЛЮТНОГО РЫНКА**\n\n"
+    parts = ["📊 **КОМПЛЕКСНЫЙ ОБЗОР КРИПТОВАЛЮТНОГО РЫНКА**\n\n"]
 
     if 'summary' in result:
-        formatted_result += f"{result['summary']}\n\n"
+        parts.append(f"{result['summary']}\n\n")
 
     # Добавляем основные новости
     if 'news' in result and result['news']:
-        formatted_result += "**Ключевые новости:**\n"
+        parts.append("**Ключевые новости:**\n")
         for item in result['news'][:5]:
-            formatted_result += f"- {item.get('title', 'Нет заголовка')}\n"
-        formatted_result += "\n"
+            parts.append(f"- {item.get('title', 'Нет заголовка')}\n")
+        parts.append("\n")
 
     # Добавляем основные твиты
     if 'tweets' in result and result['tweets']:
-        formatted_result += "**Важные твиты:**\n"
+        parts.append("**Важные твиты:**\n")
         for item in result['tweets'][:3]:
             user = item.get('user_name', 'Аноним')
             tweet = item.get('tweet', 'Нет текста')
-            formatted_result += f"- @{user}: {tweet}\n"
-        formatted_result += "\n"
+            parts.append(f"- @{user}: {tweet}\n")
+        parts.append("\n")
 
     # Добавляем важные события
     if 'events' in result and result['events']:
-        formatted_result += "**Важные события:**\n"
+        parts.append("**Важные события:**\n")
         for item in result['events']:
-            formatted_result += f"- {item}\n"
+            parts.append(f"- {item}\n")
 
-    return formatted_result
+    return "".join(parts)
@@ -1,9 +1,20 @@
-import aiohttp
-import pandas as pd
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import numpy as np
+import orjson
 from langchain_core.tools import tool
-from config.settings import COINGECKO_API_KEY
+from ._coingecko import COINGECKO_DISPATCHER
+from ._http import invoke_bulk, request
+from config.settings import COINGECKO_API_KEY, COINGECKO_HISTORY_CACHE_TTL, COINGECKO_MAX_CONCURRENCY
+from core.cache import TTLCache, single_flight
+from core.retry import CircuitOpenError
+
+# Исторические данные за дни меняются не чаще раза в час: повторные запросы берутся из кэша
+_HISTORY_CACHE = TTLCache(ttl_s=COINGECKO_HISTORY_CACHE_TTL, maxsize=128)
 
 @tool
+@single_flight
 async def get_token_historical_data(token_id: str, token_label: str, vs_currency: str = 'usd', days: str = '90') -> str:
     """
     Получает исторические данные по токену с CoinGecko и анализирует их.
@@ -14,61 +25,99 @@ async def get_token_historical_data(token_id: str, token_label: str, vs_currency
         vs_currency: валюта, в которой выражены значения (по умолчанию 'usd')
         days: период в днях для запроса данных (по умолчанию '90')
     """
-    url = f'https://api.coingecko.com/api/v3/coins/{token_id}/market_chart'
-    params = {'vs_currency': vs_currency, 'days': days}
-    
-    if COINGECKO_API_KEY:
-        params['x_cg_demo_api_key'] = COINGECKO_API_KEY
-        
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as response:
+    cache_key = (token_id, vs_currency, days)
+    series = _HISTORY_CACHE.get(cache_key)
+    if series is None:
+        url = f'https://api.coingecko.com/api/v3/coins/{token_id}/market_chart'
+        params = {'vs_currency': vs_currency, 'days': days}
+
+        if COINGECKO_API_KEY:
+            params['x_cg_demo_api_key'] = COINGECKO_API_KEY
+
+        try:
+            response = await COINGECKO_DISPATCHER.submit(lambda: request("GET", url, params=params))
+        except CircuitOpenError as e:
+            return f"Ошибка при получении данных для {token_label}: {e}"
+
+        async with response:
             if response.status != 200:
                 response_text = await response.text()
                 return f"Ошибка при получении данных для {token_label}: {response_text}"
 
-            data = await response.json()
+            data = orjson.loads(await response.read())
 
-    # Преобразуем данные в датафреймы
-    prices = pd.DataFrame(data.get('prices', []), columns=['timestamp', 'price'])
-    market_caps = pd.DataFrame(data.get('market_caps', []), columns=['timestamp', 'market_cap'])
-    volumes = pd.DataFrame(data.get('total_volumes', []), columns=['timestamp', 'volume'])
+        # Ряды вида [timestamp_ms, значение] -> массивы формы (N, 2). В кэше хранятся
+        # уже преобразованные массивы: повторный анализ не разбирает списки заново
+        series = tuple(
+            np.array(data.get(key, []), dtype=np.float64).reshape(-1, 2)
+            for key in ('prices', 'market_caps', 'total_volumes')
+        )
+        _HISTORY_CACHE.set(cache_key, series)
 
-    for df in [prices, market_caps, volumes]:
-        df['date'] = pd.to_datetime(df['timestamp'], unit='ms')
+    # В даты переводятся только временные метки экстремумов
+    prices, market_caps, volumes = series
 
     # Анализ данных
     result = f"=== Анализ данных токена {token_label} за последние {days} дней ===\n\n"
 
     # Текущая цена и изменения
-    current_price = prices.iloc[-1]['price']
-    start_price = prices.iloc[0]['price']
+    current_price = prices[-1, 1]
+    start_price = prices[0, 1]
     price_change = ((current_price - start_price) / start_price) * 100
 
     result += f"Текущая цена: ${current_price:.6f}\n"
     result += f"Изменение цены за период: {price_change:.2f}%\n"
 
     # Минимальная и максимальная цены
-    min_price = prices['price'].min()
-    max_price = prices['price'].max()
-    min_date = prices.loc[prices['price'].idxmin(), 'date']
-    max_date = prices.loc[prices['price'].idxmax(), 'date']
+    min_index = int(prices[:, 1].argmin())
+    max_index = int(prices[:, 1].argmax())
+    min_price = prices[min_index, 1]
+    max_price = prices[max_index, 1]
+    min_date = datetime.fromtimestamp(prices[min_index, 0] / 1000, tz=timezone.utc)
+    max_date = datetime.fromtimestamp(prices[max_index, 0] / 1000, tz=timezone.utc)
 
     result += f"Минимальная цена: ${min_price:.6f} ({min_date.strftime('%Y-%m-%d')})\n"
     result += f"Максимальная цена: ${max_price:.6f} ({max_date.strftime('%Y-%m-%d')})\n\n"
 
     # Рыночная капитализация
-    current_market_cap = market_caps.iloc[-1]['market_cap']
-    start_market_cap = market_caps.iloc[0]['market_cap']
+    current_market_cap = market_caps[-1, 1]
+    start_market_cap = market_caps[0, 1]
     market_cap_change = ((current_market_cap - start_market_cap) / start_market_cap) * 100
 
     result += f"Текущая рыночная капитализация: ${current_market_cap:,.2f}\n"
     result += f"Изменение рыночной капитализации за период: {market_cap_change:.2f}%\n\n"
 
     # Объемы торгов
-    avg_volume = volumes['volume'].mean()
-    current_volume = volumes.iloc[-1]['volume']
+    avg_volume = volumes[:, 1].mean()
+    current_volume = volumes[-1, 1]
 
     result += f"Текущий объем торгов: ${current_volume:,.2f}\n"
     result += f"Средний объем торгов за период: ${avg_volume:,.2f}\n"
 
     return result
+
+@tool
+async def analyze_tokens_bulk(token_ids: List[str], token_labels: Optional[List[str]] = None,
+                              vs_currency: str = 'usd', days: str = '90') -> str:
+    """
+    Получает и анализирует исторические данные сразу нескольких токенов (например, для сравнения BTC, ETH и SOL).
+
+    Используйте вместо нескольких вызовов get_token_historical_data.
+
+    Args:
+        token_ids: идентификаторы токенов в CoinGecko (например, ['bitcoin', 'ethereum'])
+        token_labels: читаемые названия токенов в том же порядке (по умолчанию - идентификаторы)
+        vs_currency: валюта, в которой выражены значения (по умолчанию 'usd')
+        days: период в днях для запроса данных (по умолчанию '90')
+    """
+    # Токены запрашиваются параллельно, но не больше лимита CoinGecko одновременно
+    return await invoke_bulk(
+        get_token_historical_data, token_ids, token_labels,
+        lambda token_id, token_label: {
+            "token_id": token_id,
+            "token_label": token_label,
+            "vs_currency": vs_currency,
+            "days": days
+        },
+        COINGECKO_MAX_CONCURRENCY
+    )
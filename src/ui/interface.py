@@ -1,173 +1,407 @@
 """Компоненты пользовательского интерфейса."""
 
-from rich.console import Console
+import asyncio
+import functools
+import sys
+import threading
+import time
+from operator import attrgetter
+from rich.console import Console, Group, RenderableType
 from rich.panel import Panel
-from rich.prompt import Prompt
-from rich.markdown import Markdown
-from rich.live import Live
+from rich.rule import Rule
+from rich.table import Table
 from rich.text import Text
 from rich import box
-from typing import List, Dict, Any  
-from config.settings import APP_NAME, APP_COLOR
+from typing import TYPE_CHECKING, AsyncIterator, Callable, List, Dict, Any, Optional, Tuple
+from config.settings import APP_NAME, APP_COLOR, MARKDOWN_CACHE_SIZE
+
+if TYPE_CHECKING:
+    # Markdown (парсер markdown-it) и Live загружаются при первом выводе ответа,
+    # а не при запуске CLI
+    from rich.markdown import Markdown
 
 # Инициализация Rich консоли
 console = Console()
 
-def display_welcome():
-    """Отображает приветственный экран приложения."""
-    console.clear()
-    title = Text(APP_NAME, style=f"bold {APP_COLOR}")
-    console.print(Panel(
-        title, 
-        box=box.DOUBLE,
-        border_style=APP_COLOR,
-        padding=(1, 15)
-    ))
-    
-    console.print("\n[bold yellow]Доступные возможности:[/bold yellow]")
-    
+# Разделитель между взаимодействиями: готовый renderable, строится один раз при импорте
+SEPARATOR = Group(Text(), Rule(style="dim"), Text())
+
+# Строки приветствия (заголовки разделов и списки возможностей) с разметкой Rich
+_WELCOME_BODY_LINES: Tuple[str, ...] = (
+    "\n[bold yellow]Доступные возможности:[/bold yellow]",
+
     # Аналитические возможности
-    console.print("[bold cyan]Анализ криптовалют:[/bold cyan]")
-    console.print(" • Получение цен токенов")
-    console.print(" • Анализ трендовых монет")
-    console.print(" • Поиск информации о криптовалютах")
-    console.print(" • Анализ DeFi протоколов и пулов")
-    console.print(" • Исторический анализ токенов")
-    console.print(" • Анализ держателей токенов")
-    
+    "[bold cyan]Анализ криптовалют:[/bold cyan]",
+    " • Получение цен токенов",
+    " • Анализ трендовых монет",
+    " • Поиск информации о криптовалютах",
+    " • Анализ DeFi протоколов и пулов",
+    " • Исторический анализ токенов",
+    " • Анализ держателей токенов",
+
     # Торговые возможности
-    console.print("\n[bold cyan]Торговля (HyperLiquid):[/bold cyan]")
-    console.print(" • Получение цен активов")
-    console.print(" • Графики и история свечей")
-    console.print(" • Выполнение торговых операций")
-    console.print(" • Информация о рынках и аккаунте")
-    
+    "\n[bold cyan]Торговля (HyperLiquid):[/bold cyan]",
+    " • Получение цен активов",
+    " • Графики и история свечей",
+    " • Выполнение торговых операций",
+    " • Информация о рынках и аккаунте",
+
     # Новостные возможности
-    console.print("\n[bold cyan]Новости и информация (LlamaFeed):[/bold cyan]")
-    console.print(" • Последние криптоновости")
-    console.print(" • Значимые твиты из криптомира")
-    console.print(" • Информация о хаках и уязвимостях")
-    console.print(" • Данные о разблокировках токенов")
-    console.print(" • Информация о финансировании проектов")
-    console.print(" • Данные Polymarket")
-    console.print(" • Комплексный обзор рынка")
-    
-    console.print("\n[bold yellow]Специальные команды:[/bold yellow]")
-    console.print(" • /research SYMBOL - Запустить глубокое исследование токена (например: /research BTC)")
-    console.print(" • exit, quit, q - Выход из приложения")
-    
-    console.print("\n[dim](Введите команду или запрос)[/dim]\n")
+    "\n[bold cyan]Новости и информация (LlamaFeed):[/bold cyan]",
+    " • Последние криптоновости",
+    " • Значимые твиты из криптомира",
+    " • Информация о хаках и уязвимостях",
+    " • Данные о разблокировках токенов",
+    " • Информация о финансировании проектов",
+    " • Данные Polymarket",
+    " • Комплексный обзор рынка",
 
-def display_response(response_text):
-    """Отображает ответ ассистента в красивом формате."""
-    console.print(Panel(
-        Markdown(response_text),
-        title="🤖 [bold blue]Ответ ассистента[/bold blue]",
+    "\n[bold yellow]Специальные команды:[/bold yellow]",
+    " • /research SYMBOL - Запустить глубокое исследование токена (например: /research BTC)",
+    " • exit, quit, q - Выход из приложения",
+
+    "\n[dim](Введите команду или запрос)[/dim]\n"
+)
+
+# Текст приветствия разбирается из разметки один раз при импорте, а не при каждом выводе
+_WELCOME_BODY = Text.from_markup("\n".join(_WELCOME_BODY_LINES))
+
+# Заголовок зависит только от констант настроек: панель строится один раз
+_TITLE_PANEL = Panel(
+    Text(APP_NAME, style=f"bold {APP_COLOR}"),
+    box=box.DOUBLE,
+    border_style=APP_COLOR,
+    padding=(1, 15)
+)
+
+_WELCOME_RENDERABLE = Group(_TITLE_PANEL, _WELCOME_BODY)
+
+def display_welcome():
+    """Отображает приветственный экран приложения."""
+    console.clear()
+    # Весь экран выводится одним вызовом
+    console.print(_WELCOME_RENDERABLE)
+
+# Заголовки панелей: постоянная часть разбирается из разметки один раз
+_RESPONSE_TITLE = Text.from_markup("🤖 [bold blue]Ответ ассистента[/bold blue]")
+_RESEARCH_TITLE_PREFIX = Text.from_markup("🔬 [bold blue]Глубокое исследование [/bold blue]")
+
+@functools.lru_cache(maxsize=MARKDOWN_CACHE_SIZE)
+def _md(text: str) -> "Markdown":
+    """Разбирает Markdown; готовые ответы при повторном выводе не разбираются заново."""
+    from rich.markdown import Markdown
+    return Markdown(text)
+
+def _response_panel(response_text: str, partial: bool = False) -> Panel:
+    """Создает панель с ответом ассистента (partial - промежуточный текст потока, не кэшируется)."""
+    from rich.markdown import Markdown
+    return Panel(
+        Markdown(response_text) if partial else _md(response_text),
+        title=_RESPONSE_TITLE,
         title_align="left",
         border_style="blue",
         box=box.ROUNDED,
         padding=1
-    ))
+    )
+
+def display_response(response_text):
+    """Отображает ответ ассистента в красивом формате."""
+    console.print(_response_panel(response_text))
+
+class StreamingResponseView:
+    """
+    Область терминала, в которой ответ перерисовывается по мере поступления фрагментов.
+
+    Фрагменты копятся в буфере; Markdown разбирается, а панель в Live подменяется не чаще
+    частоты обновления экрана, а не на каждый фрагмент. При выходе выводится итоговый текст.
+    """
+
+    def __init__(self, panel: Callable[[str, bool], Panel], show_empty: bool = False,
+                 refresh_per_second: int = 8):
+        """
+        Args:
+            panel: Функция (текст, partial) -> панель для отображения
+            show_empty: Выводить ли панель, если не пришло ни одного фрагмента
+            refresh_per_second: Частота перерисовки
+        """
+        self._panel = panel
+        self._show_empty = show_empty
+        self._refresh_per_second = refresh_per_second
+        self._parts: List[str] = []
+        self._live = None
+        self._last_update = 0.0
+
+    @property
+    def started(self) -> bool:
+        """Начат ли вывод (пришел ли первый фрагмент)."""
+        return self._live is not None
+
+    @property
+    def text(self) -> str:
+        """Текст, полученный к текущему моменту."""
+        return "".join(self._parts)
+
+    def __enter__(self) -> "StreamingResponseView":
+        return self
+
+    def update(self, chunk: str) -> None:
+        """Добавляет фрагмент и при необходимости перерисовывает панель."""
+        self._parts.append(chunk)
+        # Live запускается на первом фрагменте, чтобы не конфликтовать со спиннерами до него
+        if self._live is None:
+            from rich.live import Live
+            self._live = Live(console=console, refresh_per_second=self._refresh_per_second,
+                              vertical_overflow="visible")
+            self._live.start()
+        # Markdown перестраивается не чаще частоты обновления экрана
+        now = time.monotonic()
+        if now - self._last_update >= 1 / self._refresh_per_second:
+            self._live.update(self._panel(self.text, True))
+            self._last_update = now
+
+    def __exit__(self, *exc_info) -> None:
+        if self._live is not None:
+            self._live.update(self._panel(self.text, False))
+            self._live.stop()
+        elif self._show_empty:
+            console.print(self._panel(self.text, False))
+
+async def display_response_stream(chunks: AsyncIterator[str]) -> str:
+    """
+    Отображает ответ ассистента по мере генерации.
+
+    Args:
+        chunks: Асинхронный поток фрагментов ответа
+
+    Returns:
+        Полный текст ответа
+    """
+    # Пока модель выбирает и вызывает инструменты, показываем спиннер
+    status = display_thinking()
+    status.start()
+    with StreamingResponseView(_response_panel, show_empty=True) as view:
+        try:
+            async for chunk in chunks:
+                if not view.started:
+                    status.stop()
+                view.update(chunk)
+        finally:
+            status.stop()
+
+    return view.text
 
 def get_multiline_input():
     """Обрабатывает многострочный ввод пользователя."""
+    # Ввод из канала (не терминал) читается целиком одним вызовом; как и input(),
+    # на исчерпанном потоке выбрасывается EOFError
+    if not sys.stdin.isatty():
+        text = sys.stdin.read()
+        if not text:
+            raise EOFError
+        return text.rstrip("\n")
+
     lines = []
+    append = lines.append
     console.print("[bold green]Введите запрос (для завершения введите пустую строку):[/bold green]")
     
     while True:
         line = input("│ " if lines else "╭ ")
         if not line and lines:  # Пустая строка завершает ввод
             break
-        lines.append(line)
+        append(line)
     
     return "\n".join(lines)
 
-def display_thinking(message: str = "Модель думает...") -> Console.status:
+async def get_multiline_input_async() -> str:
+    """Многострочный ввод без блокировки event loop: stdin читается в отдельном потоке."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def read():
+        try:
+            result = get_multiline_input()
+        except BaseException as e:
+            loop.call_soon_threadsafe(resolve, None, e)
+        else:
+            loop.call_soon_threadsafe(resolve, result, None)
+
+    # Поток-демон не задерживает завершение программы по Ctrl+C, пока ожидается ввод
+    threading.Thread(target=read, name="user-input", daemon=True).start()
+    return await future
+
+_DEFAULT_THINKING_MESSAGE = "Модель думает..."
+_DEFAULT_THINKING = f"[bold green]{_DEFAULT_THINKING_MESSAGE}[/bold green]"
+
+def display_thinking(message: str = _DEFAULT_THINKING_MESSAGE) -> Console.status:
     """Показывает анимацию с кастомным сообщением."""
-    return console.status(f"[bold green]{message}[/bold green]", spinner="dots")
+    text = _DEFAULT_THINKING if message == _DEFAULT_THINKING_MESSAGE else f"[bold green]{message}[/bold green]"
+    return console.status(text, spinner="dots")
+
+# Прощальное сообщение не меняется: разметка разбирается один раз при импорте
+_EXIT_TEXT = Text.from_markup("\n[bold cyan]До свидания! Спасибо за использование Crypto Analysis Assistant![/bold cyan]")
 
 def display_exit_message():
     """Отображает сообщение при выходе из приложения."""
-    console.print("\n[bold cyan]До свидания! Спасибо за использование Crypto Analysis Assistant![/bold cyan]")
+    console.print(_EXIT_TEXT)
 
 def display_separator():
     """Отображает разделитель между взаимодействиями."""
-    console.print("\n" + "-" * 80 + "\n")
+    console.print(SEPARATOR)
+
+def display_turn_summary(response_text: Optional[str], footer: List[RenderableType]) -> None:
+    """
+    Выводит ответ и завершающие блоки хода одним вызовом console.print.
+
+    Args:
+        response_text: Текст ответа (None, если ответ уже выведен потоком)
+        footer: Блоки, выводимые после ответа (время обработки, разделитель, статистика)
+    """
+    renderables = [] if response_text is None else [_response_panel(response_text)]
+    renderables.extend(footer)
+    console.print(Group(*renderables))
     
-def display_research_result(result: str, token_symbol: str):
-    """Отображает результаты глубокого исследования токена."""
-    console.print(Panel(
-        Markdown(result),
-        title=f"🔬 [bold blue]Глубокое исследование {token_symbol}[/bold blue]",
+def _research_panel(result: str, token_symbol: str, partial: bool = False) -> Panel:
+    """Формирует панель с отчетом глубокого исследования (partial - промежуточный текст потока)."""
+    from rich.markdown import Markdown
+    return Panel(
+        Markdown(result) if partial else _md(result),
+        title=Text.assemble(_RESEARCH_TITLE_PREFIX, (token_symbol, "bold blue")),
         title_align="left",
         border_style="blue",
         box=box.ROUNDED,
         padding=1,
         width=100  # Фиксированная ширина для лучшего форматирования Markdown
-    ))
-    
-    console.print("\n[dim italic]Исследование завершено. Используйте эти данные на свой страх и риск.[/dim italic]")
-    display_separator()
+    )
+
+# Завершающее сообщение исследования вместе с разделителем
+_RESEARCH_FOOTER = Group(
+    Text.from_markup("\n[dim italic]Исследование завершено. Используйте эти данные на свой страх и риск.[/dim italic]"),
+    SEPARATOR
+)
+
+def display_research_result(result: str, token_symbol: str):
+    """Отображает результаты глубокого исследования токена."""
+    # Отчет, сообщение и разделитель выводятся одной записью в терминал
+    console.print(Group(_research_panel(result, token_symbol), _RESEARCH_FOOTER))
+
+# Подписи этапов deep research для вывода прогресса
+_RESEARCH_PHASES = {
+    "prepare": "Определяю параметры исследования...",
+    "gather": "Собираю данные из источников...",
+    "analyze": "Анализирую данные и формирую отчет...",
+}
+
+def display_research_progress(phase: str, event: str) -> None:
+    """Выводит строку о начале этапа deep research (колбэк on_progress)."""
+    if event == "start":
+        console.print(f"[dim]• {_RESEARCH_PHASES.get(phase, phase)}[/dim]")
+
+async def display_research_stream(chunks: AsyncIterator[str], token_symbol: str) -> str:
+    """
+    Отображает отчет глубокого исследования по мере его генерации.
+
+    Args:
+        chunks: Асинхронный поток фрагментов отчета
+        token_symbol: Символ исследуемого токена
+
+    Returns:
+        Полный текст отчета
+    """
+    with StreamingResponseView(lambda text, partial: _research_panel(text, token_symbol, partial)) as view:
+        async for chunk in chunks:
+            view.update(chunk)
+
+    console.print(_RESEARCH_FOOTER)
+    return view.text
     
     
+# Колонки таблиц мультиагентной системы: (заголовок, стиль)
+_TASK_COLS = (("Параметр", "cyan"), ("Значение", "magenta"))
+_AGENT_COLS = (("ID", "cyan"), ("Роль", "magenta"), ("Статус", "green"))
+_RESULT_COLS = (("ID задачи", "cyan"), ("Статус", "magenta"), ("Результат", None))
+_STATS_COLS = (("Метрика", "cyan"), ("Значение", "magenta"))
+
+# Статусы задач с готовой разметкой цвета
+_STATUS_MARKUP = {
+    "completed": "[green]completed[/green]",
+    "in_progress": "[yellow]in_progress[/yellow]",
+    "failed": "[red]failed[/red]"
+}
+
+# Роль и состояние агента извлекаются одним вызовом attrgetter
+_agent_fields = attrgetter("role.value", "state")
+_STATE_MARKUP = {True: "[green]Активен[/green]", False: "[red]Неактивен[/red]"}
+
+def _new_table(title: Optional[str], cols: Tuple[Tuple[str, Optional[str]], ...]) -> Table:
+    """Создает таблицу с заданными колонками."""
+    table = Table(box=box.ROUNDED, title=title)
+    for name, style in cols:
+        table.add_column(name, style=style)
+    return table
+
 def display_task_status(task_info: Dict[str, Any]) -> None:
     """Отображает статус конкретной задачи."""
-    table = Table(box=box.ROUNDED, title="Статус задачи")
-    table.add_column("Параметр", style="cyan")
-    table.add_column("Значение", style="magenta")
-    
-    status_colors = {
-        "completed": "green",
-        "in_progress": "yellow",
-        "failed": "red"
-    }
+    table = _new_table("Статус задачи", _TASK_COLS)
     
     for key, value in task_info.items():
         if key == "status":
-            color = status_colors.get(value, "white")
-            value = f"[{color}]{value}[/{color}]"
+            value = _STATUS_MARKUP.get(value) or f"[white]{value}[/white]"
         table.add_row(key, str(value))
     
     console.print(table)
 
 def display_agents_list(agents: Dict[str, Any]) -> None:
     """Отображает список доступных агентов."""
-    table = Table(box=box.ROUNDED, title="Список агентов")
-    table.add_column("ID", style="cyan")
-    table.add_column("Роль", style="magenta")
-    table.add_column("Статус", style="green")
+    table = _new_table("Список агентов", _AGENT_COLS)
     
-    for agent_id, agent in agents.items():
-        table.add_row(
-            agent_id,
-            agent.role.value,
-            "[green]Активен[/green]" if agent.state else "[red]Неактивен[/red]"
-        )
+    # Строки собираются одним проходом до заполнения таблицы
+    rows = [
+        (agent_id, role, _STATE_MARKUP[bool(state)])
+        for agent_id, (role, state) in zip(agents, map(_agent_fields, agents.values()))
+    ]
+    for row in rows:
+        table.add_row(*row)
     
     console.print(table)
 
+# Большие списки результатов выводятся частями: таблица строится и размечается
+# только для очередной порции строк, а не для всего списка сразу
+_RESULTS_CHUNK_THRESHOLD = 500
+_RESULTS_CHUNK_SIZE = 200
+
 def display_task_execution_results(results: List[Dict[str, Any]]) -> None:
     """Отображает результаты выполнения задач."""
-    table = Table(box=box.ROUNDED, title="Результаты задач")
-    table.add_column("ID задачи", style="cyan")
-    table.add_column("Статус", style="magenta")
-    table.add_column("Результат")
-    
-    for result in results:
-        status = "[green]Успех[/green]" if not isinstance(result.get('result'), Exception) else "[red]Ошибка[/red]"
-        table.add_row(
-            result['task_id'],
-            status,
-            str(result['result'])[:100] + "..." if len(str(result['result'])) > 100 else str(result['result'])
-        )
-    
-    console.print(table)
+    chunk_size = _RESULTS_CHUNK_SIZE if len(results) > _RESULTS_CHUNK_THRESHOLD else max(len(results), 1)
+
+    for start in range(0, max(len(results), 1), chunk_size):
+        chunk = results[start:start + chunk_size]
+        table = _new_table("Результаты задач" if start == 0 else None, _RESULT_COLS)
+
+        # Признак ошибки вычисляется для всех строк заранее; строковые результаты не преобразуются,
+        # обрезанный текст вместе с многоточием не длиннее 100 символов
+        is_error = [isinstance(result.get('result'), Exception) for result in chunk]
+        for result, failed in zip(chunk, is_error):
+            value = result['result']
+            text = value if type(value) is str else str(value)
+            table.add_row(
+                result['task_id'],
+                "[red]Ошибка[/red]" if failed else "[green]Успех[/green]",
+                text[:97] + "..." if len(text) > 100 else text
+            )
+
+        console.print(table)
 
 def display_system_stats(stats: Dict[str, Any]) -> None:
     """Отображает системную статистику."""
-    table = Table(box=box.ROUNDED, title="Системная статистика")
-    table.add_column("Метрика", style="cyan")
-    table.add_column("Значение", style="magenta")
+    table = _new_table("Системная статистика", _STATS_COLS)
     
     for metric, value in stats.items():
         table.add_row(metric, str(value))